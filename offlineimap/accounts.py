@@ -17,7 +17,7 @@
 from offlineimap import mbnames, CustomConfig, OfflineImapError
 from offlineimap.repository import Repository
 from offlineimap.ui import getglobalui
-from offlineimap.threadutil import InstanceLimitedThread
+from offlineimap.threadutil import getTaskEngine, getWorkerPool
 from subprocess import Popen, PIPE
 from threading import Event
 import os
@@ -29,6 +29,10 @@ try:
 except:
     pass # ok if this fails, we can do without
 
+SYNCPROCESS_ENV = 'OFFLINEIMAP_SYNCPROCESS'
+"""Set to the pid of the main process in the processes it starts to sync
+accounts with 'syncprocesses'"""
+
 def getaccountlist(customconfig):
     return customconfig.getsectionlist('Account')
 
@@ -73,6 +77,8 @@ class Account(CustomConfig.ConfigHelperMixin):
         self.quicknum = 0
         if self.refreshperiod == 0.0:
             self.refreshperiod = None
+        # set by repositories that noticed changes we did not make
+        self.localchange = Event()
 
     def getlocaleval(self):
         return self.localeval
@@ -130,9 +136,16 @@ class Account(CustomConfig.ConfigHelperMixin):
         skipsleep = self.getconfboolean("skipsleep", 0)
         if skipsleep:
             self.config.set(self.getsection(), "skipsleep", '0')
-        return skipsleep or Account.abort_soon_signal.is_set() or \
+        return skipsleep or self.localchange.is_set() or \
+            Account.abort_soon_signal.is_set() or \
             Account.abort_NOW_signal.is_set()
 
+    def notifylocalchange(self):
+        """Request an early sync because the local repository changed
+
+        Unlike a requested resync, this keeps the 'quick' schedule."""
+        self.localchange.set()
+
     def sleeper(self):
         """Sleep if the account is set to autorefresh
 
@@ -164,7 +177,10 @@ class Account(CustomConfig.ConfigHelperMixin):
             if Account.abort_soon_signal.is_set() or \
                     Account.abort_NOW_signal.is_set():
                 return 2
-            self.quicknum = 0
+            if self.localchange.is_set():
+                self.localchange.clear()
+            else:
+                self.quicknum = 0
             return 1
         return 0
 
@@ -192,7 +208,12 @@ class SyncableAccount(Account):
                                           "%s.lock" % self)
 
     def lock(self):
-        """Lock the account, throwing an exception if it is locked already"""
+        """Lock the account, throwing an exception if it is locked already
+
+        Processes started for 'syncprocesses' do not lock their accounts,
+        the main process holds their locks while they run."""
+        if os.environ.get(SYNCPROCESS_ENV) == str(os.getppid()):
+            return
         self._lockfd = open(self._lockfilepath, 'w')
         try:
             fcntl.lockf(self._lockfd, fcntl.LOCK_EX|fcntl.LOCK_NB)
@@ -260,6 +281,7 @@ class SyncableAccount(Account):
                 self.unlock()
                 if looping and self.sleeper() >= 2:
                     looping = 0
+        self.localrepos.shutdown()
 
     def get_local_folder(self, remotefolder):
         """Return the corresponding local folder for a given remotefolder"""
@@ -274,7 +296,9 @@ class SyncableAccount(Account):
         `self.statusrepos` has already been populated, so it should only
         be called from the :meth:`syncrunner` function.
         """
-        folderthreads = []
+        folderfutures = []
+        taskengine = getTaskEngine()
+        folderpool = getWorkerPool('FOLDER_' + self.remoterepos.getname())
 
         hook = self.getconf('presynchook', '')
         self.callhook(hook)
@@ -297,6 +321,8 @@ class SyncableAccount(Account):
             localrepos = self.localrepos
             statusrepos = self.statusrepos
 
+            # open all remote connections up front, in parallel
+            remoterepos.connect()
             # init repos with list of folders, so we have them (and the
             # folder delimiter etc)
             remoterepos.getfolders()
@@ -307,11 +333,9 @@ class SyncableAccount(Account):
             if not localrepos.getconfboolean('readonly', False):
                 self.ui.syncfolders(remoterepos, localrepos)
 
-            # iterate through all folders on the remote repo and sync
+            # collect the folders on the remote repo to sync
+            remotefolders = []
             for remotefolder in remoterepos.getfolders():
-                # check for CTRL-C or SIGTERM
-                if Account.abort_NOW_signal.is_set(): break
-
                 if not remotefolder.sync_this:
                     self.ui.debug('', "Not syncing filtered folder '%s'"
                                   "[%s]" % (remotefolder, remoterepos))
@@ -321,16 +345,30 @@ class SyncableAccount(Account):
                     self.ui.debug('', "Not syncing filtered folder '%s'"
                                  "[%s]" % (localfolder, localfolder.repository))
                     continue # Ignore filtered folder
-                thread = InstanceLimitedThread(\
-                    instancename = 'FOLDER_' + self.remoterepos.getname(),
-                    target = syncfolder,
-                    name = "Folder %s [acc: %s]" % (remotefolder, self),
-                    args = (self, remotefolder, quick))
-                thread.start()
-                folderthreads.append(thread)
-            # wait for all threads to finish
-            for thr in folderthreads:
-                thr.join()
+                remotefolders.append(remotefolder)
+
+            for rank, remotefolder in enumerate(
+                    self.schedulefolders(remotefolders)):
+                # check for CTRL-C or SIGTERM
+                if Account.abort_NOW_signal.is_set(): break
+
+                name = "Folder %s [acc: %s]" % (remotefolder, self)
+                if taskengine:
+                    future = taskengine.submit(
+                        'FOLDER_' + self.remoterepos.getname(),
+                        syncfolder, name, (self, remotefolder, quick, rank),
+                        priority=rank)
+                else:
+                    future = folderpool.submit(syncfolder, name,
+                        (self, remotefolder, quick, rank), priority=rank)
+                folderfutures.append(future)
+            # wait for all folders to finish
+            for future in folderfutures:
+                future.wait()
+            self.ui.debug('thread', (taskengine or folderpool).getstats())
+            for future in folderfutures:
+                # syncfolder() handles folder level errors itself
+                future.result()
             # Write out mailbox names if required and not in dry-run mode
             if not self.dryrun:
                 mbnames.write()
@@ -350,6 +388,23 @@ class SyncableAccount(Account):
         hook = self.getconf('postsynchook', '')
         self.callhook(hook)
 
+    def schedulefolders(self, remotefolders):
+        """Return the remote folders in the order they should be synced
+
+        Folders with a higher 'folderpriority' of the remote repository
+        (by default INBOX) come first, then folders by the estimated
+        number of messages to sync (see :meth:`BaseFolder.getsynccost`),
+        smallest first, and finally those whose cost is unknown. Folders
+        otherwise keep the order of getfolders()."""
+        priority = self.remoterepos.folderpriority
+        def key(folder):
+            cost = folder.getsynccost()
+            return (-priority(folder.getvisiblename()), cost is None, cost)
+        remotefolders = sorted(remotefolders, key=key)
+        self.ui.debug('', "Folder sync order: %s" % ", ".join(
+                [str(folder) for folder in remotefolders]))
+        return remotefolders
+
     def callhook(self, cmd):
         # check for CTRL-C or SIGTERM and run postsynchook
         if Account.abort_NOW_signal.is_set():
@@ -371,20 +426,26 @@ class SyncableAccount(Account):
         except Exception as e:
             self.ui.error(e, exc_info()[2], msg = "Calling hook")
 
-def syncfolder(account, remotefolder, quick):
-    """This function is called as target for the
-    InstanceLimitedThread invokation in SyncableAccount.
+def syncfolder(account, remotefolder, quick, rank=0):
+    """This function is queued on the folder WorkerPool (or the
+    TaskEngine) by SyncableAccount.
 
+    `rank` is the position of the folder in the sync schedule, the
+    message copies of earlier folders are preferred by the pools too.
     Filtered folders on the remote side will not invoke this function."""
     remoterepos = account.remoterepos
     localrepos = account.localrepos
     statusrepos = account.statusrepos
 
+    # check for CTRL-C or SIGTERM while the folder was queued
+    if Account.abort_NOW_signal.is_set():
+        return
     ui = getglobalui()
     ui.registerthread(account)
     try:
         # Load local folder.
         localfolder = account.get_local_folder(remotefolder)
+        remotefolder.syncrank = localfolder.syncrank = rank
 
         # Write the mailboxes
         mbnames.add(account.name, localfolder.getname())
@@ -457,6 +518,9 @@ def syncfolder(account, remotefolder, quick):
                          % remoterepos.getname())
 
         statusfolder.save()
+        if not account.dryrun:
+            localfolder.save_folderstatus()
+            remotefolder.save_folderstatus()
         localrepos.restore_atime()
     except (KeyboardInterrupt, SystemExit):
         raise
@@ -0,0 +1,89 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+# Set operations for the sync passes
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+"""Compute the work of the sync passes with set operations
+
+Rather than looking up every UID of one folder in another, the UIDs of
+both are compared in one go: as sorted arrays merged by NumPy if it is
+installed, or as Python sets otherwise. All functions return plain
+lists in ascending UID order."""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from offlineimap.flagutil import Flags
+
+NUMPY_THRESHOLD = 10000
+"""Below this number of UIDs, Python sets are faster than NumPy"""
+
+def _usenumpy(*seqs):
+    return numpy is not None and \
+        max([len(seq) for seq in seqs]) >= NUMPY_THRESHOLD
+
+def _uidarray(uids):
+    # the UIDs of a folder are unique already
+    return numpy.sort(numpy.fromiter(uids, numpy.int64, len(uids)))
+
+def difference(uids, other):
+    """Return the UIDs of `uids` that are not in `other`"""
+    if _usenumpy(uids, other):
+        return numpy.setdiff1d(_uidarray(uids), _uidarray(other),
+                               assume_unique=True).tolist()
+    other = set(other)
+    return sorted([uid for uid in uids if uid not in other])
+
+def intersection(uids, other):
+    """Return the UIDs that are in both `uids` and `other`"""
+    if _usenumpy(uids, other):
+        return numpy.intersect1d(_uidarray(uids), _uidarray(other),
+                                 assume_unique=True).tolist()
+    return sorted(set(uids).intersection(other))
+
+def changedflags(uidflags, messagelist):
+    """Compare the flags of messages with those in a message list
+
+    :param uidflags: iterable of (uid, flags) pairs
+    :param messagelist: the message list of the other folder, a dict of
+        uid: {'flags': flags, ...}
+    :returns: a list of (uid, otherflags) pairs for the messages of
+        `uidflags` whose flags differ from otherflags, sorted by UID.
+        otherflags are empty Flags for messages that are not in the
+        message list."""
+    changed = []
+    for uid, flags in uidflags:
+        msg = messagelist.get(uid)
+        otherflags = msg['flags'] if msg is not None else Flags()
+        if flags != otherflags:
+            changed.append((uid, otherflags))
+    changed.sort()
+    return changed
+
+def flagbatches(changes):
+    """Group flag changes by flag, for bulk flag updates
+
+    :param changes: iterable of (uid, flags, oldflags) triples, where
+        flags are the wanted flags and oldflags the current ones
+    :returns: (addflags, delflags), two dicts of flag: list of UIDs"""
+    addflags = {}
+    delflags = {}
+    for uid, flags, oldflags in changes:
+        for flag in flags - oldflags:
+            addflags.setdefault(flag, []).append(uid)
+        for flag in oldflags - flags:
+            delflags.setdefault(flag, []).append(uid)
+    return addflags, delflags
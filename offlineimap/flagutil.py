@@ -0,0 +1,124 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+# Compact representation of message flags
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+"""Message flags as a bitmask
+
+All folder backends keep the flags of a message as a :class:`Flags`
+instance: the Maildir flag characters ('S', 'R', 'F', 'T', 'D', ...)
+as bits of an int."""
+
+import string
+
+FLAGCHARS = string.digits + string.ascii_uppercase + '_' + \
+    string.ascii_lowercase
+"""All characters that may be a flag, in ASCII order. The position of a
+character is its bit, so a mask fits into 63 bits."""
+
+FLAGBITS = dict((char, 1 << bit) for bit, char in enumerate(FLAGCHARS))
+
+class Flags(int):
+    """An immutable set of flag characters, stored as a bitmask
+
+    Flags behave like a frozenset of flag characters for what is done
+    with flags: iteration (in ASCII order), `in`, len() and the set
+    operators | & - ^ with other Flags, sets or strings of flag
+    characters. But they are ints, so comparing two Flags is a plain
+    integer comparison. Note that Flags never compare equal to sets.
+
+    There is only one Flags instance per mask, shared by all messages
+    with these flags, and str() of it is the status string, e.g. 'RS'.
+
+    Flags() accepts a mask, a string of flag characters or any iterable
+    of them, and raises ValueError on unknown characters."""
+
+    _bymask = {}
+    _bystring = {}
+
+    def __new__(cls, flags=0):
+        if type(flags) is Flags:
+            return flags
+        if isinstance(flags, basestring):
+            known = cls._bystring.get(flags)
+            if known is not None:
+                return known
+        if isinstance(flags, (int, long)):
+            mask = flags
+            if mask < 0 or mask >> len(FLAGCHARS):
+                raise ValueError("Invalid flag mask %r" % mask)
+        else:
+            mask = 0
+            for flag in flags:
+                try:
+                    mask |= FLAGBITS[flag]
+                except KeyError:
+                    raise ValueError("Invalid flag %r" % flag)
+        known = cls._bymask.get(mask)
+        if known is None:
+            known = int.__new__(cls, mask)
+            known.string = ''.join([char for char in FLAGCHARS
+                                    if mask & FLAGBITS[char]])
+            known = cls._bymask.setdefault(mask, known)
+        if isinstance(flags, basestring):
+            cls._bystring[flags] = known
+        return known
+
+    def __str__(self):
+        return self.string
+
+    def __repr__(self):
+        return "Flags(%r)" % self.string
+
+    def __iter__(self):
+        return iter(self.string)
+
+    def __len__(self):
+        return len(self.string)
+
+    def __contains__(self, flag):
+        return bool(self & FLAGBITS.get(flag, 0))
+
+    def __or__(self, other):
+        return _frommask(int.__or__(self, _mask(other)))
+    __ror__ = __or__
+
+    def __and__(self, other):
+        return _frommask(int.__and__(self, _mask(other)))
+    __rand__ = __and__
+
+    def __xor__(self, other):
+        return _frommask(int.__xor__(self, _mask(other)))
+    __rxor__ = __xor__
+
+    def __sub__(self, other):
+        return _frommask(int.__and__(self, ~_mask(other)))
+
+    def __rsub__(self, other):
+        return _frommask(_mask(other) & ~int.__int__(self))
+
+    def __reduce__(self):
+        return (Flags, (int(self),))
+
+def _mask(flags):
+    """The mask of Flags, a mask or an iterable of flag characters"""
+    if type(flags) is Flags:
+        return int.__int__(flags)
+    return int.__int__(Flags(flags))
+
+def _frommask(mask):
+    try:
+        return Flags._bymask[mask]
+    except KeyError:
+        return Flags(mask)
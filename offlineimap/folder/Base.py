@@ -15,12 +15,14 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-from offlineimap import threadutil
+from offlineimap import threadutil, diffutil
 from offlineimap.ui import getglobalui
+from offlineimap.flagutil import Flags
 from offlineimap.error import OfflineImapError
 import offlineimap.accounts
 import os.path
 import re
+import time
 from sys import exc_info
 import traceback
 
@@ -47,6 +49,8 @@ class BaseFolder(object):
         if self.visiblename == self.getsep():
             self.visiblename = ''
         self.config = repository.getconfig()
+        self.syncrank = 0
+        """Position of the folder in the account's sync schedule"""
 
     def getname(self):
         """Returns name"""
@@ -71,8 +75,8 @@ class BaseFolder(object):
         return 0
 
     def getcopyinstancelimit(self):
-        """For threading folders, returns the instancelimitname for
-        InstanceLimitedThreads."""
+        """For threading folders, returns the name of the WorkerPool
+        used to copy messages."""
         raise NotImplementedException
 
     def storesmessages(self):
@@ -164,6 +168,20 @@ class BaseFolder(object):
         os.rename(uidfilename + ".tmp", uidfilename)
         self._base_saved_uidvalidity = newval
 
+    def getsynccost(self):
+        """Estimate the number of messages to be synced in this folder
+
+        Used to sync cheap folders first. Must not be expensive itself.
+        :returns: the estimate or None if it is unknown"""
+        return None
+
+    def save_folderstatus(self):
+        """Save whatever quickchanged() needs to detect changes later on
+
+        Invoked after the folder has been synced successfully. The
+        default implementation does nothing."""
+        pass
+
     def get_uidvalidity(self):
         """Retrieve the current connections UIDVALIDITY value
 
@@ -195,6 +213,26 @@ class BaseFolder(object):
         """Gets the number of messages."""
         return len(self.getmessagelist())
 
+    def getmissinguids(self, uidlist):
+        """Returns the UIDs of uidlist that do not exist in this folder,
+        in ascending order"""
+        return diffutil.difference(uidlist, self.getmessageuidlist())
+
+    def getotheruids(self, uidlist):
+        """Returns the UIDs of this folder that are not in uidlist, in
+        ascending order"""
+        return diffutil.difference(self.getmessageuidlist(), uidlist)
+
+    def getchangedflags(self, uidflags):
+        """Compares flags with the flags in this folder
+
+        :param uidflags: iterable of (uid, flags) pairs
+        :returns: a list of (uid, ourflags) pairs for the messages
+            whose flags differ from ourflags, in ascending UID order.
+            ourflags are empty Flags for messages that do not exist in
+            this folder."""
+        return diffutil.changedflags(uidflags, self.getmessagelist())
+
     def getmessage(self, uid):
         """Returns the content of the specified message."""
         raise NotImplementedException
@@ -220,9 +258,23 @@ class BaseFolder(object):
         Note that savemessage() does not check against dryrun settings,
         so you need to ensure that savemessage is never called in a
         dryrun mode.
+
+        A backend may write messages in batches. Such a message is only
+        safe once :meth:`flushmessages` ran, see :meth:`afterflush`.
         """
         raise NotImplementedException
 
+    def afterflush(self, uid, func, *args):
+        """Call func(*args) once the message `uid` saved by savemessage()
+        is safely stored, which is right away unless the backend batches
+        writes. If the message is lost before that, func is never
+        called."""
+        func(*args)
+
+    def flushmessages(self):
+        """Store messages that are still batched, see :meth:`afterflush`"""
+        pass
+
     def getmessagetime(self, uid):
         """Return the received time for the specified message."""
         raise NotImplementedException
@@ -247,7 +299,7 @@ class BaseFolder(object):
         so you need to ensure that it is never called in a
         dryrun mode.
 
-        :param flags: A set() of flags"""
+        :param flags: Flags, or a set of flag characters"""
         newflags = self.getmessageflags(uid) | flags
         self.savemessageflags(uid, newflags)
 
@@ -347,8 +399,10 @@ class BaseFolder(object):
                     self.change_message_uid(uid, new_uid)
                     statusfolder.deletemessage(uid)
                     # Got new UID, change the local uid.
-                # Save uploaded status in the statusfolder
-                statusfolder.savemessage(new_uid, message, flags, rtime)
+                # Save uploaded status in the statusfolder, but not
+                # before the message is safe in dstfolder
+                dstfolder.afterflush(new_uid, statusfolder.savemessage,
+                                     new_uid, message, flags, rtime)
             elif new_uid == 0:
                 # Message was stored to dstfolder, but we can't find it's UID
                 # This means we can't link current message to the one created
@@ -385,38 +439,67 @@ class BaseFolder(object):
            - If dstfolder doesn't have it yet, add them to dstfolder.
            - Update statusfolder
 
+        The statusfolder is checkpointed every 'statuscheckpoint'
+        messages or 'statuscheckpointinterval' seconds, so that an
+        interrupted sync does not need to start over.
+
         This function checks and protects us from action in ryrun mode.
         """
-        threads = []
+        futures = []
+        account = self.repository.account
+        checkpointevery = account.getconfint('statuscheckpoint', 100)
+        checkpointinterval = account.getconfint('statuscheckpointinterval', 60)
+        lastcheckpoint = time.time()
 
-        copylist = filter(lambda uid: not \
-                              statusfolder.uidexists(uid),
-                            self.getmessageuidlist())
+        copylist = statusfolder.getmissinguids(self.getmessageuidlist())
         num_to_copy = len(copylist)
         if num_to_copy and self.repository.account.dryrun:
             self.ui.info("[DRYRUN] Copy {0} messages from {1}[{2}] to {3}".format(
                     num_to_copy, self, self.repository, dstfolder.repository))
             return
-        for num, uid in enumerate(copylist):
-            # bail out on CTRL-C or SIGTERM
-            if offlineimap.accounts.Account.abort_NOW_signal.is_set():
-                break
-            self.ui.copyingmessage(uid, num+1, num_to_copy, self, dstfolder)
-            # exceptions are caught in copymessageto()
-            if self.suggeststhreads():
-                self.waitforthread()
-                thread = threadutil.InstanceLimitedThread(\
-                    self.getcopyinstancelimit(),
-                    target = self.copymessageto,
-                    name = "Copy message from %s:%s" % (self.repository, self),
-                    args = (uid, dstfolder, statusfolder))
-                thread.start()
-                threads.append(thread)
-            else:
-                self.copymessageto(uid, dstfolder, statusfolder,
-                                   register = 0)
-        for thread in threads:
-            thread.join()
+        try:
+            for num, uid in enumerate(copylist):
+                # bail out on CTRL-C or SIGTERM
+                if offlineimap.accounts.Account.abort_NOW_signal.is_set():
+                    break
+                self.ui.copyingmessage(uid, num+1, num_to_copy, self,
+                                       dstfolder)
+                # exceptions are caught in copymessageto()
+                if self.suggeststhreads() and not threadutil.getTaskEngine():
+                    self.waitforthread()
+                    pool = threadutil.getWorkerPool(
+                        self.getcopyinstancelimit())
+                    futures.append(pool.submit(self.copymessageto,
+                        "Copy message from %s:%s" % (self.repository, self),
+                        (uid, dstfolder, statusfolder),
+                        priority=self.syncrank))
+                else:
+                    self.copymessageto(uid, dstfolder, statusfolder,
+                                       register = 0)
+                if (checkpointevery and (num + 1) % checkpointevery == 0) or \
+                        (checkpointinterval and
+                         time.time() - lastcheckpoint >= checkpointinterval):
+                    # copies still in flight are journaled and make it into
+                    # the next checkpoint
+                    statusfolder.checkpoint()
+                    lastcheckpoint = time.time()
+            for future in futures:
+                # copy what the busy workers did not get to yet ourselves,
+                # within the same connection and worker limits
+                if not future.done():
+                    self.waitforthread()
+                    pool.tryrun(future)
+                future.wait()
+        finally:
+            # messages that are never flushed, e.g. on severe errors, stay
+            # in tmp/ and are not in the statusfolder, so they are copied
+            # again
+            dstfolder.flushmessages()
+        if futures:
+            self.ui.debug('thread', pool.getstats())
+        for future in futures:
+            # copymessageto() only raises severe and unknown errors
+            future.result()
 
     def syncmessagesto_delete(self, dstfolder, statusfolder):
         """Pass 2: Remove locally deleted messages on dst
@@ -427,9 +510,8 @@ class BaseFolder(object):
 
         This function checks and protects us from action in ryrun mode.
         """
-        deletelist = filter(lambda uid: uid>=0 \
-                                and not self.uidexists(uid),
-                            statusfolder.getmessageuidlist())
+        deletelist = filter(lambda uid: uid>=0,
+            statusfolder.getotheruids(self.getmessageuidlist()))
         if len(deletelist):
             self.ui.deletingmessages(deletelist, [dstfolder])
             if self.repository.account.dryrun:
@@ -452,46 +534,29 @@ class BaseFolder(object):
         # For each flag, we store a list of uids to which it should be
         # added.  Then, we can call addmessagesflags() to apply them in
         # bulk, rather than one call per message.
-        addflaglist = {}
-        delflaglist = {}
-        for uid in self.getmessageuidlist():
-            # Ignore messages with negative UIDs missed by pass 1 and
-            # don't do anything if the message has been deleted remotely
-            if uid < 0 or not dstfolder.uidexists(uid):
-                continue
-
-            selfflags = self.getmessageflags(uid)
-            statusflags = statusfolder.getmessageflags(uid)
-            #if we could not get message flags from LocalStatus, assume empty.
-            if statusflags is None:
-                statusflags = set()
-
-            addflags = selfflags - statusflags
-            delflags = statusflags - selfflags
-
-            for flag in addflags:
-                if not flag in addflaglist:
-                    addflaglist[flag] = []
-                addflaglist[flag].append(uid)
-
-            for flag in delflags:
-                if not flag in delflaglist:
-                    delflaglist[flag] = []
-                delflaglist[flag].append(uid)
+        # Ignore messages with negative UIDs missed by pass 1 and
+        # don't do anything if the message has been deleted remotely
+        uids = diffutil.intersection(self.getmessageuidlist(),
+                                     dstfolder.getmessageuidlist())
+        uidflags = ((uid, self.getmessageflags(uid))
+                    for uid in uids if uid >= 0)
+        addflaglist, delflaglist = diffutil.flagbatches(
+            (uid, self.getmessageflags(uid), statusflags)
+            for uid, statusflags in statusfolder.getchangedflags(uidflags))
 
         for flag, uids in addflaglist.items():
             self.ui.addingflags(uids, flag, dstfolder)
             if self.repository.account.dryrun:
                 continue #don't actually add in a dryrun
-            dstfolder.addmessagesflags(uids, set(flag))
-            statusfolder.addmessagesflags(uids, set(flag))
+            dstfolder.addmessagesflags(uids, Flags(flag))
+            statusfolder.addmessagesflags(uids, Flags(flag))
 
         for flag,uids in delflaglist.items():
             self.ui.deletingflags(uids, flag, dstfolder)
             if self.repository.account.dryrun:
                 continue #don't actually remove in a dryrun
-            dstfolder.deletemessagesflags(uids, set(flag))
-            statusfolder.deletemessagesflags(uids, set(flag))
+            dstfolder.deletemessagesflags(uids, Flags(flag))
+            statusfolder.deletemessagesflags(uids, Flags(flag))
                 
     def syncmessagesto(self, dstfolder, statusfolder):
         """Syncs messages in this folder to the destination dstfolder.
@@ -29,6 +29,7 @@ except NameError:
     from sets import Set as set
 
 from offlineimap import OfflineImapError
+from offlineimap.flagutil import Flags
 
 # Find the UID in a message filename
 re_uidmatch = re.compile(',U=(\d+)')
@@ -136,11 +137,11 @@ class CouchFolder(BaseFolder):
 
     @staticmethod
     def _encode_flags(flags):
-        return reduce(lambda a,b: a+b, flags, "")
+        return str(Flags(flags))
 
     @staticmethod
     def _decode_flags(flags):
-        return set(flags)
+        return Flags(flags)
 
     @staticmethod
     def _encode_text(text):
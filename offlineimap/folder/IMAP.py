@@ -19,14 +19,19 @@ import email
 import random
 import binascii
 import re
+import os
 import time
 from sys import exc_info
 from .Base import BaseFolder
 from offlineimap import imaputil, imaplibutil, OfflineImapError
 from offlineimap.imaplib2 import MonthNames
+from offlineimap.flagutil import Flags
 
 
 class IMAPFolder(BaseFolder):
+    re_headerend = re.compile(r'\r?\n\r?\n')
+    """Matches the empty line separating message headers and body"""
+
     def __init__(self, imapserver, name, repository):
         name = imaputil.dequote(name)
         self.sep = imapserver.delim
@@ -36,6 +41,14 @@ class IMAPFolder(BaseFolder):
         self.imapserver = imapserver
         self.messagelist = None
         self.randomgenerator = random.Random()
+        self._quickstatus = None
+        """STATUS values of this folder as found before syncing it"""
+        self._appendeduids = []
+        """UIDs of the messages we appended (0 if unknown)"""
+        self._expungeduids = []
+        """UIDs of the messages we expunged"""
+        self._reflagged = False
+        """Did we store flags in this folder?"""
         #self.ui is set in BaseFolder
 
     def selectro(self, imapobj, force = False):
@@ -69,7 +82,7 @@ class IMAPFolder(BaseFolder):
         if hasattr(self, '_uidvalidity'):
             # use cached value if existing
             return self._uidvalidity
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
         try:
             # SELECT (if not already done) and get current UIDVALIDITY
             self.selectro(imapobj)
@@ -81,7 +94,108 @@ class IMAPFolder(BaseFolder):
         finally:
             self.imapserver.releaseconnection(imapobj)
 
+    def _getquickstatus(self):
+        """Return the STATUS values of this folder (or None)
+
+        The values are fetched once, before we start syncing the
+        folder, so that :meth:`save_folderstatus` does not record changes
+        that have not been synced (see :meth:`_getsyncedstatus`)."""
+        if self._quickstatus is None:
+            self._quickstatus = self.repository.getfolderstatus(
+                self.getfullname())
+        return self._quickstatus
+
+    def _getfolderstatusfilename(self):
+        return os.path.join(self.repository.getfolderstatusdir(),
+                            self.getfolderbasename())
+
+    def getsynccost(self):
+        """Estimate the number of messages to be synced from the STATUS
+
+        Compares the number of messages and UIDNEXT with the values saved
+        after the last sync, or returns the number of messages if the
+        folder has not been synced yet."""
+        status = self._getquickstatus()
+        if not status or not 'MESSAGES' in status:
+            return None
+        saved = self.get_savedfolderstatus()
+        if saved is None or \
+                saved.get('UIDVALIDITY') != status.get('UIDVALIDITY'):
+            return status['MESSAGES']
+        return abs(status['MESSAGES'] - saved.get('MESSAGES', 0)) + \
+            max(status.get('UIDNEXT', 0) - saved.get('UIDNEXT', 0), 0)
+
+    def get_savedfolderstatus(self):
+        """Return the STATUS values saved after the last successful sync
+
+        :returns: dict of STATUS items or None if none had been saved."""
+        filename = self._getfolderstatusfilename()
+        if not os.path.exists(filename):
+            return None
+        with open(filename, "rt") as file:
+            items = file.readline().split()
+        return dict(zip(items[::2], [long(v) for v in items[1::2]]))
+
+    def _getsyncedstatus(self):
+        """Return the STATUS values to save after we synced the folder
+
+        If we changed the folder, STATUS is queried again, and the new
+        values are returned if our own appends and expunges account for
+        the new MESSAGES and UIDNEXT. Otherwise somebody else changed
+        the folder as well, and the values from before the sync are
+        returned so that the next sync does not miss those changes. The
+        new HIGHESTMODSEQ is taken as is, as we can not tell how far our
+        own changes moved it: flags changed by others while we synced
+        the folder are only noticed once it changes again."""
+        before = self._quickstatus
+        if not (self._appendeduids or self._expungeduids or self._reflagged):
+            return before
+        if 0 in self._appendeduids or not 'MESSAGES' in before or \
+                not 'UIDNEXT' in before:
+            return before
+        after = self.imapserver.folderstatus([self.getfullname()]).get(
+            self.getfullname())
+        if after is None or \
+                after.get('UIDVALIDITY') != before.get('UIDVALIDITY'):
+            return before
+        messages = before['MESSAGES'] + len(self._appendeduids) - \
+            len(self._expungeduids)
+        uidnext = max([before['UIDNEXT']] +
+                      [uid + 1 for uid in self._appendeduids])
+        if after.get('MESSAGES') != messages or \
+                after.get('UIDNEXT') != uidnext:
+            return before
+        return after
+
+    def save_folderstatus(self):
+        """Save the STATUS values for the next :meth:`quickchanged` call"""
+        if self._quickstatus is None:
+            return
+        status = self._getsyncedstatus()
+        filename = self._getfolderstatusfilename()
+        items = ' '.join(['%s %d' % (k, v) for k, v in sorted(status.items())])
+        with open(filename + ".tmp", "wt") as file:
+            file.write("%s\n" % items)
+        os.rename(filename + ".tmp", filename)
+
     def quickchanged(self, statusfolder):
+        """Returns True if the folder changed since the last sync
+
+        Compares the folder's STATUS (MESSAGES, UIDNEXT, UIDVALIDITY and,
+        on CONDSTORE servers, HIGHESTMODSEQ) with the values saved after
+        the previous sync. The STATUS of all folders is fetched in one
+        go, so no SELECT is needed. Falls back to SELECTing the folder if
+        the server did not report a STATUS for it."""
+        status = self._getquickstatus()
+        if status is None:
+            return self._quickchanged_select(statusfolder)
+        saved = self.get_savedfolderstatus()
+        if saved is None:
+            # Nothing saved yet, only compare the number of messages
+            return status.get('MESSAGES') != statusfolder.getmessagecount()
+        return status != saved
+
+    def _quickchanged_select(self, statusfolder):
         # An IMAP folder has definitely changed if the number of
         # messages or the UID of the last message have changed.  Otherwise
         # only flag changes could have occurred.
@@ -124,6 +238,8 @@ class IMAPFolder(BaseFolder):
         maxsize = self.config.getdefaultint("Account %s" % self.accountname,
                                             "maxsize", -1)
         self.messagelist = {}
+        # record the pre-sync STATUS for save_folderstatus()
+        self._getquickstatus()
 
         imapobj = self.imapserver.acquireconnection()
         try:
@@ -182,21 +298,24 @@ class IMAPFolder(BaseFolder):
         finally:
             self.imapserver.releaseconnection(imapobj)
 
+        fetch2hash = imaputil.fetch2hash
+        flagsimap2maildir = imaputil.flagsimap2maildir
         for messagestr in response:
             # looks like: '1 (FLAGS (\\Seen Old) UID 4807)' or None if no msg
-            # Discard initial message number.
             if messagestr == None:
                 continue
-            messagestr = messagestr.split(' ', 1)[1]
-            options = imaputil.flags2hash(messagestr)
+            options = fetch2hash(messagestr)
             if not 'UID' in options:
                 self.ui.warn('No UID in message with options %s' %\
                                           str(options),
                                           minor = 1)
             else:
                 uid = long(options['UID'])
-                flags = imaputil.flagsimap2maildir(options['FLAGS'])
-                rtime = imaplibutil.Internaldate2epoch(messagestr)
+                flags = flagsimap2maildir(options['FLAGS'])
+                rtime = None
+                if 'INTERNALDATE' in options:
+                    rtime = imaplibutil.Internaldate2epoch(
+                        'INTERNALDATE ' + options['INTERNALDATE'])
                 self.messagelist[uid] = {'uid': uid, 'flags': flags, 'time': rtime}
 
     def getmessagelist(self):
@@ -209,7 +328,7 @@ class IMAPFolder(BaseFolder):
                   (probably severity MESSAGE) if e.g. no message with
                   this UID could be found.
         """
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(self.getfullname(), True)
         try:
             fails_left = 2 # retry on dropped connection
             while fails_left:
@@ -221,7 +340,8 @@ class IMAPFolder(BaseFolder):
                 except imapobj.abort as e:
                     # Release dropped connection, and get a new one
                     self.imapserver.releaseconnection(imapobj, True)
-                    imapobj = self.imapserver.acquireconnection()
+                    imapobj = self.imapserver.acquireconnection(
+                        self.getfullname(), True)
                     self.ui.error(e, exc_info()[2])
                     fails_left -= 1
                     if not fails_left:
@@ -242,17 +362,19 @@ class IMAPFolder(BaseFolder):
             # and that msg is in data[0]. msbody is in [0][1]
             data = data[0][1].replace("\r\n", "\n")
 
-            if len(data)>200:
-                dbg_output = "%s...%s" % (str(data)[:150],
-                                          str(data)[-50:])
-            else:
-                dbg_output = data
-            self.ui.debug('imap', "Returned object from fetching %d: '%s'" %
-                          (uid, dbg_output))
+            if self.ui.is_debugging('imap'):
+                self.ui.debug('imap', "Returned object from fetching %d: '%s'"
+                              % (uid, self._dbg_excerpt(data)))
         finally:
             self.imapserver.releaseconnection(imapobj)
         return data
 
+    def _dbg_excerpt(self, content):
+        """Returns the start and end of a message for debug output"""
+        if len(content) > 200:
+            return "%s...%s" % (content[:150], content[-50:])
+        return content
+
     def getmessagetime(self, uid):
         return self.messagelist[uid]['time']
 
@@ -290,20 +412,29 @@ class IMAPFolder(BaseFolder):
         self.ui.debug('imap',
                  'savemessage_addheader: called to add %s: %s' % (headername,
                                                                   headervalue))
-        insertionpoint = content.find("\r\n\r\n")
-        self.ui.debug('imap', 'savemessage_addheader: insertionpoint = %d' % insertionpoint)
-        leader = content[0:insertionpoint]
-        self.ui.debug('imap', 'savemessage_addheader: leader = %s' % repr(leader))
-        if insertionpoint == 0 or insertionpoint == -1:
-            newline = ''
+        # content may use either LF or CRLF line endings, append() will
+        # convert them all to CRLF anyway.
+        headerend = self.re_headerend.search(content)
+        if headerend is None:
+            # headers only, no body
+            insertionpoint = 0
+            newline = "%s: %s\r\n" % (headername, headervalue)
+        elif headerend.start() == 0:
             insertionpoint = 0
+            newline = "%s: %s" % (headername, headervalue)
         else:
-            newline = "\r\n"
-        newline += "%s: %s" % (headername, headervalue)
-        self.ui.debug('imap', 'savemessage_addheader: newline = ' + repr(newline))
-        trailer = content[insertionpoint:]
-        self.ui.debug('imap', 'savemessage_addheader: trailer = ' + repr(trailer))
-        return leader + newline + trailer
+            insertionpoint = headerend.start()
+            if content[insertionpoint] == '\r':
+                newline = "\r\n"
+            else:
+                newline = "\n"
+            newline += "%s: %s" % (headername, headervalue)
+        self.ui.debug('imap', 'savemessage_addheader: insertionpoint = %d' % insertionpoint)
+        leader = content[0:insertionpoint]
+        if self.ui.is_debugging('imap'):
+            self.ui.debug('imap', 'savemessage_addheader: leader = %s' % repr(leader))
+            self.ui.debug('imap', 'savemessage_addheader: newline = ' + repr(newline))
+        return ''.join((leader, newline, content[insertionpoint:]))
 
 
     def savemessage_searchforheader(self, imapobj, headername, headervalue):
@@ -431,6 +562,10 @@ class IMAPFolder(BaseFolder):
                   (including double quotes) or `None` in case of failure
                   (which is fine as value for append)."""
         if rtime is None:
+            # only parse the headers, not a possibly huge body
+            headerend = self.re_headerend.search(content)
+            if headerend is not None:
+                content = content[:headerend.start()]
             message = email.message_from_string(content)
             # parsedate returns a 9-tuple that can be passed directly to
             # time.mktime(); Will be None if missing or not in a valid
@@ -500,6 +635,7 @@ class IMAPFolder(BaseFolder):
                   message is saved, but it's UID can not be found, it will
                   return 0. If the message can't be written (folder is
                   read-only for example) it will return -1."""
+        flags = Flags(flags)
         self.ui.savemessage('imap', uid, flags, self)
 
         # already have it, just save modified flags
@@ -507,31 +643,31 @@ class IMAPFolder(BaseFolder):
             self.savemessageflags(uid, flags)
             return uid
 
+        # get the date of the message, so we can pass it to the server.
+        date = self.getmessageinternaldate(content, rtime)
+        # Line endings are left alone: imapobj.append() translates them
+        # to CRLF while sending, so converting them here would only
+        # copy the message once more.
+
         retry_left = 2 # succeeded in APPENDING?
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
         try:
             while retry_left:
                 # UIDPLUS extension provides us with an APPENDUID response.
                 use_uidplus = 'UIDPLUS' in imapobj.capabilities
 
-                # get the date of the message, so we can pass it to the server.
-                date = self.getmessageinternaldate(content, rtime)
-                content = re.sub("(?<!\r)\n", "\r\n", content)
-
+                message = content
                 if not use_uidplus:
                     # insert a random unique header that we can fetch later
                     (headername, headervalue) = self.generate_randomheader(
                                                     content)
                     self.ui.debug('imap', 'savemessage: header is: %s: %s' %\
                                       (headername, headervalue))
-                    content = self.savemessage_addheader(content, headername,
-                                                         headervalue)    
-                if len(content)>200:
-                    dbg_output = "%s...%s" % (content[:150], content[-50:])
-                else:
-                    dbg_output = content
-                self.ui.debug('imap', "savemessage: date: %s, content: '%s'" %
-                             (date, dbg_output))
+                    message = self.savemessage_addheader(content, headername,
+                                                         headervalue)
+                if self.ui.is_debugging('imap'):
+                    self.ui.debug('imap', "savemessage: date: %s, content: '%s'"
+                                  % (date, self._dbg_excerpt(message)))
 
                 try:
                     # Select folder for append and make the box READ-WRITE
@@ -539,25 +675,27 @@ class IMAPFolder(BaseFolder):
                 except imapobj.readonly:
                     # readonly exception. Return original uid to notify that
                     # we did not save the message. (see savemessage in Base.py)
-                    self.ui.msgtoreadonly(self, uid, content, flags)
+                    self.ui.msgtoreadonly(self, uid, message, flags)
                     return uid
 
                 #Do the APPEND
                 try:
                     (typ, dat) = imapobj.append(self.getfullname(),
                                        imaputil.flagsmaildir2imap(flags),
-                                       date, content)
+                                       date, message)
                     retry_left = 0                # Mark as success
                 except imapobj.abort as e:
                     # connection has been reset, release connection and retry.
                     retry_left -= 1
                     self.imapserver.releaseconnection(imapobj, True)
-                    imapobj = self.imapserver.acquireconnection()
+                    imapobj = self.imapserver.acquireconnection(
+                        self.getfullname())
                     if not retry_left:
                         raise OfflineImapError("Saving msg in folder '%s', "
                               "repository '%s' failed (abort). Server reponded: %s\n"
                               "Message content was: %s" %
-                              (self, self.getrepository(), str(e), dbg_output),
+                              (self, self.getrepository(), str(e),
+                               self._dbg_excerpt(message)),
                                                OfflineImapError.ERROR.MESSAGE)
                     self.ui.error(e, exc_info()[2])
                 except imapobj.error as e: # APPEND failed
@@ -568,7 +706,8 @@ class IMAPFolder(BaseFolder):
                     imapobj = None
                     raise OfflineImapError("Saving msg folder '%s', repo '%s'"
                         "failed (error). Server reponded: %s\nMessage content was: "
-                        "%s" % (self, self.getrepository(), str(e), dbg_output),
+                        "%s" % (self, self.getrepository(), str(e),
+                                self._dbg_excerpt(message)),
                                            OfflineImapError.ERROR.MESSAGE)
             # Checkpoint. Let it write out stuff, etc. Eg searches for
             # just uploaded messages won't work if we don't do this.
@@ -587,10 +726,11 @@ class IMAPFolder(BaseFolder):
                 if resp == [None] or resp is None:
                     self.ui.warn("Server supports UIDPLUS but got no APPENDUID "
                                  "appending a message.")
-                    return 0
-                uid = long(resp[-1].split(' ')[1])
-                if uid == 0:
-                    self.ui.warn("savemessage: Server supports UIDPLUS, but"
+                    uid = 0
+                else:
+                    uid = long(resp[-1].split(' ')[1])
+                    if uid == 0:
+                        self.ui.warn("savemessage: Server supports UIDPLUS, but"
                             " we got no usable uid back. APPENDUID reponse was "
                             "'%s'" % str(resp))
             else:
@@ -609,6 +749,7 @@ class IMAPFolder(BaseFolder):
         finally:
             self.imapserver.releaseconnection(imapobj)
 
+        self._appendeduids.append(uid)
         if uid: # avoid UID FETCH 0 crash happening later on
             self.messagelist[uid] = {'uid': uid, 'flags': flags}
 
@@ -621,7 +762,7 @@ class IMAPFolder(BaseFolder):
         Note that this function does not check against dryrun settings,
         so you need to ensure that it is never called in a
         dryrun mode."""
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
         try:
             try:
                 imapobj.select(self.getfullname())
@@ -631,13 +772,14 @@ class IMAPFolder(BaseFolder):
             result = imapobj.uid('store', '%d' % uid, 'FLAGS',
                                  imaputil.flagsmaildir2imap(flags))
             assert result[0] == 'OK', 'Error with store: ' + '. '.join(result[1])
+            self._reflagged = True
         finally:
             self.imapserver.releaseconnection(imapobj)
         result = result[1][0]
         if not result:
-            self.messagelist[uid]['flags'] = flags
+            self.messagelist[uid]['flags'] = Flags(flags)
         else:
-            flags = imaputil.flags2hash(imaputil.imapsplit(result)[1])['FLAGS']
+            flags = imaputil.fetch2hash(result)['FLAGS']
             self.messagelist[uid]['flags'] = imaputil.flagsimap2maildir(flags)
 
     def addmessageflags(self, uid, flags):
@@ -665,7 +807,7 @@ class IMAPFolder(BaseFolder):
             self.processmessagesflags(operation, uidlist[100:], flags)
             return
 
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
         try:
             try:
                 imapobj.select(self.getfullname())
@@ -677,6 +819,7 @@ class IMAPFolder(BaseFolder):
                             operation + 'FLAGS',
                             imaputil.flagsmaildir2imap(flags))
             assert r[0] == 'OK', 'Error with store: ' + '. '.join(r[1])
+            self._reflagged = True
             r = r[1]
         finally:
             self.imapserver.releaseconnection(imapobj)
@@ -689,7 +832,7 @@ class IMAPFolder(BaseFolder):
                 # Compensate for servers that don't return anything from
                 # STORE.
                 continue
-            attributehash = imaputil.flags2hash(imaputil.imapsplit(result)[1])
+            attributehash = imaputil.fetch2hash(result)
             if not ('UID' in attributehash and 'FLAGS' in attributehash):
                 # Compensate for servers that don't return a UID attribute.
                 continue
@@ -726,8 +869,8 @@ class IMAPFolder(BaseFolder):
         if not len(uidlist):
             return
 
-        self.addmessagesflags_noconvert(uidlist, set('T'))
-        imapobj = self.imapserver.acquireconnection()
+        self.addmessagesflags_noconvert(uidlist, Flags('T'))
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
         try:
             try:
                 imapobj.select(self.getfullname())
@@ -736,6 +879,7 @@ class IMAPFolder(BaseFolder):
                 return
             if self.expunge:
                 assert(imapobj.expunge()[0] == 'OK')
+                self._expungeduids.extend(uidlist)
         finally:
             self.imapserver.releaseconnection(imapobj)
         for uid in uidlist:
@@ -16,17 +16,43 @@
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
 from .Base import BaseFolder
+from offlineimap.flagutil import Flags
 import os
 import threading
 
-magicline = "OFFLINEIMAP LocalStatus CACHE DATA - DO NOT MODIFY - FORMAT 1"
+magicline = "OFFLINEIMAP LocalStatus CACHE DATA - DO NOT MODIFY - FORMAT 2"
+# Format 1 status files have the same content, but no journal
+magiclines = (magicline,
+              "OFFLINEIMAP LocalStatus CACHE DATA - DO NOT MODIFY - FORMAT 1")
 
 
 class LocalStatusFolder(BaseFolder):
+    """LocalStatus backend implemented with plain text files
+
+    The status of a folder is a snapshot file with one 'uid:flags' line
+    per message, and an append-only journal of the changes made since
+    the snapshot was written. A 'uid:flags' journal record adds a
+    message or sets its flags, a '-uid' record deletes it. Saving a
+    change thus only appends to the journal. The snapshot is rewritten
+    (and the journal emptied) when the journal grows larger than
+    'statuscompactratio' times the snapshot."""
+
     def __init__(self, name, repository):
         self.sep = '.' #needs to be set before super.__init__()
         super(LocalStatusFolder, self).__init__(name, repository)
         self.filename = os.path.join(self.getroot(), self.getfolderbasename())
+        self.journalname = os.path.join(repository.journalroot,
+                                        self.getfolderbasename())
+        self.journal = None
+        """Open journal file, if we appended to it already"""
+        self.journalsize = 0
+        """Number of records in the journal"""
+        self.snapshotsize = 0
+        """Number of messages in the snapshot"""
+        self.oldformat = False
+        """Is the snapshot in a format that needs an upgrade?"""
+        self.compactratio = repository.account.getconffloat(
+            'statuscompactratio', 1.0)
         self.messagelist = {}
         self.savelock = threading.Lock()
         self.doautosave = self.config.getdefaultboolean("general", "fsync",
@@ -52,56 +78,142 @@ class LocalStatusFolder(BaseFolder):
         return self.filename
 
     def deletemessagelist(self):
+        with self.savelock:
+            self.closejournal()
+            self.journalsize = 0
+            if os.path.exists(self.journalname):
+                os.unlink(self.journalname)
         if not self.isnewfolder():
             os.unlink(self.filename)
 
+    def readline(self, line, filename):
+        """Parse a 'uid:flags' line of a status or journal file"""
+        line = line.strip()
+        try:
+            uid, flags = line.split(':')
+            uid = long(uid)
+            flags = Flags(flags)
+        except ValueError as e:
+            errstr = "Corrupt line '%s' in cache file '%s'" % \
+                (line, filename)
+            self.ui.warn(errstr)
+            raise ValueError(errstr)
+        return uid, flags
+
     def cachemessagelist(self):
-        if self.isnewfolder():
-            self.messagelist = {}
-            return
-        file = open(self.filename, "rt")
         self.messagelist = {}
-        line = file.readline().strip()
-        if not line:
-            # The status file is empty - should not have happened,
-            # but somehow did.
-            errstr = "Cache file '%s' is empty. Closing..." % self.filename
-            self.ui.warn(errstr)
+        self.snapshotsize = 0
+        if not self.isnewfolder():
+            file = open(self.filename, "rt")
+            line = file.readline().strip()
+            if not line:
+                # The status file is empty - should not have happened,
+                # but somehow did.
+                errstr = "Cache file '%s' is empty. Closing..." % self.filename
+                self.ui.warn(errstr)
+                file.close()
+                return
+            assert(line in magiclines)
+            self.oldformat = line != magicline
+            for line in file.xreadlines():
+                uid, flags = self.readline(line, self.filename)
+                self.messagelist[uid] = {'uid': uid, 'flags': flags}
             file.close()
+            self.snapshotsize = len(self.messagelist)
+        self.replayjournal()
+
+    def replayjournal(self):
+        """Apply the changes journaled since the snapshot was written"""
+        self.journalsize = 0
+        if not os.path.exists(self.journalname):
             return
-        assert(line == magicline)
+        file = open(self.journalname, "rt")
+        complete = 0
         for line in file.xreadlines():
-            line = line.strip()
-            try:
-                uid, flags = line.split(':')
-                uid = long(uid)
-                flags = set(flags)
-            except ValueError as e:
-                errstr = "Corrupt line '%s' in cache file '%s'" % \
-                    (line, self.filename)
-                self.ui.warn(errstr)
-                raise ValueError(errstr)
-            self.messagelist[uid] = {'uid': uid, 'flags': flags}
+            if not line.endswith("\n"):
+                # Torn write of the last record, the change was not
+                # recorded as done. Cut it off, or the next record
+                # would be appended to it.
+                file.close()
+                file = open(self.journalname, "r+b")
+                file.truncate(complete)
+                break
+            complete += len(line)
+            if line.startswith('-'):
+                uid, flags = self.readline(line[1:].strip() + ':',
+                                           self.journalname)
+                self.messagelist.pop(uid, None)
+            else:
+                uid, flags = self.readline(line, self.journalname)
+                self.messagelist[uid] = {'uid': uid, 'flags': flags}
+            self.journalsize += 1
+        file.close()
+
+    def closejournal(self):
+        """Close the journal file, the caller must hold the savelock"""
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def appendjournal(self, records):
+        """Append records to the journal, the caller must hold the savelock
+
+        Every record is a complete line, a partially written last line
+        is ignored when replaying the journal."""
+        if self.journal is None:
+            self.journal = open(self.journalname, "at")
+        self.journal.write(''.join(records))
+        self.journal.flush()
+        if self.doautosave:
+            os.fsync(self.journal.fileno())
+        self.journalsize += len(records)
+
+    def compact(self):
+        """Write a new snapshot and empty the journal
+
+        The caller must hold the savelock."""
+        file = open(self.filename + ".tmp", "wt")
+        file.write(magicline + "\n")
+        for msg in self.messagelist.values():
+            file.write("%s:%s\n" % (msg['uid'], msg['flags']))
+        file.flush()
+        if self.doautosave:
+            os.fsync(file.fileno())
         file.close()
+        os.rename(self.filename + ".tmp", self.filename)
+        self.snapshotsize = len(self.messagelist)
+        self.oldformat = False
+
+        # The snapshot now contains everything journaled. If we die
+        # before the unlink, replaying the journal again is harmless.
+        self.closejournal()
+        self.journalsize = 0
+        if os.path.exists(self.journalname):
+            os.unlink(self.journalname)
+
+        if self.doautosave:
+            fd = os.open(os.path.dirname(self.filename), os.O_RDONLY)
+            os.fsync(fd)
+            os.close(fd)
 
     def save(self):
+        """Make sure the status is on disk, compacting it if needed
+
+        All changes are journaled as they are made, so this only
+        rewrites the snapshot when the journal has grown too large. The
+        journal file is closed, so that the folders of an account do not
+        keep a file open each between syncs."""
         with self.savelock:
-            file = open(self.filename + ".tmp", "wt")
-            file.write(magicline + "\n")
-            for msg in self.messagelist.values():
-                flags = msg['flags']
-                flags = ''.join(sorted(flags))
-                file.write("%s:%s\n" % (msg['uid'], flags))
-            file.flush()
-            if self.doautosave:
-                os.fsync(file.fileno())
-            file.close()
-            os.rename(self.filename + ".tmp", self.filename)
+            if self.isnewfolder() or self.oldformat or \
+                    self.journalsize > self.compactratio * self.snapshotsize:
+                self.compact()
+            else:
+                self.closejournal()
 
-            if self.doautosave:
-                fd = os.open(os.path.dirname(self.filename), os.O_RDONLY)
-                os.fsync(fd)
-                os.close(fd)
+    def checkpoint(self):
+        """Called periodically while copying messages, so that the
+        journal of a large initial sync gets compacted on the way."""
+        self.save()
 
     def getmessagelist(self):
         return self.messagelist
@@ -120,8 +232,10 @@ class LocalStatusFolder(BaseFolder):
             self.savemessageflags(uid, flags)
             return uid
 
-        self.messagelist[uid] = {'uid': uid, 'flags': flags, 'time': rtime}
-        self.save()
+        flags = Flags(flags)
+        with self.savelock:
+            self.messagelist[uid] = {'uid': uid, 'flags': flags, 'time': rtime}
+            self.appendjournal(["%s:%s\n" % (uid, flags)])
         return uid
 
     def getmessageflags(self, uid):
@@ -131,8 +245,10 @@ class LocalStatusFolder(BaseFolder):
         return self.messagelist[uid]['time']
 
     def savemessageflags(self, uid, flags):
-        self.messagelist[uid]['flags'] = flags
-        self.save()
+        flags = Flags(flags)
+        with self.savelock:
+            self.messagelist[uid]['flags'] = flags
+            self.appendjournal(["%s:%s\n" % (uid, flags)])
 
     def deletemessage(self, uid):
         self.deletemessages([uid])
@@ -143,6 +259,7 @@ class LocalStatusFolder(BaseFolder):
         if not len(uidlist):
             return
 
-        for uid in uidlist:
-            del(self.messagelist[uid])
-        self.save()
+        with self.savelock:
+            for uid in uidlist:
+                del(self.messagelist[uid])
+            self.appendjournal(["-%s\n" % uid for uid in uidlist])
@@ -16,39 +16,49 @@
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 import os.path
 import re
-from threading import Lock
+import time
+from threading import Lock, Thread, Event, local
+try:
+    from Queue import Queue, Empty
+except ImportError: # python3
+    from queue import Queue, Empty
 from .LocalStatus import LocalStatusFolder
+from offlineimap.ui import getglobalui
+from offlineimap.flagutil import Flags
 try:
     import sqlite3 as sqlite
 except:
     pass #fail only if needed later on, not on import
 
 
-class LocalStatusSQLiteFolder(LocalStatusFolder):
-    """LocalStatus backend implemented with an SQLite database
+class LocalStatusSQLiteDB(object):
+    """The status database shared by all folders of an account
 
-    As python-sqlite currently does not allow to access the same sqlite
-    objects from various threads, we need to open get and close a db
-    connection and cursor for all operations. This is a big disadvantage
-    and we might want to investigate if we cannot hold an object open
-    for a thread somehow."""
-    #though. According to sqlite docs, you need to commit() before
-    #the connection is closed or your changes will be lost!"""
-    #get db connection which autocommits
-    #connection = sqlite.connect(self.filename, isolation_level=None)        
-    #cursor = connection.cursor()
-    #return connection, cursor
+    The database is in WAL mode, so that readers and the writer do not
+    block each other. All writes go through a single writer thread,
+    which batches them into transactions. A transaction is committed
+    when `batchsize` statements are pending, `flushinterval` seconds
+    after its first statement or when flush() is called, rather than
+    once per statement. Every other thread reads through its own
+    connection, so reads only see committed writes. Use flush() first
+    if a read needs to see the writes queued before."""
 
     #current version of our db format
-    cur_version = 1
+    cur_version = 2
 
-    def __init__(self, name, repository):
-        super(LocalStatusSQLiteFolder, self).__init__(name, repository)       
-        # dblock protects against concurrent writes in same connection
-        self._dblock = Lock()
-        #Try to establish connection, no need for threadsafety in __init__
+    batchsize = 1000
+    flushinterval = 1.0
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.ui = getglobalui()
+        self.queue = Queue()
+        self.errors = {}
+        """folder: exception of a failed write of the folder, raised by
+        the next flush() for it"""
+        self.readers = local()
         try:
-            self.connection = sqlite.connect(self.filename, check_same_thread = False)
+            connection = sqlite.connect(self.filename)
         except NameError:
             # sqlite import had failed
             raise UserWarning('SQLite backend chosen, but no sqlite python '
@@ -57,127 +67,254 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
         #Make sure sqlite is in multithreading SERIALIZE mode
         assert sqlite.threadsafety == 1, 'Your sqlite is not multithreading safe.'
 
+        connection.execute('PRAGMA journal_mode=WAL')
         #Test if db version is current enough and if db is readable.
         try:
-            cursor = self.connection.execute("SELECT value from metadata WHERE key='db_version'")
+            cursor = connection.execute("SELECT value from metadata WHERE key='db_version'")
         except sqlite.DatabaseError:
             #db file missing or corrupt, recreate it.
-            self.upgrade_db(0)
+            self.create_db(connection)
         else:
-            # fetch db version and upgrade if needed
+            # fetch db version, future upgrades go here
             version = int(cursor.fetchone()[0])
-            if version < LocalStatusSQLiteFolder.cur_version:
-                self.upgrade_db(version)
+            assert version == LocalStatusSQLiteDB.cur_version, \
+                "Unknown LocalStatus db version %d" % version
+        connection.close()
+
+        self.writer = Thread(target=self._writer,
+                             name='LocalStatus writer')
+        self.writer.setDaemon(True)
+        self.writer.start()
+
+    def create_db(self, connection):
+        """Create the tables in a new db file"""
+        self.ui._msg('Creating new Local Status db %s' % self.filename)
+        connection.executescript("""
+        CREATE TABLE metadata (key VARCHAR(50) PRIMARY KEY, value VARCHAR(128));
+        INSERT INTO metadata VALUES('db_version', '2');
+        CREATE TABLE status (folder VARCHAR(256), id INTEGER,
+                             flags VARCHAR(50), PRIMARY KEY (folder, id));
+        """)
+        connection.commit()
+
+    def getreader(self):
+        """Return the reading connection of the current thread"""
+        connection = getattr(self.readers, 'connection', None)
+        if connection is None:
+            # readers do not need implicit transactions, which would
+            # keep them on an old snapshot of the db
+            connection = sqlite.connect(self.filename, isolation_level=None)
+            self.readers.connection = connection
+        return connection
 
-    def sql_write(self, sql, vars=None, executemany=False):
-        """Execute some SQL, retrying if the db was locked.
+    def execute(self, sql, vars=()):
+        """Execute a reading SQL statement, returns the Cursor()"""
+        return self.getreader().execute(sql, vars)
+
+    def querywith(self, rows, sql, vars=()):
+        """Execute a query against a temporary table of messages
+
+        The temporary table 'msgs' (seq, id, flags) is filled with the
+        (uid, flags) pairs from the iterable `rows`, numbered in order
+        by 'seq'. This lets the db compute set operations between the
+        status and the messages of a folder, without loading either
+        into memory. Returns the list of result rows."""
+        connection = self.getreader()
+        connection.execute('BEGIN')
+        try:
+            connection.execute('CREATE TEMP TABLE IF NOT EXISTS msgs '
+                '(seq INTEGER PRIMARY KEY, id INTEGER, flags VARCHAR(50))')
+            connection.execute('CREATE INDEX IF NOT EXISTS temp.msgs_id '
+                               'ON msgs (id)')
+            connection.execute('DELETE FROM temp.msgs')
+            connection.executemany('INSERT INTO temp.msgs (id,flags) '
+                                   'VALUES (?,?)', rows)
+            return connection.execute(sql, vars).fetchall()
+        finally:
+            connection.execute('COMMIT')
+
+    def write(self, sql, vars=(), executemany=False, folder=None):
+        """Queue a writing SQL statement for the writer thread
 
         :param sql: the SQL string passed to execute()
         :param vars: the variable values to `sql`. E.g. (1,2) or {uid:1,
             flags:'T'}. See sqlite docs for possibilities.
         :param executemany: bool indicating whether we want to
             perform conn.executemany() or conn.execute().
-        :returns: the Cursor() or raises an Exception"""
-        success = False
-        while not success:
-            self._dblock.acquire()
+        :param folder: the folder the statement writes to, which is
+            told about a failure by flush()"""
+        self.queue.put((sql, vars, executemany, folder, None))
+
+    def flush(self, folder=None):
+        """Commit all queued writes and wait for it
+
+        Raises the error of a write of `folder` that failed since the
+        last flush for it. If the commit of a transaction fails, all
+        folders that wrote in it get the error."""
+        done = Event()
+        self.queue.put((None, None, None, None, done))
+        done.wait()
+        error = self.errors.pop(folder, None)
+        if error:
+            raise error
+
+    def _writer(self):
+        connection = sqlite.connect(self.filename)
+        connection.execute('PRAGMA synchronous=NORMAL')
+        pending = 0
+        deadline = None
+        folders = set()
+        """folders with writes in the current transaction"""
+        while True:
             try:
-                if vars is None:
-                    if executemany:
-                        cursor = self.connection.executemany(sql)
-                    else:
-                        cursor = self.connection.execute(sql)
+                if pending:
+                    item = self.queue.get(
+                        timeout=max(0, deadline - time.time()))
                 else:
+                    item = self.queue.get()
+            except Empty:
+                item = (None, None, None, None, None)
+            sql, vars, executemany, folder, done = item
+            if sql is not None:
+                try:
                     if executemany:
-                        cursor = self.connection.executemany(sql, vars)
+                        connection.executemany(sql, vars)
                     else:
-                        cursor = self.connection.execute(sql, vars)
-                success = True
-                self.connection.commit()
-            except sqlite.OperationalError as e:
-                if e.args[0] == 'cannot commit - no transaction is active':
-                    pass
-                elif e.args[0] == 'database is locked':
-                    self.ui.debug('', "Locked sqlite database, retrying.")
-                    success = False
+                        connection.execute(sql, vars)
+                except sqlite.Error as e:
+                    self.errors.setdefault(folder, e)
                 else:
-                    raise
-            finally:
-                self._dblock.release()
-        return cursor
-
-    def upgrade_db(self, from_ver):
-        """Upgrade the sqlite format from version 'from_ver' to current"""
-
-        if hasattr(self, 'connection'):
-            self.connection.close() #close old connections first
-        self.connection = sqlite.connect(self.filename,
-                                         check_same_thread = False)
-
-        if from_ver == 0:
-            # from_ver==0: no db existent: plain text migration?
-            self.create_db()
-            # below was derived from repository.getfolderfilename() logic
-            plaintextfilename = os.path.join(
-                self.repository.account.getaccountmeta(),
-                'LocalStatus',
-                self.getfolderbasename())
-            # MIGRATE from plaintext if needed
-            if os.path.exists(plaintextfilename):
-                self.ui._msg('Migrating LocalStatus cache from plain text '
-                             'to sqlite database for %s:%s' %\
-                                 (self.repository, self))
-                file = open(plaintextfilename, "rt")
-                line = file.readline().strip()
-                data = []
-                for line in file.xreadlines():
-                    uid, flags = line.strip().split(':')
-                    uid = long(uid)
-                    flags = ''.join(sorted(flags))
-                    data.append((uid,flags))
-                self.connection.executemany('INSERT INTO status (id,flags) VALUES (?,?)',
-                                       data)
-                self.connection.commit()
-                file.close()
-                os.rename(plaintextfilename, plaintextfilename + ".old")
-        # Future version upgrades come here...
-        # if from_ver <= 1: ... #upgrade from 1 to 2
-        # if from_ver <= 2: ... #upgrade from 2 to 3
-
-    def create_db(self):
-        """Create a new db file"""
-        self.ui._msg('Creating new Local Status db for %s:%s' \
-                         % (self.repository, self))
-        if hasattr(self, 'connection'):
-            self.connection.close() #close old connections first
-        self.connection = sqlite.connect(self.filename, check_same_thread = False)
-        self.connection.executescript("""
-        CREATE TABLE metadata (key VARCHAR(50) PRIMARY KEY, value VARCHAR(128));
-        INSERT INTO metadata VALUES('db_version', '1');
-        CREATE TABLE status (id INTEGER PRIMARY KEY, flags VARCHAR(50));
-        """)
-        self.connection.commit()
+                    if not pending:
+                        deadline = time.time() + self.flushinterval
+                    pending += 1
+                    folders.add(folder)
+                if pending and pending < self.batchsize and \
+                        time.time() < deadline:
+                    continue
+            if pending:
+                try:
+                    connection.commit()
+                except sqlite.Error as e:
+                    connection.rollback()
+                    for folder in folders:
+                        self.errors.setdefault(folder, e)
+                pending = 0
+                folders.clear()
+            if done:
+                done.set()
+
+
+class LocalStatusSQLiteFolder(LocalStatusFolder):
+    """LocalStatus backend implemented with an SQLite database
+
+    The status of all folders of an account is stored in a single
+    LocalStatusSQLiteDB, with a 'folder' column holding the name that
+    the plain text status file of the folder would have. Status changes
+    are written in batches, save() commits them."""
+
+    def __init__(self, name, repository):
+        super(LocalStatusSQLiteFolder, self).__init__(name, repository)
+        self.db = repository.getstatusdb()
+        self.dbfolder = self.getfolderbasename()
+        # self.filename is where older versions kept a db for the folder
+        olddbfilename, self.filename = self.filename, self.db.filename
+        if os.path.exists(olddbfilename):
+            self.migrate_db(olddbfilename)
+        else:
+            self.migrate_plaintext()
+
+    def migrate_db(self, olddbfilename):
+        """Move the status of a db file per folder into the shared db"""
+        self.ui._msg('Migrating LocalStatus cache of %s:%s into %s' %\
+                         (self.repository, self, self.db.filename))
+        connection = sqlite.connect(olddbfilename)
+        try:
+            data = [(self.dbfolder, uid, flags) for uid, flags in
+                    connection.execute('SELECT id,flags FROM status')]
+        except sqlite.DatabaseError:
+            data = [] # the db was never written to
+        connection.close()
+        self.write('INSERT OR REPLACE INTO status (folder,id,flags) '
+                      'VALUES (?,?,?)', data, True)
+        self.flush()
+        os.rename(olddbfilename, olddbfilename + ".old")
+
+    def migrate_plaintext(self):
+        """Move the plain text status of the folder into the db"""
+        # below was derived from repository.getfolderfilename() logic
+        plaintextfilename = os.path.join(
+            self.repository.account.getaccountmeta(),
+            'LocalStatus',
+            self.getfolderbasename())
+        if not os.path.exists(plaintextfilename) or \
+                self.db.execute('SELECT 1 FROM status WHERE folder=? LIMIT 1',
+                                (self.dbfolder,)).fetchone():
+            return
+        self.ui._msg('Migrating LocalStatus cache from plain text '
+                     'to sqlite database for %s:%s' %\
+                         (self.repository, self))
+        messagelist = {}
+        file = open(plaintextfilename, "rt")
+        line = file.readline().strip()
+        for line in file.xreadlines():
+            uid, flags = self.readline(line, plaintextfilename)
+            messagelist[uid] = flags
+        file.close()
+        journalname = os.path.join(
+            self.repository.account.getaccountmeta(),
+            'LocalStatus-journal',
+            self.getfolderbasename())
+        if os.path.exists(journalname):
+            file = open(journalname, "rt")
+            for line in file.xreadlines():
+                if not line.endswith("\n"):
+                    break
+                if line.startswith('-'):
+                    uid, flags = self.readline(line[1:].strip() + ':',
+                                               journalname)
+                    messagelist.pop(uid, None)
+                else:
+                    uid, flags = self.readline(line, journalname)
+                    messagelist[uid] = flags
+            file.close()
+            os.rename(journalname, journalname + ".old")
+        self.write('INSERT INTO status (folder,id,flags) VALUES (?,?,?)',
+                      [(self.dbfolder, uid, str(flags))
+                       for uid, flags in messagelist.items()], True)
+        self.flush()
+        os.rename(plaintextfilename, plaintextfilename + ".old")
+
+    def write(self, sql, vars=(), executemany=False):
+        """Queue a writing SQL statement of this folder"""
+        self.db.write(sql, vars, executemany, self.dbfolder)
+
+    def flush(self):
+        """Commit the queued writes, raising the error of a failed
+        write of this folder"""
+        self.db.flush(self.dbfolder)
 
     def isnewfolder(self):
-        # testing the existence of the db file won't work. It is created
-        # as soon as this class instance was intitiated. So say it is a
-        # new folder when there are no messages at all recorded in it.
+        # testing the existence of the db file won't work. It is shared
+        # by all folders. So say it is a new folder when there are no
+        # messages at all recorded in it.
         return self.getmessagecount() > 0
 
     def deletemessagelist(self):
         """delete all messages in the db"""
-        self.sql_write('DELETE FROM status')
+        self.write('DELETE FROM status WHERE folder=?', (self.dbfolder,))
 
     def cachemessagelist(self):
         self.messagelist = {}
-        cursor = self.connection.execute('SELECT id,flags from status')
+        self.flush()
+        cursor = self.db.execute('SELECT id,flags from status WHERE folder=?',
+                                 (self.dbfolder,))
         for row in cursor:
-                flags = set(row[1])
+                flags = Flags(row[1])
                 self.messagelist[row[0]] = {'uid': row[0], 'flags': flags}
 
     def save(self):
-        #Noop in this backend
-        pass
+        """Commit the status changes queued so far"""
+        self.flush()
 
     # Following some pure SQLite functions, where we chose to use
     # BaseFolder() methods instead. Doing those on the in-memory list is
@@ -229,21 +366,23 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
             self.savemessageflags(uid, flags)
             return uid
 
+        flags = Flags(flags)
         self.messagelist[uid] = {'uid': uid, 'flags': flags, 'time': rtime}
-        flags = ''.join(sorted(flags))
-        self.sql_write('INSERT INTO status (id,flags) VALUES (?,?)',
-                         (uid,flags))
+        self.write('INSERT INTO status (folder,id,flags) VALUES (?,?,?)',
+                      (self.dbfolder, uid, str(flags)))
         return uid
 
     def savemessageflags(self, uid, flags):
+        flags = Flags(flags)
         self.messagelist[uid] = {'uid': uid, 'flags': flags}
-        flags = ''.join(sorted(flags))
-        self.sql_write('UPDATE status SET flags=? WHERE id=?',(flags,uid))
+        self.write('UPDATE status SET flags=? WHERE folder=? AND id=?',
+                      (str(flags), self.dbfolder, uid))
 
     def deletemessage(self, uid):
         if not uid in self.messagelist:
             return
-        self.sql_write('DELETE FROM status WHERE id=?', (uid, ))
+        self.write('DELETE FROM status WHERE folder=? AND id=?',
+                      (self.dbfolder, uid))
         del(self.messagelist[uid])
 
     def deletemessages(self, uidlist):
@@ -256,7 +395,141 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
         uidlist = [uid for uid in uidlist if uid in self.messagelist]
         if not len(uidlist):
             return
-        # arg2 needs to be an iterable of 1-tuples [(1,),(2,),...]
-        self.sql_write('DELETE FROM status WHERE id=?', zip(uidlist, ), True)
+        # arg2 needs to be an iterable of 2-tuples [(folder,1),...]
+        self.write('DELETE FROM status WHERE folder=? AND id=?',
+                      [(self.dbfolder, uid) for uid in uidlist], True)
         for uid in uidlist:
             del(self.messagelist[uid])
+
+
+class LocalStatusSQLiteQueryFolder(LocalStatusSQLiteFolder):
+    """SQLite status backend that does not hold the status in memory
+
+    Rather than loading all messages in cachemessagelist(), every
+    lookup is answered by an indexed query, and the set operations of
+    the sync passes by joins with a temporary table of the UIDs of the
+    folder being synced. This keeps memory use flat for folders with
+    millions of messages, at the price of some speed."""
+
+    def __init__(self, name, repository):
+        super(LocalStatusSQLiteQueryFolder, self).__init__(name, repository)
+        self.dirty = False
+        """Did we queue writes that queries need to see?"""
+
+    def execute(self, sql, vars=()):
+        """Execute a query, seeing all writes queued before"""
+        if self.dirty:
+            self.flush()
+            self.dirty = False
+        return self.db.execute(sql, vars)
+
+    def querywith(self, rows, sql):
+        """Execute a query against the temporary table 'msgs', the only
+        variable of `sql` is the name of this folder"""
+        if self.dirty:
+            self.flush()
+            self.dirty = False
+        return self.db.querywith(rows, sql, (self.dbfolder,))
+
+    def write(self, sql, vars=(), executemany=False):
+        super(LocalStatusSQLiteQueryFolder, self).write(sql, vars,
+                                                        executemany)
+        self.dirty = True
+
+    def cachemessagelist(self):
+        self.messagelist = {}
+        self.flush()
+        self.dirty = False
+
+    def getmessagelist(self):
+        """Load and return the complete message list
+
+        Defeats the purpose of this backend, so nothing uses it during
+        a sync."""
+        cursor = self.execute('SELECT id,flags from status WHERE folder=?',
+                              (self.dbfolder,))
+        return dict((row[0], {'uid': row[0], 'flags': Flags(row[1])})
+                    for row in cursor)
+
+    def uidexists(self, uid):
+        cursor = self.execute('SELECT 1 FROM status WHERE folder=? AND id=?',
+                              (self.dbfolder, uid))
+        return cursor.fetchone() is not None
+
+    def getmessageuidlist(self):
+        cursor = self.execute('SELECT id FROM status WHERE folder=?',
+                              (self.dbfolder,))
+        return [row[0] for row in cursor]
+
+    def getmessagecount(self):
+        cursor = self.execute('SELECT COUNT(*) FROM status WHERE folder=?',
+                              (self.dbfolder,))
+        return cursor.fetchone()[0]
+
+    def getmessageflags(self, uid):
+        cursor = self.execute('SELECT flags FROM status '
+                              'WHERE folder=? AND id=?', (self.dbfolder, uid))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return Flags(row[0])
+
+    def getmissinguids(self, uidlist):
+        rows = self.querywith(((uid, None) for uid in uidlist),
+            'SELECT id FROM temp.msgs WHERE NOT EXISTS (SELECT 1 FROM '
+            'status WHERE folder=? AND status.id=msgs.id) ORDER BY seq')
+        return [row[0] for row in rows]
+
+    def getotheruids(self, uidlist):
+        rows = self.querywith(((uid, None) for uid in uidlist),
+            'SELECT id FROM status WHERE folder=? AND NOT EXISTS '
+            '(SELECT 1 FROM temp.msgs WHERE msgs.id=status.id)')
+        return [row[0] for row in rows]
+
+    def getchangedflags(self, uidflags):
+        rows = self.querywith(
+            ((uid, str(Flags(flags))) for uid, flags in uidflags),
+            'SELECT msgs.id, status.flags FROM temp.msgs LEFT JOIN status '
+            'ON status.folder=? AND status.id=msgs.id '
+            'WHERE status.flags IS NULL OR status.flags != msgs.flags')
+        return [(uid, Flags(flags or '')) for uid, flags in rows]
+
+    def savemessage(self, uid, content, flags, rtime):
+        """Writes a new message, with the specified uid.
+
+        See folder/Base for detail. Note that savemessage() does not
+        check against dryrun settings, so you need to ensure that
+        savemessage is never called in a dryrun mode."""
+        if uid < 0:
+            # We cannot assign a uid.
+            return uid
+        self.write('INSERT OR REPLACE INTO status (folder,id,flags) '
+                   'VALUES (?,?,?)', (self.dbfolder, uid, str(Flags(flags))))
+        return uid
+
+    def savemessageflags(self, uid, flags):
+        self.write('UPDATE status SET flags=? WHERE folder=? AND id=?',
+                   (str(Flags(flags)), self.dbfolder, uid))
+
+    def changemessagesflags(self, uidlist, change):
+        """Apply change(flags) to the flags of the messages in uidlist"""
+        rows = self.querywith(((uid, None) for uid in uidlist),
+            'SELECT status.id, status.flags FROM temp.msgs JOIN status '
+            'ON status.folder=? AND status.id=msgs.id')
+        self.write('UPDATE status SET flags=? WHERE folder=? AND id=?',
+                   [(str(change(Flags(flags))), self.dbfolder, uid)
+                    for uid, flags in rows], True)
+
+    def addmessagesflags(self, uidlist, flags):
+        self.changemessagesflags(uidlist, lambda old: old | flags)
+
+    def deletemessagesflags(self, uidlist, flags):
+        self.changemessagesflags(uidlist, lambda old: old - flags)
+
+    def deletemessage(self, uid):
+        self.write('DELETE FROM status WHERE folder=? AND id=?',
+                   (self.dbfolder, uid))
+
+    def deletemessages(self, uidlist):
+        self.write('DELETE FROM status WHERE folder=? AND id=?',
+                   [(self.dbfolder, uid) for uid in uidlist], True)
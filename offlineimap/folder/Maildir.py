@@ -17,10 +17,14 @@
 
 import socket
 import time
+import errno
 import re
 import os
+import string
+from itertools import islice
 from .Base import BaseFolder
 from threading import Lock
+from sys import exc_info
 
 try:
     from hashlib import md5
@@ -33,16 +37,43 @@ except NameError:
     from sets import Set as set
 
 from offlineimap import OfflineImapError
+from offlineimap.flagutil import Flags
+
+try:
+    import ctypes
+    import ctypes.util
+    _sync_file_range = ctypes.CDLL(ctypes.util.find_library('c') or
+                                   'libc.so.6', use_errno=True).sync_file_range
+    _sync_file_range.argtypes = [ctypes.c_int, ctypes.c_int64,
+                                 ctypes.c_int64, ctypes.c_uint]
+except (ImportError, OSError, AttributeError):
+    _sync_file_range = None # not Linux, batches are synced file by file
+SYNC_FILE_RANGE_WRITE = 2
 
 # Find the UID in a message filename
 re_uidmatch = re.compile(',U=(\d+)')
 # Find a numeric timestamp in a string (filename prefix)
 re_timestampmatch = re.compile('(\d+)');
 
+scancachemagic = "OFFLINEIMAP Maildir SCAN CACHE - DO NOT MODIFY - FORMAT 1"
+
 timeseq = 0
 lasttime = 0
 timelock = Lock()
 
+_infoflags = {}
+
+def infoflags(info):
+    """Return the Flags of the flags part of a Maildir info suffix"""
+    flags = _infoflags.get(info)
+    if flags is None:
+        # Filter out all lowercase (custom maildir) flags. We don't
+        # handle them yet.
+        flags = Flags(info.translate(None, string.ascii_lowercase))
+        if len(_infoflags) < 1000:
+            _infoflags[info] = flags
+    return flags
+
 def gettimeseq():
     global lasttime, timeseq, timelock
     timelock.acquire()
@@ -76,8 +107,27 @@ class MaildirFolder(BaseFolder):
         self.re_prefixmatch = re.compile('([^'+ self.infosep + ',]*)')
         #folder's md, so we can match with recorded file md5 for validity
         self._foldermd5 = md5(self.getvisiblename()).hexdigest()
+        # The usual file name of a message, see _parse_filename(). Others
+        # are parsed with the patterns above. The pattern is the same for
+        # all folders, so that re caches it when there are many folders.
+        self.re_filename = re.compile(
+            r'([^%(sep)s,]*)(?:,U=(\d+))?(?:,FMD5=([0-9a-f]{32}))?'
+            r'(?:%(sep)s2,(\w*))?$' % {'sep': re.escape(self.infosep)})
         # Cache the full folder path, as we use getfullname() very often
         self._fullname = os.path.join(self.getroot(), self.getname())
+        self._watcher = repository.getwatcher()
+        # messages are moved out of tmp/ in batches of writebatch
+        self.writebatch = repository.getconfint('writebatch', 1)
+        self._batch = []
+        """UIDs of the messages in tmp/ waiting for flushmessages()"""
+        self._batchcallbacks = {}
+        """uid: list of afterflush() calls, for batched messages"""
+        self._batchlock = Lock()
+        self._flushlock = Lock()
+        self._scancachefile = None
+        if repository.getscancachedir():
+            self._scancachefile = os.path.join(repository.getscancachedir(),
+                                               self.getfolderbasename())
 
     def getfullname(self):
         """Return the absolute file path to the Maildir folder (sans cur|new)"""
@@ -90,26 +140,24 @@ class MaildirFolder(BaseFolder):
         token."""
         return 42
 
-    #Checks to see if the given message is within the maximum age according
-    #to the maildir name which should begin with a timestamp
-    def _iswithinmaxage(self, messagename, maxage):
-        #In order to have the same behaviour as SINCE in an IMAP search
-        #we must convert this to the oldest time and then strip off hrs/mins
-        #from that day
+    def _maxagecutoff(self, maxage):
+        """Return the oldest timestamp of messages within maxage days
+
+        In order to have the same behaviour as SINCE in an IMAP search
+        this is the start of the day (UTC) maxage days ago."""
         oldest_time_utc = time.time() - (60*60*24*maxage)
         oldest_time_struct = time.gmtime(oldest_time_utc)
         oldest_time_today_seconds = ((oldest_time_struct[3] * 3600) \
             + (oldest_time_struct[4] * 60) \
             + oldest_time_struct[5])
-        oldest_time_utc -= oldest_time_today_seconds
+        return oldest_time_utc - oldest_time_today_seconds
 
+    #Checks to see if the given message is within the maximum age according
+    #to the maildir name which should begin with a timestamp
+    def _iswithinmaxage(self, messagename, cutoff):
+        """:param cutoff: as returned by :meth:`_maxagecutoff`"""
         timestampmatch = re_timestampmatch.search(messagename)
-        timestampstr = timestampmatch.group()
-        timestamplong = long(timestampstr)
-        if(timestamplong < oldest_time_utc):
-            return False
-        else:
-            return True
+        return long(timestampmatch.group()) >= cutoff
 
     def _parse_filename(self, filename):
         """Returns a messages file name components
@@ -125,8 +173,18 @@ class MaildirFolder(BaseFolder):
         detected, we return an empty flags list.
 
         :returns: (prefix, UID, FMD5, flags). UID is a numeric "long"
-            type. flags is a set() of Maildir flags"""
-        prefix, uid, fmd5, flags = None, None, None, set()
+            type. flags are the Flags of the Maildir info suffix"""
+        # Names as we write them are parsed in one go.
+        match = self.re_filename.match(filename)
+        if match:
+            prefix, uid, fmd5, info = match.groups()
+            if uid is not None and fmd5 == self._foldermd5:
+                uid = long(uid)
+            else:
+                uid = None
+            return prefix, uid, None, infoflags(info or '')
+
+        prefix, uid, fmd5, flags = None, None, None, Flags()
         prefixmatch = self.re_prefixmatch.match(filename)
         if prefixmatch:
             prefix = prefixmatch.group(1)
@@ -140,53 +198,169 @@ class MaildirFolder(BaseFolder):
                 uid = long(uidmatch.group(1))
         flagmatch = self.re_flagmatch.search(filename)
         if flagmatch:
-            # Filter out all lowercase (custom maildir) flags. We don't
-            # handle them yet.
-            flags = set((c for c in flagmatch.group(1) if not c.islower()))
+            flags = infoflags(flagmatch.group(1))
         return prefix, uid, fmd5, flags
 
+    def _loadscancache(self):
+        """Read the scan cache of the folder
+
+        :returns: a dict of dirannex: (mtime, entries) where entries is
+            a dict of filename: (uid, flags, size) as returned by
+            :meth:`_scandir`. It is empty if there is no usable cache."""
+        if not self._scancachefile or not os.path.exists(self._scancachefile):
+            return {}
+        dirs = {}
+        file = open(self._scancachefile, "rt")
+        try:
+            if file.readline().strip() != scancachemagic or \
+                    file.readline().strip() != '%s %s' % (self._foldermd5,
+                                                          self.infosep):
+                return {}
+            for header in file:
+                dirannex, mtime, count = header.split()
+                entries = {}
+                for line in islice(file, int(count)):
+                    uid, flags, size, filename = line[:-1].split('\t', 3)
+                    entries[filename] = (long(uid) if uid else None,
+                                         Flags(flags),
+                                         long(size) if size else None)
+                mtime = float(mtime)
+                dirs[dirannex] = (mtime if mtime >= 0 else None, entries)
+        except ValueError:
+            self.ui.warn("Ignoring corrupt Maildir scan cache '%s'" %
+                         self._scancachefile)
+            return {}
+        finally:
+            file.close()
+        return dirs
+
+    def _savescancache(self, dirs):
+        """Write the scan cache of the folder, see :meth:`_loadscancache`"""
+        file = open(self._scancachefile + ".tmp", "wt")
+        file.write(scancachemagic + "\n")
+        file.write("%s %s\n" % (self._foldermd5, self.infosep))
+        for dirannex, (mtime, entries) in dirs.items():
+            # file names with newlines are parsed every time
+            entries = [(filename, entry) for filename, entry
+                       in entries.iteritems() if not '\n' in filename]
+            file.write("%s %r %d\n" % (dirannex,
+                       mtime if mtime is not None else -1.0, len(entries)))
+            for filename, (uid, flags, size) in entries:
+                file.write("%s\t%s\t%s\t%s\n" % (
+                        '' if uid is None else uid, flags,
+                        '' if size is None else size, filename))
+        file.close()
+        os.rename(self._scancachefile + ".tmp", self._scancachefile)
+
+    def _scanentry(self, fulldirname, filename, entry, maxsize):
+        """Return the (uid, flags, size) scan entry of a file name,
+        reusing `entry` from the cache unless it is None"""
+        if entry is None:
+            prefix, uid, fmd5, flags = self._parse_filename(filename)
+            entry = (uid, flags, None)
+        if maxsize and entry[2] is None:
+            entry = (entry[0], entry[1], os.path.getsize(
+                    os.path.join(fulldirname, filename)))
+        return entry
+
+    def _scandir(self, dirannex, cached, maxsize):
+        """List and parse the file names in one of new/ and cur/
+
+        :param cached: (mtime, entries) of the scan cache or None. If the
+            directory mtime did not change, the entries are used as they
+            are, otherwise only file names that are not in them are parsed.
+            If the repository watches its folders, only the file names
+            that changed since the last scan are looked at.
+        :returns: (mtime, entries), entries being a dict of filename:
+            (uid, flags, size). uid is None for messages that have no
+            UID in this folder, size is only set if maxsize is.
+            mtime is None if it must not be trusted next time."""
+        fulldirname = os.path.join(self.getfullname(), dirannex)
+        if cached and maxsize and \
+                None in [entry[2] for entry in cached[1].itervalues()]:
+            cached = None
+        changes = None
+        if self._watcher:
+            self._watcher.watch(fulldirname)
+            changes = self._watcher.takechanges(fulldirname)
+        if cached and changes is not None:
+            if not changes:
+                return cached
+            entries = dict(cached[1])
+            for filename in changes:
+                if os.path.exists(os.path.join(fulldirname, filename)):
+                    entries[filename] = self._scanentry(fulldirname,
+                        filename, None, maxsize)
+                else:
+                    entries.pop(filename, None)
+            # events may still be on their way, so the mtime is not safe
+            return None, entries
+
+        scantime = time.time()
+        mtime = os.stat(fulldirname).st_mtime
+        if cached and cached[0] == mtime:
+            return cached
+        oldentries = cached[1] if cached else {}
+        entries = {}
+        for filename in os.listdir(fulldirname):
+            entries[filename] = self._scanentry(fulldirname, filename,
+                oldentries.get(filename), maxsize)
+            if '\n' in filename:
+                mtime = None
+        # A change in the same tick of the file system clock as the one
+        # we read would go unnoticed next time.
+        if mtime is not None and mtime > scantime - 2:
+            mtime = None
+        return mtime, entries
+
     def _scanfolder(self):
         """Cache the message list from a Maildir.
 
         Maildir flags are: R (replied) S (seen) T (trashed) D (draft) F
         (flagged).
+
+        Unless disabled with the repository option 'scancache', the
+        parsed file names are cached along with the mtimes of new/ and
+        cur/, so that only directories that changed are listed again.
+        With the repository option 'watch', the changes are taken from
+        inotify instead. new/ and cur/ are scanned in parallel.
         :returns: dict that can be used as self.messagelist"""
         maxage = self.config.getdefaultint("Account " + self.accountname,
                                            "maxage", None)
         maxsize = self.config.getdefaultint("Account " + self.accountname,
                                             "maxsize", None)
+        if maxage:
+            maxagecutoff = self._maxagecutoff(maxage)
         retval = {}
-        files = []
         nouidcounter = -1          # Messages without UIDs get negative UIDs.
+        if self.getname() in self.repository.lastscans:
+            cache = self.repository.lastscans[self.getname()]
+        else:
+            cache = self._loadscancache()
+        # new/ and cur/ are listed at the same time on the scan pool
+        dirs = dict(zip(['new', 'cur'], self.repository.scanmap(
+                    self._scandir, [(dirannex, cache.get(dirannex), maxsize)
+                                    for dirannex in ['new', 'cur']])))
+
         for dirannex in ['new', 'cur']:
-            fulldirname = os.path.join(self.getfullname(), dirannex)
-            files.extend((dirannex, filename) for
-                         filename in os.listdir(fulldirname))
-
-        for dirannex, filename in files:
-            # We store just dirannex and filename, ie 'cur/123...'
-            filepath = os.path.join(dirannex, filename)
-            # check maxage/maxsize if this message should be considered
-            if maxage and not self._iswithinmaxage(filename, maxage):
-                continue
-            if maxsize and (os.path.getsize(os.path.join(
-                        self.getfullname(), filepath)) > maxsize):
-                continue
-
-            (prefix, uid, fmd5, flags) = self._parse_filename(filename)
-            if uid is None: # assign negative uid to upload it.
-                uid = nouidcounter
-                nouidcounter -= 1
-            else:                       # It comes from our folder.
-                uidmatch = re_uidmatch.search(filename)
-                uid = None
-                if not uidmatch:
+            dirprefix = dirannex + os.sep
+            for filename, (uid, flags, size) in dirs[dirannex][1].iteritems():
+                # check maxage/maxsize if this message should be considered
+                if maxage and not self._iswithinmaxage(filename,
+                                                       maxagecutoff):
+                    continue
+                if maxsize and size > maxsize:
+                    continue
+                if uid is None: # assign negative uid to upload it.
                     uid = nouidcounter
                     nouidcounter -= 1
-                else:
-                    uid = long(uidmatch.group(1))
-            # 'filename' is 'dirannex/filename', e.g. cur/123,U=1,FMD5=1:2,S
-            retval[uid] = {'flags': flags, 'filename': filepath}
+                # We store just dirannex and filename, ie 'cur/123...'
+                retval[uid] = {'flags': flags, 'filename': dirprefix + filename}
+
+        if self._watcher:
+            self.repository.lastscans[self.getname()] = dirs
+        if self._scancachefile and dirs != cache:
+            self._savescancache(dirs)
         return retval
 
     def quickchanged(self, statusfolder):
@@ -197,9 +371,10 @@ class MaildirFolder(BaseFolder):
                 sorted(statusfolder.getmessageuidlist()):
             return True
         # Also check for flag changes, it's quick on a Maildir 
-        for (uid, message) in self.getmessagelist().iteritems():
-            if message['flags'] != statusfolder.getmessageflags(uid):
-                return True
+        if statusfolder.getchangedflags(
+                (uid, message['flags'])
+                for (uid, message) in self.getmessagelist().iteritems()):
+            return True
         return False  #Nope, nothing changed
 
     def cachemessagelist(self):
@@ -209,6 +384,15 @@ class MaildirFolder(BaseFolder):
     def getmessagelist(self):
         return self.messagelist
 
+    def _expect(self, filename):
+        """Tell the watcher that we are going to change a file ourselves
+
+        :param filename: 'new/...' or 'cur/...' as in the message list"""
+        if self._watcher:
+            dirannex, filename = os.path.split(filename)
+            self._watcher.expect(os.path.join(self.getfullname(), dirannex),
+                                 filename)
+
     def getmessage(self, uid):
         """Return the content of the message"""
         filename = self.messagelist[uid]['filename']
@@ -225,16 +409,16 @@ class MaildirFolder(BaseFolder):
         filepath = os.path.join(self.getfullname(), filename)
         return os.path.getmtime(filepath)
 
-    def new_message_filename(self, uid, flags=set()):
+    def new_message_filename(self, uid, flags=Flags()):
         """Creates a new unique Maildir filename
 
         :param uid: The UID`None`, or a set of maildir flags
-        :param flags: A set of maildir flags
+        :param flags: The Flags of the message
         :returns: String containing unique message filename"""
         timeval, timeseq = gettimeseq()
         return '%d_%d.%d.%s,U=%d,FMD5=%s%s2,%s' % \
             (timeval, timeseq, os.getpid(), socket.gethostname(),
-             uid, self._foldermd5, self.infosep, ''.join(sorted(flags)))
+             uid, self._foldermd5, self.infosep, Flags(flags))
         
     def savemessage(self, uid, content, flags, rtime):
         """Writes a new message, with the specified uid.
@@ -244,6 +428,7 @@ class MaildirFolder(BaseFolder):
         savemessage is never called in a dryrun mode."""
         # This function only ever saves to tmp/,
         # but it calls savemessageflags() to actually save to cur/ or new/.
+        flags = Flags(flags)
         self.ui.savemessage('maildir', uid, flags, self)
         if uid < 0:
             # We cannot assign a new uid.
@@ -275,7 +460,7 @@ class MaildirFolder(BaseFolder):
         file.write(content)
         # Make sure the data hits the disk
         file.flush()
-        if self.dofsync:
+        if self.dofsync and self.writebatch <= 1:
             os.fsync(fd)
         file.close()
 
@@ -284,11 +469,116 @@ class MaildirFolder(BaseFolder):
 
         self.messagelist[uid] = {'flags': flags,
                                  'filename': os.path.join('tmp', messagename)}
-        # savemessageflags moves msg to 'cur' or 'new' as appropriate
-        self.savemessageflags(uid, flags)
+        if self.writebatch > 1:
+            # flushmessages() moves the whole batch to 'cur' or 'new'
+            with self._batchlock:
+                self._batch.append(uid)
+                self._batchcallbacks[uid] = []
+                full = len(self._batch) >= self.writebatch
+            if full:
+                self.flushmessages()
+        else:
+            # savemessageflags moves msg to 'cur' or 'new' as appropriate
+            self.savemessageflags(uid, flags)
         self.ui.debug('maildir', 'savemessage: returning uid %d' % uid)
         return uid
 
+    def afterflush(self, uid, func, *args):
+        """Call func(*args) once message `uid` is in 'cur' or 'new', see
+        :meth:`flushmessages`"""
+        with self._batchlock:
+            if uid in self._batchcallbacks:
+                self._batchcallbacks[uid].append((func, args))
+                return
+        func(*args)
+
+    def flushmessages(self):
+        """Move the batch of messages written to tmp/ to 'cur' or 'new'
+
+        The files of the batch are synced to disk before the messages
+        are moved, and each directory they are moved to is fsynced once
+        afterwards. So like without batches, a message never shows up
+        without its content. Then the afterflush() functions of the
+        moved messages are called.
+
+        Messages that were deleted in the meantime are dropped along
+        with their afterflush() functions, and messages that were moved
+        by savemessageflags() are not moved again. A message that cannot
+        be moved stays in the batch for the next flush."""
+        with self._flushlock:
+            with self._batchlock:
+                batch, self._batch = self._batch, []
+            done = []
+            try:
+                for uid in batch[:]:
+                    if uid not in self.messagelist:
+                        batch.remove(uid)
+                        with self._batchlock:
+                            del self._batchcallbacks[uid]
+                if batch and self.dofsync:
+                    self._syncbatch(batch)
+                dirs = set()
+                while batch:
+                    uid = batch[0]
+                    filename = self.messagelist[uid]['filename']
+                    if filename.startswith('tmp' + os.sep):
+                        try:
+                            self.savemessageflags(uid,
+                                self.messagelist[uid]['flags'])
+                        except OfflineImapError as e:
+                            if e.severity > OfflineImapError.ERROR.FOLDER:
+                                raise
+                            self.ui.error(e, exc_info()[2])
+                            with self._batchlock:
+                                self._batch.append(batch.pop(0))
+                            continue
+                        filename = self.messagelist[uid]['filename']
+                    dirs.add(os.path.dirname(filename))
+                    done.append(batch.pop(0))
+                if self.dofsync:
+                    for dirannex in dirs:
+                        fd = os.open(os.path.join(self.getfullname(),
+                                                  dirannex), os.O_RDONLY)
+                        os.fsync(fd)
+                        os.close(fd)
+            except:
+                # whatever was not moved is tried again next time
+                with self._batchlock:
+                    self._batch[:0] = done + batch
+                raise
+            callbacks = []
+            with self._batchlock:
+                for uid in done:
+                    callbacks.extend(self._batchcallbacks.pop(uid))
+            for func, args in callbacks:
+                func(*args)
+
+    def _syncbatch(self, batch):
+        """Make sure the files of the messages `batch` are on disk
+
+        Where available, sync_file_range() first starts writing all of
+        them, so that the fsync()s that follow mostly wait for writes
+        already under way. Files that are gone are left to the rename."""
+        paths = [os.path.join(self.getfullname(),
+                              self.messagelist[uid]['filename'])
+                 for uid in batch]
+        passes = [os.fsync]
+        if _sync_file_range is not None:
+            passes.insert(0, lambda fd: _sync_file_range(fd, 0, 0,
+                                                         SYNC_FILE_RANGE_WRITE))
+        for syncfunc in passes:
+            for path in paths:
+                try:
+                    fd = os.open(path, os.O_RDONLY)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue
+                try:
+                    syncfunc(fd)
+                finally:
+                    os.close(fd)
+
     def getmessageflags(self, uid):
         return self.messagelist[uid]['flags']
 
@@ -301,6 +591,7 @@ class MaildirFolder(BaseFolder):
         Note that this function does not check against dryrun settings,
         so you need to ensure that it is never called in a
         dryrun mode."""
+        flags = Flags(flags)
         oldfilename = self.messagelist[uid]['filename']
         dir_prefix, filename = os.path.split(oldfilename)
         # If a message has been seen, it goes into 'cur'
@@ -313,11 +604,13 @@ class MaildirFolder(BaseFolder):
             infomatch = self.re_flagmatch.search(filename)
             if infomatch:
                 filename = filename[:-len(infomatch.group())] #strip off
-            infostr = '%s2,%s' % (self.infosep, ''.join(sorted(flags)))
+            infostr = '%s2,%s' % (self.infosep, flags)
             filename += infostr
 
         newfilename = os.path.join(dir_prefix, filename)
         if (newfilename != oldfilename):
+            self._expect(oldfilename)
+            self._expect(newfilename)
             try:
                 os.rename(os.path.join(self.getfullname(), oldfilename),
                           os.path.join(self.getfullname(), newfilename))
@@ -344,6 +637,8 @@ class MaildirFolder(BaseFolder):
         dir_prefix, filename = os.path.split(oldfilename)
         flags = self.getmessageflags(uid)
         filename = self.new_message_filename(new_uid, flags)
+        self._expect(oldfilename)
+        self._expect(os.path.join(dir_prefix, filename))
         os.rename(os.path.join(self.getfullname(), oldfilename),
                   os.path.join(self.getfullname(), dir_prefix, filename))
         self.messagelist[new_uid] = self.messagelist[uid]
@@ -362,6 +657,7 @@ class MaildirFolder(BaseFolder):
 
         filename = self.messagelist[uid]['filename']
         filepath = os.path.join(self.getfullname(), filename)
+        self._expect(filename)
         try:
             os.unlink(filepath)
         except OSError:
@@ -370,6 +666,7 @@ class MaildirFolder(BaseFolder):
             if uid in newmsglist:       # Nope, try new filename.
                 filename = newmsglist[uid]['filename']
                 filepath = os.path.join(self.getfullname(), filename)
+                self._expect(filename)
                 os.unlink(filepath)
             # Yep -- return.
         del(self.messagelist[uid])
@@ -18,6 +18,16 @@ from threading import Lock
 from offlineimap import OfflineImapError
 from .IMAP import IMAPFolder
 import os.path
+import struct
+
+mapmagic = 'OIUIDMAP'
+"""Start of a map file in the binary format"""
+_mapheader = struct.Struct('<8sq')
+"""mapmagic and the number of sorted pairs that follow, which are
+16 bytes each"""
+mapslack = 1024
+"""Pairs appended to a map file beyond twice the map size before it is
+compacted"""
 
 class MappedIMAPFolder(IMAPFolder):
     """IMAP class to map between Folder() instances where both side assign a uid
@@ -44,44 +54,112 @@ class MappedIMAPFolder(IMAPFolder):
                             self.getfolderbasename())
         
     def _loadmaps(self):
+        """Read the UID map of the folder
+
+        The map file holds (local UID, remote UID) pairs as fixed-width
+        little-endian 64 bit integers after a header. The first pairs,
+        as many as the header says, are sorted by local UID, as written
+        by :meth:`_savemaps`, so the file can be mmapped and binary
+        searched; a file not matching its header is rejected as
+        corrupt. Changes after that are
+        appended by :meth:`_appendmaps`, a remote UID of 0 marking a
+        deleted message, and the last pair of a local UID counts. Maps
+        in the former text format of 'local:remote' lines are read too.
+
+        :returns: (r2l, l2r) dicts"""
         self.maplock.acquire()
         try:
             mapfilename = self._getmapfilename()
+            # None until the file is written in the binary format
+            self._maprecords = None
             if not os.path.exists(mapfilename):
                 return ({}, {})
-            file = open(mapfilename, 'rt')
-            r2l = {}
+            file = open(mapfilename, 'rb')
+            data = file.read()
+            file.close()
+            if not data.startswith(mapmagic):
+                # converted by the first _appendmaps()
+                return self._loadtextmaps(mapfilename, data)
+            count, partial = divmod(len(data) - _mapheader.size, 16)
+            pairs = struct.unpack_from('<%dq' % (2 * count), data,
+                                       _mapheader.size)
+            sortedcount = _mapheader.unpack_from(data)[1]
+            sortedlocs = pairs[:2 * sortedcount:2]
+            if not 0 <= sortedcount <= count or \
+                    any(sortedlocs[i] >= sortedlocs[i + 1]
+                        for i in xrange(len(sortedlocs) - 1)):
+                raise Exception("Corrupt UID mapping file '%s': the header "
+                                "announces %d sorted pairs" %
+                                (mapfilename, sortedcount))
+            # A pair cut short by a crash while appending is ignored,
+            # and the file is rewritten before appending to it again.
+            self._maprecords = None if partial else count
             l2r = {}
-            while 1:
-                line = file.readline()
-                if not len(line):
-                    break
-                try:
-                    line = line.strip()
-                except ValueError:
-                    raise Exception("Corrupt line '%s' in UID mapping file '%s'" \
-                                        %(line, mapfilename))
-                (str1, str2) = line.split(':')
-                loc = long(str1)
-                rem = long(str2)
-                r2l[rem] = loc
-                l2r[loc] = rem
+            for i in xrange(0, len(pairs), 2):
+                l2r[pairs[i]] = pairs[i + 1]
+            for loc, rem in l2r.items():
+                if rem == 0:
+                    del l2r[loc]
+            r2l = dict((rem, loc) for loc, rem in l2r.iteritems())
             return (r2l, l2r)
         finally:
             self.maplock.release()
 
+    def _loadtextmaps(self, mapfilename, data):
+        r2l = {}
+        l2r = {}
+        for line in data.splitlines():
+            try:
+                (str1, str2) = line.strip().split(':')
+                loc = long(str1)
+                rem = long(str2)
+            except ValueError:
+                raise Exception("Corrupt line '%s' in UID mapping file '%s'" \
+                                    %(line, mapfilename))
+            r2l[rem] = loc
+            l2r[loc] = rem
+        return (r2l, l2r)
+
     def _savemaps(self, dolock = 1):
+        """Rewrite the map file with the pairs sorted by local UID,
+        compacting the changes appended to it"""
         mapfilename = self._getmapfilename()
         if dolock: self.maplock.acquire()
         try:
-            file = open(mapfilename + ".tmp", 'wt')
-            for (key, value) in self.diskl2r.iteritems():
-                file.write("%d:%d\n" % (key, value))
+            pairs = []
+            for key in sorted(self.diskl2r):
+                pairs.append(key)
+                pairs.append(self.diskl2r[key])
+            file = open(mapfilename + ".tmp", 'wb')
+            file.write(_mapheader.pack(mapmagic, len(self.diskl2r)))
+            file.write(struct.pack('<%dq' % len(pairs), *pairs))
             file.close()
             os.rename(mapfilename + '.tmp', mapfilename)
+            self._maprecords = len(self.diskl2r)
         finally:
             if dolock: self.maplock.release()
 
+    def _appendmaps(self, changes):
+        """Record changed pairs of diskl2r in the map file
+
+        Appends the (local UID, remote UID) pairs `changes` to the file,
+        with a remote UID of 0 for deleted messages, instead of writing
+        the whole map. Once the file holds twice as many pairs as the
+        map (plus some slack), it is compacted with :meth:`_savemaps`.
+        Must be called with self.maplock held."""
+        if self._maprecords is None or self._maprecords + len(changes) > \
+                2 * len(self.diskl2r) + mapslack:
+            self._savemaps(dolock = 0)
+            return
+        pairs = []
+        for loc, rem in changes:
+            pairs.append(loc)
+            pairs.append(rem)
+        file = open(self._getmapfilename(), 'ab')
+        file.write(struct.pack('<%dq' % len(pairs), *pairs))
+        file.close()
+        self._maprecords += len(changes)
+
     def _uidlist(self, mapping, items):
         try:
             return [mapping[x] for x in items]
@@ -100,14 +178,17 @@ class MappedIMAPFolder(IMAPFolder):
             # OK.  Now we've got a nice list.  First, delete things from the
             # summary that have been deleted from the folder.
 
+            deleted = []
             for luid in self.diskl2r.keys():
                 if not luid in reallist:
                     ruid = self.diskl2r[luid]
                     del self.diskr2l[ruid]
                     del self.diskl2r[luid]
+                    deleted.append((luid, 0))
+            if deleted:
+                self._appendmaps(deleted)
 
             # Now, assign negative UIDs to local items.
-            self._savemaps(dolock = 0)
             nextneg = -1
 
             self.r2l = self.diskr2l.copy()
@@ -122,6 +203,11 @@ class MappedIMAPFolder(IMAPFolder):
         finally:
             self.maplock.release()
 
+    def save_folderstatus(self):
+        # The STATUS had been recorded by the wrapped folder when
+        # caching its message list.
+        self._mb.save_folderstatus()
+
     def uidexists(self, ruid):
         """Checks if the (remote) UID exists in this Folder"""
         # This implementation overrides the one in BaseFolder, as it is
@@ -211,7 +297,7 @@ class MappedIMAPFolder(IMAPFolder):
             self.diskr2l[uid] = newluid
             self.l2r[newluid] = uid
             self.r2l[uid] = newluid
-            self._savemaps(dolock = 0)
+            self._appendmaps([(newluid, uid)])
         finally:
             self.maplock.release()
         return uid
@@ -258,14 +344,14 @@ class MappedIMAPFolder(IMAPFolder):
             if luid>0: self.diskl2r[luid] = new_ruid
             if ruid>0: del self.diskr2l[ruid]
             if new_ruid > 0: self.diskr2l[new_ruid] = luid
-            self._savemaps(dolock = 0)
+            if luid>0: self._appendmaps([(luid, new_ruid)])
         finally:
             self.maplock.release()
 
     def _mapped_delete(self, uidlist):
         self.maplock.acquire()
         try:
-            needssave = 0
+            deleted = []
             for ruid in uidlist:
                 luid = self.r2l[ruid]
                 del self.r2l[ruid]
@@ -273,9 +359,9 @@ class MappedIMAPFolder(IMAPFolder):
                 if ruid > 0:
                     del self.diskr2l[ruid]
                     del self.diskl2r[luid]
-                    needssave = 1
-            if needssave:
-                self._savemaps(dolock = 0)
+                    deleted.append((luid, 0))
+            if deleted:
+                self._appendmaps(deleted)
         finally:
             self.maplock.release()
 
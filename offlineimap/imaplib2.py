@@ -59,6 +59,7 @@ IDLE_TIMEOUT_RESPONSE = '* IDLE TIMEOUT\r\n'
 IDLE_TIMEOUT = 60*29                            # Don't stay in IDLE state longer
 READ_POLL_TIMEOUT = 30                          # Without this timeout interrupted network connections can hang reader
 READ_SIZE = 32768                               # Consume all available in socket
+MAX_READ_SIZE = 1024*1024                       # Largest read while receiving a literal
 
 DFLT_DEBUG_BUF_LVL = 3                          # Level above which the logging output goes directly to stderr
 
@@ -323,6 +324,10 @@ class IMAP4(object):
         else:
             self.read_poll_timeout = READ_POLL_TIMEOUT
         self.read_size = READ_SIZE
+        self._line_part = ''            # Incomplete line read so far
+        self._literal_buf = None        # Preallocated buffer for literal being read
+        self._literal_pos = 0
+        self._in_literal_response = False   # Last queued item was a literal
 
         # Open socket to server.
 
@@ -1702,6 +1707,72 @@ class IMAP4(object):
         if __debug__: self._log(1, 'finished')
 
 
+    def _next_read_size(self):
+
+        # Read a literal in as few reads as possible.
+
+        if self._literal_buf is None:
+            return self.read_size
+        left = len(self._literal_buf) - self._literal_pos
+        return max(self.read_size, min(left, MAX_READ_SIZE))
+
+
+    def _put_data(self, data):
+
+        # Split data read by the reader into lines for the handler.
+        # Literals announced by untagged responses are collected into a
+        # preallocated buffer and queued as a single item, rather than
+        # line by line.
+        # Returns True if the reader should terminate.
+
+        terminate = False
+        start = 0
+        dlen = len(data)
+        while start < dlen:
+            if self._literal_buf is not None:
+                size = min(len(self._literal_buf) - self._literal_pos, dlen - start)
+                end = self._literal_pos + size
+                memoryview(self._literal_buf)[self._literal_pos:end] = \
+                    memoryview(data)[start:start + size]
+                self._literal_pos = end
+                start += size
+                if end == len(self._literal_buf):
+                    if __debug__: self._log(4, '< literal size %s' % end)
+                    self.inq.put(str(self._literal_buf))
+                    self._literal_buf = None
+                    self._in_literal_response = True
+                continue
+
+            stop = data.find('\n', start)
+            if stop < 0:
+                self._line_part += data[start:]
+                break
+            stop += 1
+            self._line_part, start, line = \
+                '', stop, self._line_part + data[start:stop]
+            if __debug__: self._log(4, '< %s' % line)
+            self.inq.put(line)
+            if self.TerminateReader:
+                terminate = True
+
+            # Same rules as _put_response() for a literal to come
+            # (but don't touch self.mo, that belongs to the handler)
+            mo = None
+            if (self._in_literal_response or line.startswith('* ')) \
+                    and line.endswith('}\r\n'):
+                mo = self.literal_cre.match(line[:-2])
+            if mo is not None:
+                size = int(mo.group('size'))
+                if size:
+                    self._literal_buf = bytearray(size)
+                    self._literal_pos = 0
+                self._in_literal_response = True
+            else:
+                self._in_literal_response = False
+
+        return terminate
+
+
     if hasattr(select_module, "poll"):
 
       def _reader(self):
@@ -1718,8 +1789,6 @@ class IMAP4(object):
             }
             return ' '.join([PollErrors[s] for s in PollErrors.keys() if (s & state)])
 
-        line_part = ''
-
         poll = select.poll()
 
         poll.register(self.read_fd, select.POLLIN)
@@ -1742,8 +1811,7 @@ class IMAP4(object):
                 fd,state = r[0]
 
                 if state & select.POLLIN:
-                    data = self.read(self.read_size)            # Drain ssl buffer if present
-                    start = 0
+                    data = self.read(self._next_read_size())    # Drain ssl buffer if present
                     dlen = len(data)
                     if __debug__: self._log(5, 'rcvd %s' % dlen)
                     if dlen == 0:
@@ -1754,18 +1822,8 @@ class IMAP4(object):
                         continue                                # Try again
                     rxzero = 0
 
-                    while True:
-                        stop = data.find('\n', start)
-                        if stop < 0:
-                            line_part += data[start:]
-                            break
-                        stop += 1
-                        line_part, start, line = \
-                            '', stop, line_part + data[start:stop]
-                        if __debug__: self._log(4, '< %s' % line)
-                        self.inq.put(line)
-                        if self.TerminateReader:
-                            terminate = True
+                    if self._put_data(data):
+                        terminate = True
 
                 if state & ~(select.POLLIN):
                     raise IOError(poll_error(state))
@@ -1793,8 +1851,6 @@ class IMAP4(object):
 
         if __debug__: self._log(1, 'starting using select')
 
-        line_part = ''
-
         rxzero = 0
         terminate = False
 
@@ -1809,8 +1865,7 @@ class IMAP4(object):
                 if not r:                                       # Timeout
                     continue
 
-                data = self.read(self.read_size)                # Drain ssl buffer if present
-                start = 0
+                data = self.read(self._next_read_size())        # Drain ssl buffer if present
                 dlen = len(data)
                 if __debug__: self._log(5, 'rcvd %s' % dlen)
                 if dlen == 0:
@@ -1821,18 +1876,8 @@ class IMAP4(object):
                     continue                                    # Try again
                 rxzero = 0
 
-                while True:
-                    stop = data.find('\n', start)
-                    if stop < 0:
-                        line_part += data[start:]
-                        break
-                    stop += 1
-                    line_part, start, line = \
-                        '', stop, line_part + data[start:stop]
-                    if __debug__: self._log(4, '< %s' % line)
-                    self.inq.put(line)
-                    if self.TerminateReader:
-                        terminate = True
+                if self._put_data(data):
+                    terminate = True
             except:
                 reason = 'socket error: %s - %s' % sys.exc_info()[:2]
                 if __debug__:
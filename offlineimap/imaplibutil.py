@@ -16,12 +16,15 @@
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
 import os
+import errno
 import fcntl
 import re
+import select
 import socket
 import ssl
 import time
 import subprocess
+import sys
 import threading
 from hashlib import sha1
 
@@ -31,6 +34,152 @@ from offlineimap.imaplib2 import IMAP4, IMAP4_SSL, zlib, IMAP4_PORT, InternalDat
 
 
 class UsefulIMAPMixIn(object):
+    def __init__(self, *args, **kwargs):
+        self.phasetimes = {}
+        """Seconds spent setting up the connection, by phase ('tcp',
+        'tls', 'auth')"""
+        self.sharedreader = kwargs.pop('sharedreader', None)
+        """:class:`SharedReader` reading this connection, or None to use
+        a reader thread of its own"""
+        self._ownreader = False
+        """Set while STARTTLS or COMPRESS need a reader thread of our own"""
+        self.commandhook = None
+        """Called as commandhook(imapobj, name, seconds, typ, bytes, text)
+        after each synchronous command, typ being 'BYE' if the
+        connection was aborted"""
+        self.bytesin = 0
+        """Number of (decompressed) bytes received"""
+        super(UsefulIMAPMixIn, self).__init__(*args, **kwargs)
+
+    def _reader(self):
+        if not self._usesharedreader():
+            return super(UsefulIMAPMixIn, self)._reader()
+        # the reader thread ends here, the SharedReader takes over
+        threading.currentThread().setName(self.identifier + 'reader')
+        if self._isssl():
+            # a read must not wait for the rest of an SSL record
+            self.sock.setblocking(0)
+        self.sharedreader.register(self)
+
+    def _switchreader(self):
+        """Read this connection with a thread of its own from now on
+
+        Only to be called while the server sends nothing, i.e. before
+        we send the next command."""
+        self._ownreader = True
+        self.sharedreader.unregister(self)
+        if self._isssl():
+            self.sock.setblocking(1)
+        self.rdth = threading.Thread(target=self._reader)
+        self.rdth.setDaemon(True)
+        self.rdth.start()
+
+    def shutdown(self):
+        if self.sharedreader is not None:
+            self.sharedreader.unregister(self)
+        super(UsefulIMAPMixIn, self).shutdown()
+
+    def _put_data(self, data):
+        self.bytesin += len(data)
+        return super(UsefulIMAPMixIn, self)._put_data(data)
+
+    def _simple_command(self, name, *args, **kw):
+        # LOGOUT is left out as the pool logs out with its locks held
+        if self.commandhook is None or 'callback' in kw or name == 'LOGOUT':
+            return super(UsefulIMAPMixIn, self)._simple_command(name, *args,
+                                                                **kw)
+        start, bytesin = time.time(), self.bytesin
+        try:
+            typ, dat = super(UsefulIMAPMixIn, self)._simple_command(name,
+                                                                *args, **kw)
+        except self.abort as e:
+            self.commandhook(self, name, time.time() - start, 'BYE',
+                             self.bytesin - bytesin, str(e))
+            raise
+        text = ''
+        if typ == 'NO':
+            text = ' '.join([str(d) for d in dat if d])
+        self.commandhook(self, name, time.time() - start, typ,
+                         self.bytesin - bytesin, text)
+        return typ, dat
+
+    def _usesharedreader(self):
+        """Whether the :class:`SharedReader` reads this connection
+
+        It reads plain and SSL streams. COMPRESS keeps received data in
+        a buffer that poll() does not signal, so compressed connections
+        keep a reader thread of their own, as do connections switching
+        to TLS with STARTTLS until the handshake is done."""
+        return self.sharedreader is not None and \
+            self.decompressor is None and not self._ownreader
+
+    def _isssl(self):
+        """Whether this connection reads and writes through SSL"""
+        return isinstance(getattr(self, 'sock', None), ssl.SSLSocket)
+
+    def send(self, data):
+        if not (self._isssl() and self.sock.gettimeout() == 0.0):
+            return super(UsefulIMAPMixIn, self).send(data)
+        # The SharedReader made the SSL socket non-blocking, wait until
+        # we can write instead of spinning.
+        while data:
+            try:
+                sent = self.sock.send(data)
+            except ssl.SSLError as e:
+                if e.args[0] not in (ssl.SSL_ERROR_WANT_READ,
+                                     ssl.SSL_ERROR_WANT_WRITE):
+                    raise
+                sent = 0
+            if not sent:
+                select.select([], [self.sock], [], 1)
+                continue
+            data = data[sent:]
+
+    def starttls(self, *args, **kwargs):
+        if not self._usesharedreader():
+            return super(UsefulIMAPMixIn, self).starttls(*args, **kwargs)
+        # imaplib2 stops the reader thread right after the tagged
+        # response and restarts it once the socket is wrapped, so that
+        # no reader gets at the handshake. Do that with a thread of our
+        # own, the SharedReader would keep polling the socket.
+        self._switchreader()
+        return super(UsefulIMAPMixIn, self).starttls(*args, **kwargs)
+
+    def open_socket(self):
+        start = time.time()
+        sock = super(UsefulIMAPMixIn, self).open_socket()
+        self.phasetimes['tcp'] = time.time() - start
+        return sock
+
+    def ssl_wrap_socket(self):
+        # used for both SSL connections and STARTTLS
+        start = time.time()
+        super(UsefulIMAPMixIn, self).ssl_wrap_socket()
+        self.phasetimes['tls'] = time.time() - start
+        # the handshake is done, STARTTLS restarts the reader next
+        self._ownreader = False
+
+    def start_compressing(self):
+        shared = self._usesharedreader()
+        super(UsefulIMAPMixIn, self).start_compressing()
+        self.decompressor = CountingDecompressor(self.decompressor)
+        self.compressor = CountingCompressor(self.compressor)
+        if shared:
+            # The server sends nothing until our next command, so the
+            # reader can be switched now, see _usesharedreader().
+            self._switchreader()
+
+    def getcompressionstats(self):
+        """Returns the bytes transferred since COMPRESS was enabled
+
+        :returns: (received on the wire, received decompressed, sent on
+            the wire, sent uncompressed) or None if the connection is
+            not compressed."""
+        if self.compressor is None:
+            return None
+        return (self.decompressor.wirebytes, self.decompressor.plainbytes,
+                self.compressor.wirebytes, self.compressor.plainbytes)
+
     def getselectedfolder(self):
         if self.state == 'SELECTED':
             return self.mailbox
@@ -39,10 +188,13 @@ class UsefulIMAPMixIn(object):
     def select(self, mailbox='INBOX', readonly=False, force = False):
         """Selects a mailbox on the IMAP server
 
+        A mailbox that is selected read-write already is not
+        re-EXAMINEd for read-only access.
+
         :returns: 'OK' on success, nothing if the folder was already
         selected or raises an :exc:`OfflineImapError`"""
-        if self.getselectedfolder() == mailbox and self.is_readonly == readonly \
-                and not force:
+        if self.getselectedfolder() == mailbox and \
+                (readonly or not self.is_readonly) and not force:
             # No change; return.
             return
         # Wipe out all old responses, to maintain semantics with old imaplib2
@@ -69,6 +221,168 @@ class UsefulIMAPMixIn(object):
     def _mesg(self, s, tn=None, secs=None):
         new_mesg(self, s, tn, secs)
 
+class CountingDecompressor(object):
+    """Wraps a zlib decompressor, counting compressed and plain bytes"""
+    def __init__(self, decompressor):
+        self.decompressor = decompressor
+        self.wirebytes = 0
+        self.plainbytes = 0
+
+    @property
+    def unconsumed_tail(self):
+        return self.decompressor.unconsumed_tail
+
+    def decompress(self, data, size=0):
+        # read() hands the unconsumed tail back in, don't count it twice
+        if data is not self.decompressor.unconsumed_tail:
+            self.wirebytes += len(data)
+        data = self.decompressor.decompress(data, size)
+        self.plainbytes += len(data)
+        return data
+
+
+class CountingCompressor(object):
+    """Wraps a zlib compressor, counting plain and compressed bytes"""
+    def __init__(self, compressor):
+        self.compressor = compressor
+        self.wirebytes = 0
+        self.plainbytes = 0
+
+    def compress(self, data):
+        self.plainbytes += len(data)
+        data = self.compressor.compress(data)
+        self.wirebytes += len(data)
+        return data
+
+    def flush(self, *args):
+        data = self.compressor.flush(*args)
+        self.wirebytes += len(data)
+        return data
+
+
+class SharedReader(object):
+    """Reads the sockets of many IMAP connections in a single thread
+
+    imaplib2 starts a reader, a writer and a handler thread for each
+    connection. A plain or SSL (but not compressed) connection created
+    with `sharedreader=` registers with this poller instead of running
+    its own reader thread; its writer and handler threads are kept.
+    Each poll() event is answered with a single read, which returns
+    what arrived without blocking: SSL sockets are non-blocking while
+    registered, and data SSL decrypted beyond that read is drained
+    right away. Received data is handed to the connection's _put_data()
+    just like its reader thread would do, from where the handler thread
+    dispatches it to the waiting requests."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = {}
+        """registered connections by their read_fd"""
+        self.changed = True
+        self.thread = None
+        # poll() is interrupted by writing to this pipe on changes
+        self.wakeup_r, self.wakeup_w = os.pipe()
+
+    def register(self, imapobj):
+        with self.lock:
+            self.connections[imapobj.read_fd] = imapobj
+            imapobj._rxzero = 0
+            self.changed = True
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run,
+                                               name='Shared IMAP reader')
+                self.thread.setDaemon(True)
+                self.thread.start()
+        os.write(self.wakeup_w, 'x')
+
+    def unregister(self, imapobj):
+        with self.lock:
+            if self.connections.get(imapobj.read_fd) is imapobj:
+                del self.connections[imapobj.read_fd]
+                self.changed = True
+        os.write(self.wakeup_w, 'x')
+
+    def _run(self):
+        poll = None
+        while True:
+            with self.lock:
+                if self.changed:
+                    # snapshot of what we poll for, so that events on
+                    # a meanwhile unregistered (and reused) fd are ignored
+                    polled = dict(self.connections)
+                    poll = select.poll()
+                    poll.register(self.wakeup_r, select.POLLIN)
+                    for fd in polled:
+                        poll.register(fd, select.POLLIN)
+                    self.changed = False
+            # a short timeout, so we notice terminated connections
+            try:
+                events = poll.poll(1000)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, state in events:
+                if fd == self.wakeup_r:
+                    os.read(self.wakeup_r, 512)
+                    continue
+                imapobj = polled[fd]
+                with self.lock:
+                    if self.connections.get(fd) is not imapobj:
+                        continue # unregistered while polling
+                self._read(imapobj, state)
+            for imapobj in polled.values():
+                if imapobj.Terminate:
+                    self.unregister(imapobj)
+
+    def _read(self, imapobj, state):
+        """Reads from `imapobj` for poll() event `state`"""
+        try:
+            if not state & select.POLLIN:
+                raise IOError('poll state %d' % state)
+            try:
+                data = imapobj.read(imapobj._next_read_size())
+            except ssl.SSLError as e:
+                if e.args[0] in (ssl.SSL_ERROR_WANT_READ,
+                                 ssl.SSL_ERROR_WANT_WRITE):
+                    return # not a whole SSL record yet
+                raise
+            if not data:
+                imapobj._rxzero += 1
+                if imapobj._rxzero > 5:
+                    raise IOError("Too many read 0")
+                return
+            imapobj._rxzero = 0
+            terminate = imapobj._put_data(data)
+            # poll() does not signal what SSL decrypted already
+            while not terminate and imapobj._isssl() and \
+                    imapobj.sock.pending():
+                terminate = imapobj._put_data(
+                    imapobj.read(imapobj._next_read_size()))
+            if terminate:
+                # the connection wants its reader to stop
+                self.unregister(imapobj)
+        except:
+            reason = 'socket error: %s - %s' % sys.exc_info()[:2]
+            self.unregister(imapobj)
+            imapobj.inq.put((imapobj.abort, reason))
+
+
+def getsharedreader():
+    """Returns the process wide :class:`SharedReader`
+
+    :returns: the SharedReader or None if this platform has no poll()"""
+    global sharedreader
+    if not hasattr(select, 'poll'):
+        return None
+    with sharedreaderlock:
+        if sharedreader is None:
+            sharedreader = SharedReader()
+    return sharedreader
+
+sharedreader = None
+sharedreaderlock = threading.Lock()
+
+
 class IMAP4_Tunnel(UsefulIMAPMixIn, IMAP4):
     """IMAP4 client class over a tunnel
 
@@ -78,7 +392,7 @@ class IMAP4_Tunnel(UsefulIMAPMixIn, IMAP4):
     The result will be in PREAUTH stage."""
 
     def __init__(self, tunnelcmd, **kwargs):
-        IMAP4.__init__(self, tunnelcmd, **kwargs)
+        super(IMAP4_Tunnel, self).__init__(tunnelcmd, **kwargs)
 
     def open(self, host, port):
         """The tunnelcmd comes in on host!"""
@@ -122,6 +436,8 @@ class IMAP4_Tunnel(UsefulIMAPMixIn, IMAP4):
 
 
     def shutdown(self):
+        if self.sharedreader is not None:
+            self.sharedreader.unregister(self)
         self.infd.close()
         self.outfd.close()
         self.process.wait()
@@ -24,6 +24,7 @@ import socket
 import base64
 import time
 import errno
+import re
 from sys import exc_info
 from socket import gaierror
 from ssl import SSLError, cert_time_to_seconds
@@ -37,6 +38,10 @@ try:
 except ImportError:
     pass
 
+# NO and BYE responses that ask us to back off (see also RFC 5530)
+throttle_re = re.compile(r'\[(UNAVAILABLE|LIMIT|THROTTLED|INUSE)\]|throttl|'
+                         r'too many|try again later', re.IGNORECASE)
+
 class IMAPServer:
     """Initializes all variables from an IMAPRepository() instance
 
@@ -48,6 +53,10 @@ class IMAPServer:
      """
     GSS_STATE_STEP = 0
     GSS_STATE_WRAP = 1
+    ADAPT_INTERVAL = 10
+    """Seconds between decisions on the connection budget"""
+    ADAPT_COOLDOWN = 120
+    """Seconds not to grow the connection budget after shrinking it"""
     def __init__(self, repos):
         self.ui = getglobalui()
         self.repos = repos
@@ -69,12 +78,39 @@ class IMAPServer:
             self.verifycert = None # disable cert verification
         self.delim = None
         self.root = None
+        self.compression = repos.getcompression()
+        self.readsize = repos.getreadsize()
+        self.sharedreader = None
+        if self.config.getdefaultboolean('general', 'sharedreader', False):
+            self.sharedreader = imaplibutil.getsharedreader()
+        self.compressionstats = [0, 0, 0, 0]
+        """Bytes transferred by closed compressed connections, see
+        :meth:`imaplibutil.UsefulIMAPMixIn.getcompressionstats`"""
         self.maxconnections = repos.getmaxconnections()
         self.availableconnections = []
         self.assignedconnections = []
         self.lastowner = {}
+        self.selecthits = 0
+        """Number of times acquireconnection() found a pooled connection
+        that had the requested mailbox selected already"""
+        self.selectmisses = 0
+        """Number of times acquireconnection() did not find one"""
         self.semaphore = BoundedSemaphore(self.maxconnections)
         self.connectionlock = Lock()
+        self.adaptive = repos.getadaptiveconnections()
+        self.budget = self.maxconnections
+        """Number of connections to use at most, adapted between 1 and
+        maxconnections if 'adaptiveconnections' is on. Slots of
+        self.semaphore above it are held back in self.withheld, or
+        will be once they are released (self.pendingshrink)"""
+        self.withheld = 0
+        self.pendingshrink = 0
+        self.adaptlock = Lock()
+        self._resetadaptwindow(time.time())
+        self.baselatency = None
+        self.growthbase = None
+        self.cooldown = 0
+        self.lastdecision = 0
         self.reference = repos.getreference()
         self.idlefolders = repos.getidlefolders()
         self.gss_step = self.GSS_STATE_STEP
@@ -110,13 +146,27 @@ class IMAPServer:
         if connection is None: return #noop on bad connection
         self.connectionlock.acquire()
         self.assignedconnections.remove(connection)
+        withhold = self._releaseslot()
         # Don't reuse broken connections
-        if connection.Terminate or drop_conn:
+        if connection.Terminate or drop_conn or withhold:
+            self._addcompressionstats(connection)
             connection.logout()
         else:
             self.availableconnections.append(connection)
         self.connectionlock.release()
+
+    def _releaseslot(self):
+        """Releases a slot of self.semaphore, or withholds it if the
+        budget shrank while it was in use
+
+        Must be called with self.connectionlock held.
+        :returns: True if the slot was withheld"""
+        if self.pendingshrink > 0:
+            self.pendingshrink -= 1
+            self.withheld += 1
+            return True
         self.semaphore.release()
+        return False
 
     def md5handler(self, response):
         challenge = response.strip()
@@ -158,28 +208,54 @@ class IMAPServer:
             response = ''
         return base64.b64decode(response)
 
-    def acquireconnection(self):
+    def acquireconnection(self, mailbox=None, readonly=False):
         """Fetches a connection from the pool, making sure to create a new one
         if needed, to obey the maximum connection limits, etc.
         Opens a connection to the server and returns an appropriate
-        object."""
-
-        self.semaphore.acquire()
+        object.
+
+        :param mailbox: The mailbox the caller is going to select, if
+            any. A pooled connection that has it selected already is
+            preferred, so that select() does not need to issue another
+            SELECT/EXAMINE.
+        :param readonly: Whether `mailbox` will be selected read-only.
+            A connection with `mailbox` selected read-write serves
+            read-only callers too."""
+
+        if not self.semaphore.acquire(False):
+            # note the demand for more connections
+            with self.adaptlock:
+                self.adaptwindow['waits'] += 1
+            self.semaphore.acquire()
         self.connectionlock.acquire()
         curThread = currentThread()
         imapobj = None
 
         if len(self.availableconnections): # One is available.
-            # Try to find one that previously belonged to this thread
-            # as an optimization.  Start from the back since that's where
-            # they're popped on.
             imapobj = None
-            for i in range(len(self.availableconnections) - 1, -1, -1):
-                tryobj = self.availableconnections[i]
-                if self.lastowner[tryobj] == curThread.ident:
-                    imapobj = tryobj
-                    del(self.availableconnections[i])
-                    break
+            if mailbox is not None:
+                # Try to find one that has the mailbox selected already
+                for i in range(len(self.availableconnections) - 1, -1, -1):
+                    tryobj = self.availableconnections[i]
+                    if tryobj.getselectedfolder() == mailbox and \
+                            (readonly or not tryobj.is_readonly):
+                        imapobj = tryobj
+                        del(self.availableconnections[i])
+                        break
+                if imapobj:
+                    self.selecthits += 1
+                else:
+                    self.selectmisses += 1
+            if not imapobj:
+                # Try to find one that previously belonged to this thread
+                # as an optimization.  Start from the back since that's where
+                # they're popped on.
+                for i in range(len(self.availableconnections) - 1, -1, -1):
+                    tryobj = self.availableconnections[i]
+                    if self.lastowner[tryobj] == curThread.ident:
+                        imapobj = tryobj
+                        del(self.availableconnections[i])
+                        break
             if not imapobj:
                 imapobj = self.availableconnections[0]
                 del(self.availableconnections[0])
@@ -187,7 +263,9 @@ class IMAPServer:
             self.lastowner[imapobj] = curThread.ident
             self.connectionlock.release()
             return imapobj
-        
+
+        if mailbox is not None:
+            self.selectmisses += 1 # a new connection has nothing selected
         self.connectionlock.release()   # Release until need to modify data
 
         """ Must be careful here that if we fail we should bail out gracefully
@@ -200,7 +278,8 @@ class IMAPServer:
                 if self.tunnel:
                     self.ui.connecting('tunnel', self.tunnel)
                     imapobj = imaplibutil.IMAP4_Tunnel(self.tunnel,
-                                                       timeout=socket.getdefaulttimeout())
+                                                       timeout=socket.getdefaulttimeout(),
+                                                       sharedreader=self.sharedreader)
                     success = 1
                 elif self.usessl:
                     self.ui.connecting(self.hostname, self.port)
@@ -212,13 +291,17 @@ class IMAPServer:
                                                            self.sslcacertfile,
                                                            self.verifycert,
                                                            timeout=socket.getdefaulttimeout(),
-                                                           fingerprint=fingerprint
+                                                           fingerprint=fingerprint,
+                                                           sharedreader=self.sharedreader
                                                            )
                 else:
                     self.ui.connecting(self.hostname, self.port)
                     imapobj = imaplibutil.WrappedIMAP4(self.hostname, self.port,
-                                                       timeout=socket.getdefaulttimeout())
+                                                       timeout=socket.getdefaulttimeout(),
+                                                       sharedreader=self.sharedreader)
 
+                authstart = time.time()
+                tlstime = imapobj.phasetimes.get('tls', 0)
                 if not self.tunnel:
                     try:
                         # Try GSSAPI and continue if it fails
@@ -270,12 +353,27 @@ class IMAPServer:
                     except imapobj.error as val:
                         self.passworderror = str(val)
                         raise
+                # don't count a STARTTLS handshake as authentication
+                imapobj.phasetimes['auth'] = time.time() - authstart - \
+                    (imapobj.phasetimes.get('tls', 0) - tlstime)
+                self.ui.debug('imap', 'connection set up in %s' % ', '.join(
+                    ['%s %.3fs' % (phase, secs) for phase, secs in
+                     sorted(imapobj.phasetimes.items())]))
 
             # update capabilities after login, e.g. gmail serves different ones
             typ, dat = imapobj.capability()
             if dat != [None]:
                 imapobj.capabilities = tuple(dat[-1].upper().split())
 
+            imapobj.read_size = self.readsize
+            if self.adaptive:
+                imapobj.commandhook = self._commanddone
+
+            if self.compression and \
+                    'COMPRESS=DEFLATE' in imapobj.capabilities:
+                self.ui.debug('imap', 'Enabling COMPRESS=DEFLATE')
+                imapobj.enable_compression()
+
             if self.delim == None:
                 listres = imapobj.list(self.reference, '""')[1]
                 if listres == [None] or listres == None:
@@ -304,10 +402,14 @@ class IMAPServer:
             """If we are here then we did not succeed in getting a
             connection - we should clean up and then re-raise the
             error..."""
-            self.semaphore.release()
-
             if(self.connectionlock.locked()):
                 self.connectionlock.release()
+            with self.connectionlock:
+                self._releaseslot()
+
+            if self.adaptive:
+                # e.g. NO [UNAVAILABLE] to a LOGIN with too many connections
+                self._commanddone(None, 'CONNECT', 0, 'NO', 0, str(e))
 
             severity = OfflineImapError.ERROR.REPO
             if type(e) == gaierror:
@@ -351,6 +453,238 @@ class IMAPServer:
                 # re-raise all other errors
                 raise
 
+    def folderstatus(self, mailboxes):
+        """Query the STATUS of all `mailboxes` in a single round trip
+
+        Uses LIST-STATUS (RFC 5819) if the server supports it and
+        pipelines one STATUS command for each mailbox that was not
+        covered by it. HIGHESTMODSEQ is only requested from servers
+        that advertise CONDSTORE.
+
+        :returns: dict mapping mailbox names to dicts of (long) STATUS
+                  values. Mailboxes the server did not report on (or
+                  all of them if the connection dropped) are missing."""
+        imapobj = self.acquireconnection()
+        drop_conn = False
+        responses = []
+        try:
+            items = ['MESSAGES', 'UIDNEXT', 'UIDVALIDITY']
+            if 'CONDSTORE' in imapobj.capabilities:
+                items.append('HIGHESTMODSEQ')
+            items = '(%s)' % ' '.join(items)
+
+            if 'LIST-STATUS' in imapobj.capabilities:
+                imapobj._simple_command('LIST', self.reference, '*', 'RETURN',
+                                        '(STATUS %s)' % items,
+                                        untagged_response = 'LIST')
+                responses.extend(imapobj.response('STATUS')[1])
+            result = self._parsestatus(responses)
+
+            pending = [m for m in mailboxes if not m in result]
+            if not pending:
+                return result
+            # STATUS is an asynchronous command in imaplib2, so all
+            # requests are sent out before we wait for the first reply.
+            lock = Lock()
+            done = Event()
+            remaining = [len(pending)]
+            errors = []
+            def callback(args):
+                response, cb_arg, error = args
+                with lock:
+                    if error is not None:
+                        errors.append(error)
+                    elif response[0] == 'OK':
+                        # untagged STATUS responses of concurrent
+                        # requests may end up in any of the callbacks
+                        responses.extend(response[1])
+                    remaining[0] -= 1
+                    if not remaining[0]:
+                        done.set()
+            for mailbox in pending:
+                imapobj.status(mailbox, items, callback = callback,
+                               cb_arg = mailbox)
+            done.wait()
+            for typ, val in errors:
+                self.ui.debug('imap', 'folderstatus: STATUS failed: %s' % val)
+                if issubclass(typ, imapobj.abort):
+                    drop_conn = True
+            if drop_conn:
+                return {}
+            return self._parsestatus(responses)
+        except imapobj.abort as e:
+            # Callers fall back to SELECTing each folder.
+            self.ui.debug('imap', 'folderstatus: connection dropped: %s' % e)
+            drop_conn = True
+            return {}
+        except imapobj.error as e:
+            self.ui.debug('imap', 'folderstatus: server error: %s' % e)
+            return {}
+        finally:
+            self.releaseconnection(imapobj, drop_conn)
+
+    def _parsestatus(self, responses):
+        """Convert a list of untagged STATUS responses to a dict of dicts"""
+        result = {}
+        for response in responses:
+            if not isinstance(response, basestring):
+                # Mailbox names sent as literals are not handled, those
+                # folders are simply not reported.
+                continue
+            try:
+                mailbox, status = imaputil.status2hash(response)
+            except (ValueError, IndexError):
+                self.ui.debug('imap', "Can't parse STATUS response %s" %
+                              repr(response))
+                continue
+            result[mailbox] = status
+        return result
+
+    def warmup(self):
+        """Opens connections up to maxconnections in parallel
+
+        The first connection is opened on its own, so that the password
+        is asked for (and GSSAPI negotiated) only once; the others then
+        reuse the cached good password and are opened concurrently.
+        Errors on the first connection are raised as usual, the other
+        connections are only logged and will simply be opened lazily by
+        :meth:`acquireconnection` later on."""
+        with self.connectionlock:
+            count = self.budget - len(self.availableconnections) - \
+                len(self.assignedconnections)
+        if count <= 0:
+            return
+        connections = [self.acquireconnection()]
+        lock = Lock()
+
+        def openconnection():
+            try:
+                imapobj = self.acquireconnection()
+            except Exception as e:
+                self.ui.debug('imap', 'warmup: could not open connection: '
+                              '%s' % e)
+                return
+            with lock:
+                connections.append(imapobj)
+
+        threads = []
+        for i in range(count - 1):
+            thread = Thread(target = openconnection,
+                            name = "Connect %s #%d" % (self.repos.getname(),
+                                                       i + 2))
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        for imapobj in connections:
+            self.releaseconnection(imapobj)
+        self.ui.debug('imap', 'warmup: %d of %d connections open' %
+                      (len(connections), count))
+
+    def _addcompressionstats(self, imapobj):
+        """Adds the byte counters of a compressed connection to the totals"""
+        stats = imapobj.getcompressionstats()
+        if stats:
+            self.compressionstats = [total + count for total, count in
+                                     zip(self.compressionstats, stats)]
+
+    def _resetadaptwindow(self, now):
+        self.adaptwindow = {'start': now, 'commands': 0, 'seconds': 0.0,
+                            'bytes': 0, 'throttled': 0, 'waits': 0}
+
+    def _commanddone(self, imapobj, name, seconds, typ, nbytes, text):
+        """Records a finished command for the adaptive connection budget
+
+        Set as :attr:`UsefulIMAPMixIn.commandhook` of our connections
+        if 'adaptiveconnections' is on. Latency is only measured on
+        commands without much data in the response."""
+        throttled = typ in ('NO', 'BYE') and throttle_re.search(text)
+        with self.adaptlock:
+            now = time.time()
+            if now - seconds < self.lastdecision:
+                # sent before we last reacted
+                throttled = False
+            window = self.adaptwindow
+            if nbytes < 4096:
+                window['commands'] += 1
+                window['seconds'] += seconds
+            window['bytes'] += nbytes
+            if throttled:
+                window['throttled'] += 1
+            if throttled or now - window['start'] >= self.ADAPT_INTERVAL:
+                self._adapt(now)
+
+    def _adapt(self, now):
+        """Decides on the connection budget at the end of a window
+
+        The budget is halved when the server throttles us and reduced by
+        one when commands take much longer than they used to, or when
+        the last added connection did not increase the throughput. It
+        grows by one connection at a time while callers had to wait for
+        a connection. Called with self.adaptlock held."""
+        window = self.adaptwindow
+        self._resetadaptwindow(now)
+        elapsed = max(now - window['start'], 0.001)
+        throughput = window['bytes'] / elapsed
+        latency = None
+        if window['commands'] >= 3:
+            latency = window['seconds'] / window['commands']
+            if self.baselatency is None or latency < self.baselatency:
+                self.baselatency = latency
+        budget, reason = self.budget, None
+        if window['throttled']:
+            budget = max(1, self.budget // 2)
+            reason = "throttled by the server"
+        elif latency and self.budget > 1 and latency > 3 * self.baselatency:
+            budget = self.budget - 1
+            reason = "latency %.3fs, %.3fs at best" % (latency,
+                                                       self.baselatency)
+        elif self.growthbase is not None and \
+                throughput < self.growthbase * 1.05:
+            budget = self.budget - 1
+            reason = "throughput %d bytes/s, %d before adding a " \
+                "connection" % (throughput, self.growthbase)
+        elif window['waits'] and self.budget < self.maxconnections and \
+                now >= self.cooldown:
+            budget = self.budget + 1
+            reason = "%d waits for a connection, throughput %d bytes/s" % (
+                window['waits'], throughput)
+        self.growthbase = None
+        if budget < self.budget:
+            self.cooldown = now + self.ADAPT_COOLDOWN
+        elif budget > self.budget:
+            self.growthbase = throughput
+        else:
+            return
+        self.lastdecision = now
+        self.ui.connectionbudget(self.repos, self.budget, budget, reason)
+        self._setbudget(budget)
+
+    def _setbudget(self, budget):
+        """Withholds or returns connection slots to reach `budget`"""
+        with self.connectionlock:
+            while self.budget > budget:
+                self.budget -= 1
+                if self.semaphore.acquire(False):
+                    self.withheld += 1
+                else:
+                    self.pendingshrink += 1
+            while self.budget < budget:
+                self.budget += 1
+                if self.pendingshrink:
+                    self.pendingshrink -= 1
+                else:
+                    self.withheld -= 1
+                    self.semaphore.release()
+            # close idle connections above the budget
+            while self.availableconnections and \
+                    len(self.availableconnections) + \
+                    len(self.assignedconnections) > self.budget:
+                imapobj = self.availableconnections.pop(0)
+                self._addcompressionstats(imapobj)
+                imapobj.logout()
+
     def connectionwait(self):
         """Waits until there is a connection available.  Note that between
         the time that a connection becomes available and the time it is
@@ -370,12 +704,28 @@ class IMAPServer:
             # TODO: won't work IMHO, as releaseconnection() also
             # requires the connectionlock, leading to a potential
             # deadlock! Audit & check!
+            for i in range(self.withheld):
+                self.semaphore.release()
             threadutil.semaphorereset(self.semaphore, self.maxconnections)
+            # keep the budget for the next sync
+            for i in range(self.withheld + self.pendingshrink):
+                self.semaphore.acquire()
+            self.withheld += self.pendingshrink
+            self.pendingshrink = 0
             for imapobj in self.assignedconnections + self.availableconnections:
+                self._addcompressionstats(imapobj)
                 imapobj.logout()
             self.assignedconnections = []
             self.availableconnections = []
             self.lastowner = {}
+            if self.selecthits or self.selectmisses:
+                self.ui.debug('imap', 'connection pool: %d connections had '
+                    'the requested mailbox selected already, %d had not' %
+                    (self.selecthits, self.selectmisses))
+            self.selecthits = self.selectmisses = 0
+            if self.compressionstats[1] or self.compressionstats[3]:
+                self.ui.compressionstats(self.repos, *self.compressionstats)
+            self.compressionstats = [0, 0, 0, 0]
             # reset kerberos state
             self.gss_step = self.GSS_STATE_STEP
             self.gss_vc = None
@@ -19,6 +19,7 @@
 import re
 import string
 from offlineimap.ui import getglobalui
+from offlineimap.flagutil import Flags
 
 
 # find the first quote in a string
@@ -28,6 +29,11 @@ quotere = re.compile(
         \s*(?P<rest>.*)$           # Whitespace & remainder of string""",
     re.VERBOSE)
 
+# one attribute of a FETCH response: a name followed by a flat
+# parenthesized list, a quoted string or an atom
+fetchattrre = re.compile(
+    r'\s*([^\s()"]+)\s+(\([^()]*\)|"(?:[^"\\]|\\.)*"|[^\s()"]+)')
+
 def debug(*args):
     msg = []
     for arg in args:
@@ -77,6 +83,44 @@ def flags2hash(flags):
     {'FLAGS': '(\\Seen Old)', 'UID': '4807'}"""
     return options2hash(flagsplit(flags))
 
+def fetch2hash(response):
+    """Converts an untagged FETCH response to a hash in a single pass
+
+    E.g. '1 (FLAGS (\\Seen Old) UID 4807)' leads to
+    {'FLAGS': '(\\Seen Old)', 'UID': '4807'}, the same as
+    flags2hash(imapsplit(response)[1]) but without splitting the
+    response into intermediate lists first. Responses with literals or
+    nested lists (e.g. BODYSTRUCTURE) are handed to flags2hash()."""
+    if not isinstance(response, basestring):
+        return flags2hash(imapsplit(response)[1])
+    start = response.find('(') + 1
+    end = response.rfind(')')
+    if not start or end < start:
+        raise ValueError("Passed string '%s' is not a FETCH response" %
+            response)
+    retval = {}
+    pos = start
+    match = fetchattrre.match
+    while pos < end:
+        m = match(response, pos, end)
+        if m is None:
+            return flags2hash(response[start - 1:end + 1])
+        retval[m.group(1)] = m.group(2)
+        pos = m.end()
+    return retval
+
+def status2hash(statusstring):
+    """Converts an untagged IMAP STATUS response to a (mailbox, hash) tuple
+
+    E.g. '"INBOX.Sent" (MESSAGES 3 UIDNEXT 4807)' leads to
+    ('INBOX.Sent', {'MESSAGES': 3L, 'UIDNEXT': 4807L})"""
+    splits = imapsplit(statusstring)
+    mailbox, items = splits[0], splits[-1]
+    retval = {}
+    for key, value in flags2hash(items).items():
+        retval[key.upper()] = long(value)
+    return dequote(mailbox), retval
+
 def imapsplit(imapstring):
     """Takes a string from an IMAP conversation and returns a list containing
     its components.  One example string is:
@@ -171,23 +215,33 @@ flagmap = [('\\Seen', 'S'),
            ('\\Flagged', 'F'),
            ('\\Deleted', 'T'),
            ('\\Draft', 'D')]
+flagmap_imap2maildir = dict(flagmap)
+
+_imap2maildir = {}
+_maildir2imap = {}
 
 def flagsimap2maildir(flagstring):
-    """Convert string '(\\Draft \\Deleted)' into a flags set(DR)"""
-    retval = set()
-    imapflaglist = flagstring[1:-1].split()
-    for imapflag, maildirflag in flagmap:
-        if imapflag in imapflaglist:
-            retval.add(maildirflag)
-    return retval
+    """Convert string '(\\Draft \\Deleted)' into Flags('DT')"""
+    flags = _imap2maildir.get(flagstring)
+    if flags is None:
+        flags = Flags([flagmap_imap2maildir[imapflag]
+                       for imapflag in flagstring[1:-1].split()
+                       if imapflag in flagmap_imap2maildir])
+        if len(_imap2maildir) < 1000:
+            # servers send few distinct flag lists, keywords aside
+            _imap2maildir[flagstring] = flags
+    return flags
 
 def flagsmaildir2imap(maildirflaglist):
-    """Convert set of flags ([DR]) into a string '(\\Deleted \\Draft)'"""
-    retval = []
-    for imapflag, maildirflag in flagmap:
-        if maildirflag in maildirflaglist:
-            retval.append(imapflag)
-    return '(' + ' '.join(sorted(retval)) + ')'
+    """Convert flags ('DR') into a string '(\\Answered \\Draft)'"""
+    maildirflaglist = Flags(maildirflaglist)
+    retval = _maildir2imap.get(maildirflaglist)
+    if retval is None:
+        retval = '(' + ' '.join(sorted([imapflag
+            for imapflag, maildirflag in flagmap
+            if maildirflag in maildirflaglist])) + ')'
+        _maildir2imap[maildirflaglist] = retval
+    return retval
 
 def uid_sequence(uidlist):
     """Collapse UID lists into shorter sequence sets
@@ -18,6 +18,11 @@
 import os
 import sys
 import threading
+try:
+    from urllib import unquote_plus
+except ImportError: # python3
+    from urllib.parse import unquote_plus
+from subprocess import Popen, PIPE
 import offlineimap.imaplib2 as imaplib
 import signal
 import socket
@@ -283,14 +288,28 @@ class OfflineImap:
             config.getdefaultint('general', 'maxsyncaccounts', 1))
 
         for reposname in config.getsectionlist('Repository'):
-            for instancename in ["FOLDER_" + reposname,
-                                 "MSGCOPY_" + reposname]:
-                if options.singlethreading:
-                    threadutil.initInstanceLimit(instancename, 1)
-                else:
-                    threadutil.initInstanceLimit(instancename,
-                        config.getdefaultint('Repository ' + reposname,
-                                                  'maxconnections', 2))
+            if options.singlethreading:
+                workers = 1
+            else:
+                workers = config.getdefaultint('Repository ' + reposname,
+                                               'maxconnections', 2)
+            # the task engine shares the folder limit across its workers
+            threadutil.initInstanceLimit("FOLDER_" + reposname, workers)
+            for poolname in ["FOLDER_" + reposname,
+                             "MSGCOPY_" + reposname]:
+                threadutil.initWorkerPool(poolname, workers)
+        if not options.singlethreading:
+            # listing and stat()ing Maildir folders, shared by all
+            # repositories
+            threadutil.initWorkerPool('SCAN',
+                config.getdefaultint('general', 'scanworkers', 4))
+
+        engine = config.getdefault('general', 'engine', 'threads').lower()
+        if engine == 'tasks' and not options.singlethreading:
+            threadutil.initTaskEngine(
+                config.getdefaultint('general', 'taskworkers', 8))
+        elif engine not in ('threads', 'tasks'):
+            self.ui.warn("Unknown engine '%s', using 'threads'" % engine)
         self.config = config
         return (options, args)
 
@@ -328,7 +347,11 @@ class OfflineImap:
                 if account not in syncaccounts:
                     syncaccounts.append(account)
 
+            self.children = []
             def sig_handler(sig, frame):
+                # the sync processes handle signals like we do
+                for child in self.children:
+                    child.send_signal(sig)
                 if sig == signal.SIGUSR1 or sig == signal.SIGHUP:
                     # tell each account to stop sleeping
                     accounts.Account.set_abort_event(self.config, 1)
@@ -351,9 +374,13 @@ class OfflineImap:
             #various initializations that need to be performed:
             offlineimap.mbnames.init(self.config, syncaccounts)
 
+            processes = self.config.getdefaultint('general',
+                                                  'syncprocesses', 1)
             if options.singlethreading:
                 #singlethreaded
                 self.sync_singlethreaded(syncaccounts)
+            elif processes > 1 and len(syncaccounts) > 1:
+                self.sync_multiprocess(syncaccounts, processes)
             else:
                 # multithreaded
                 t = threadutil.ExitNotifyThread(target=syncmaster.syncitall,
@@ -380,6 +407,86 @@ class OfflineImap:
             threading.currentThread().name = "Account sync %s" % accountname
             account.syncrunner()
 
+    def sync_multiprocess(self, accs, processes):
+        """Executed if we want to spread the accounts over several processes
+
+        Every child process is another offlineimap syncing its share of
+        the accounts with the SyncProcessUI, whose output is read by a
+        thread per child and handed to our ui. We hold the locks of the
+        accounts until all children are done, the children do not lock
+        them again. Accounts which are locked by another instance are
+        skipped.
+
+        :param accs: A list of accounts that should be synced
+        :param processes: The maximum number of child processes"""
+        locked = []
+        for accountname in accs:
+            account = accounts.SyncableAccount(self.config, accountname)
+            try:
+                account.lock()
+            except OfflineImapError as e:
+                self.ui.error(e, sys.exc_info()[2])
+                continue
+            locked.append(account)
+        syncaccounts = [account.getname() for account in locked]
+        # later options override the user's ones
+        cmd = [sys.executable, '-c',
+               'from offlineimap import OfflineImap; OfflineImap().run()'] + \
+               sys.argv[1:] + ['-u', 'syncprocessui', '-k', 'syncprocesses=1']
+        if self.config.getdefaultboolean("mbnames", "enabled", 0):
+            self.ui.warn("mbnames is not written when syncing in several "
+                         "processes")
+            cmd += ['-k', 'mbnames:enabled=no']
+        env = dict(os.environ)
+        env[accounts.SYNCPROCESS_ENV] = str(os.getpid())
+        threads, shards = [], []
+        try:
+            for i in range(processes):
+                shard = ','.join(syncaccounts[i::processes])
+                if not shard:
+                    break
+                shards.append(shard)
+                child = Popen(cmd + ['-a', shard], stdin=PIPE, stdout=PIPE,
+                              close_fds=True, env=env)
+                self.children.append(child)
+                thread = threading.Thread(target=self._childevents,
+                                          args=(child, shard),
+                                          name="Sync process %d" % child.pid)
+                thread.setDaemon(True)
+                thread.start()
+                threads.append(thread)
+            for child, thread, shard in zip(self.children, threads, shards):
+                child.wait()
+                thread.join()
+                if child.returncode:
+                    self.ui.warn("Sync process %d for accounts %s exited with "
+                                 "status %d" % (child.pid, shard,
+                                                child.returncode))
+        finally:
+            for account in locked:
+                account.unlock()
+
+    def _childevents(self, child, accounts):
+        """Hand the MachineUI output of a sync process to our ui"""
+        errmsg = None
+        for line in iter(child.stdout.readline, ''):
+            # thread names may contain ':', the urlencoded message not
+            head, sep, msg = line.rstrip('\r\n').rpartition(':')
+            head = head.split(':', 2)
+            if len(head) != 3 or head[0] not in ('msg', 'warn'):
+                continue # not a protocol line, e.g. the banner
+            kind, command, threadname = head
+            msg = unquote_plus(msg)
+            if command == 'getpasserror':
+                errmsg = msg.split('\n', 1)[-1]
+            elif command == 'getpass':
+                password = self.ui.getpass(msg, self.config, errmsg)
+                child.stdin.write(password + '\n')
+                child.stdin.flush()
+                errmsg = None
+            elif command not in ('protocol', 'initbanner', 'terminate'):
+                self.ui.childevent(accounts, kind, command, threadname, msg)
+
     def serverdiagnostics(self, options):
         activeaccounts = self.config.get("general", "accounts")
         if options.accounts:
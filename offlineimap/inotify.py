@@ -0,0 +1,198 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+# Tracking changes of directories with Linux inotify
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+"""Record which files of a set of directories changed
+
+Uses the inotify API of Linux through ctypes, so there are no extra
+dependencies. On other systems :func:`available` returns False."""
+
+import os
+import errno
+import select
+import struct
+from sys import exc_info
+from threading import Thread, Lock
+from offlineimap.ui import getglobalui
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                        use_errno=True)
+    _libc.inotify_init
+    _libc.inotify_add_watch
+except (ImportError, OSError, AttributeError):
+    _libc = None
+
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+WATCHMASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+_eventheader = struct.Struct('iIII')
+
+def available():
+    """Whether inotify can be used on this system"""
+    return _libc is not None
+
+class DirectoryWatcher(object):
+    """Collects the names of files created, moved or deleted in watched
+    directories, until they are taken with :meth:`takechanges`
+
+    Changes that we are about to make ourselves can be announced with
+    :meth:`expect`. All other changes call `onchange(path, name)` from
+    the watcher thread.
+
+    If the watcher fails or is closed, the changes of all directories
+    are unknown from then on."""
+
+    def __init__(self, onchange=None):
+        self.fd = _libc.inotify_init()
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.onchange = onchange
+        self.lock = Lock()
+        self.paths = {}
+        """wd: path of all watches"""
+        self.changes = {}
+        """path: set of changed names, None if the changes are unknown"""
+        self.expected = {}
+        """path: set of names we change ourselves"""
+        self.closed = False
+        # poll() is interrupted by writing to this pipe on close()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.thread = Thread(target=self._run, name='Directory watcher')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def watch(self, path):
+        """Start watching a directory, if not done yet
+
+        Until the first :meth:`takechanges` after this, the changes of
+        the directory are unknown."""
+        with self.lock:
+            if self.closed or path in self.changes:
+                return
+            wd = _libc.inotify_add_watch(self.fd, path, WATCHMASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err), path)
+            self.paths[wd] = path
+            self.changes[path] = None
+            self.expected[path] = set()
+
+    def expect(self, path, name):
+        """Announce that we are going to change `name` in `path`"""
+        with self.lock:
+            if path in self.expected:
+                self.expected[path].add(name)
+
+    def takechanges(self, path):
+        """Return the names changed in `path` since the last call
+
+        :returns: a set of names, or None if the changes are not known
+            as the directory was not watched before or inotify lost
+            events."""
+        with self.lock:
+            if self.closed or path not in self.changes:
+                return None
+            changes = self.changes[path]
+            self.changes[path] = set()
+            self.expected[path] = set()
+            return changes
+
+    def close(self):
+        """Stop watching, closing the inotify file descriptor"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        os.write(self.wakeup_w, 'x')
+
+    def _run(self):
+        try:
+            poll = select.poll()
+            poll.register(self.fd, select.POLLIN)
+            poll.register(self.wakeup_r, select.POLLIN)
+            while not self.closed:
+                try:
+                    events = poll.poll()
+                    if not [fd for fd, state in events if fd == self.fd]:
+                        continue
+                    data = os.read(self.fd, 65536)
+                except (OSError, select.error) as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                self._dispatch(data)
+        except Exception as e:
+            getglobalui().error(e, exc_info()[2],
+                                "Watching Maildir folders failed, scanning "
+                                "them in full from now on")
+        finally:
+            with self.lock:
+                self.closed = True
+                for path in self.changes:
+                    self.changes[path] = None
+            os.close(self.fd)
+            os.close(self.wakeup_r)
+            os.close(self.wakeup_w)
+
+    def _dispatch(self, data):
+        """Record the events in `data` and call onchange for the ones we
+        did not expect"""
+        offset = 0
+        unexpected = []
+        with self.lock:
+            while offset < len(data):
+                wd, mask, cookie, length = \
+                    _eventheader.unpack_from(data, offset)
+                offset += _eventheader.size
+                name = data[offset:offset + length].rstrip('\0')
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    for path in self.changes:
+                        self.changes[path] = None
+                    unexpected.append((None, None))
+                    continue
+                path = self.paths.get(wd)
+                if path is None:
+                    continue
+                if mask & IN_IGNORED:
+                    # the directory is gone
+                    del self.paths[wd]
+                    del self.changes[path]
+                    del self.expected[path]
+                    continue
+                if self.changes[path] is not None:
+                    self.changes[path].add(name)
+                if name in self.expected[path]:
+                    self.expected[path].discard(name)
+                else:
+                    unexpected.append((path, name))
+        if self.onchange:
+            for path, name in unexpected:
+                try:
+                    self.onchange(path, name)
+                except Exception as e:
+                    # the change is recorded, only the notification is lost
+                    getglobalui().error(e, exc_info()[2],
+                                        "Notifying a change of %s" % path)
@@ -47,6 +47,7 @@ class BaseRepository(CustomConfig.ConfigHelperMixin, object):
         self.folderfilter = lambda foldername: 1
         self.folderincludes = []
         self.foldersort = None
+        self.folderpriority = lambda foldername: foldername == 'INBOX'
         if self.config.has_option(self.getsection(), 'nametrans'):
             self.nametrans = self.localeval.eval(
                 self.getconf('nametrans'), {'re': re})
@@ -59,6 +60,9 @@ class BaseRepository(CustomConfig.ConfigHelperMixin, object):
         if self.config.has_option(self.getsection(), 'foldersort'):
             self.foldersort = self.localeval.eval(
                 self.getconf('foldersort'), {'re': re})
+        if self.config.has_option(self.getsection(), 'folderpriority'):
+            self.folderpriority = self.localeval.eval(
+                self.getconf('folderpriority'), {'re': re})
 
     def restore_atime(self):
         """Sets folders' atime back to their values after a sync
@@ -83,6 +87,11 @@ class BaseRepository(CustomConfig.ConfigHelperMixin, object):
     def dropconnections(self):
         pass
 
+    def shutdown(self):
+        """Release what is kept from one sync of the account to the
+        next, once the account is done syncing"""
+        pass
+
     def getaccount(self):
         return self.account
 
@@ -16,10 +16,10 @@
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
 from offlineimap.repository.Base import BaseRepository
-from offlineimap import folder, imaputil, imapserver, OfflineImapError
+from offlineimap import folder, imaplib2, imaputil, imapserver, OfflineImapError
 from offlineimap.folder.UIDMaps import MappedIMAPFolder
 from offlineimap.threadutil import ExitNotifyThread
-from threading import Event
+from threading import Event, Lock
 import os
 from sys import exc_info
 import netrc
@@ -33,6 +33,13 @@ class IMAPRepository(BaseRepository):
         self._host = None
         self.imapserver = imapserver.IMAPServer(self)
         self.folders = None
+        self._folderstatus = None
+        self._folderstatuslock = Lock()
+        self.folderstatusdir = os.path.join(self.config.getmetadatadir(),
+                                            'Repository-' + self.name,
+                                            'FolderStatus')
+        if not os.path.exists(self.folderstatusdir):
+            os.mkdir(self.folderstatusdir, 0o700)
         if self.getconf('sep', None):
             self.ui.info("The 'sep' setting is being ignored for IMAP "
                          "repository '%s' (it's autodetected)" % self)
@@ -153,6 +160,15 @@ class IMAPRepository(BaseRepository):
     def getssl(self):
         return self.getconfboolean('ssl', 0)
 
+    def getcompression(self):
+        return self.getconfboolean('compression', False)
+
+    def getadaptiveconnections(self):
+        return self.getconfboolean('adaptiveconnections', False)
+
+    def getreadsize(self):
+        return self.getconfint('readsize', imaplib2.READ_SIZE)
+
     def getsslclientcert(self):
         return self.getconf('sslclientcert', None)
 
@@ -255,11 +271,33 @@ class IMAPRepository(BaseRepository):
         return folder.IMAP.IMAPFolder
 
     def connect(self):
-        imapobj = self.imapserver.acquireconnection()
-        self.imapserver.releaseconnection(imapobj)
+        self.imapserver.warmup()
 
     def forgetfolders(self):
         self.folders = None
+        self._folderstatus = None
+
+    def getfolderstatusdir(self):
+        return self.folderstatusdir
+
+    def getfolderstatus(self, foldername):
+        """Return the STATUS values of the folder with full name `foldername`
+
+        The first call queries the status of all folders in a single
+        round trip (see :meth:`IMAPServer.folderstatus`), later calls
+        are answered from that cache until :meth:`forgetfolders` is
+        invoked.
+
+        :returns: dict of STATUS items, e.g. {'MESSAGES': 3L, 'UIDNEXT':
+            4807L, 'UIDVALIDITY': 1L}, or None if the server did not
+            report on this folder."""
+        with self._folderstatuslock:
+            if self._folderstatus is None:
+                mailboxes = [f.getfullname() for f in self.getfolders()]
+                if not foldername in mailboxes:
+                    mailboxes.append(foldername)
+                self._folderstatus = self.imapserver.folderstatus(mailboxes)
+            return self._folderstatus.get(foldername)
 
     def getfolders(self):
         if self.folders != None:
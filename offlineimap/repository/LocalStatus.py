@@ -17,8 +17,10 @@
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
 from offlineimap.folder.LocalStatus import LocalStatusFolder, magicline
-from offlineimap.folder.LocalStatusSQLite import LocalStatusSQLiteFolder
+from offlineimap.folder.LocalStatusSQLite import LocalStatusSQLiteFolder, \
+    LocalStatusSQLiteQueryFolder, LocalStatusSQLiteDB
 from offlineimap.repository.Base import BaseRepository
+from threading import Lock
 import os
 import re
 
@@ -31,7 +33,10 @@ class LocalStatusRepository(BaseRepository):
         backend = self.account.getconf('status_backend', 'plain')
         if backend == 'sqlite':
             self._backend = 'sqlite'
-            self.LocalStatusFolderClass = LocalStatusSQLiteFolder
+            if self.account.getconfboolean('status_ondemand', False):
+                self.LocalStatusFolderClass = LocalStatusSQLiteQueryFolder
+            else:
+                self.LocalStatusFolderClass = LocalStatusSQLiteFolder
             self.root += '-sqlite'
         elif backend == 'plain':
             self._backend = 'plain'
@@ -42,9 +47,18 @@ class LocalStatusRepository(BaseRepository):
 
         if not os.path.exists(self.root):
             os.mkdir(self.root, 0o700)
+        # Journals of the plain backend live in a directory of their own,
+        # as any file name in self.root could be the status of a folder
+        self.journalroot = os.path.join(account.getaccountmeta(),
+                                        'LocalStatus-journal')
+        if self._backend == 'plain' and not os.path.exists(self.journalroot):
+            os.mkdir(self.journalroot, 0o700)
 
         # self._folders is a dict of name:LocalStatusFolders()
         self._folders = {}
+        # the LocalStatusSQLiteDB shared by all sqlite folders
+        self.statusdb = None
+        self.statusdblock = Lock()
 
     def getsep(self):
         return '.'
@@ -62,6 +76,15 @@ class LocalStatusRepository(BaseRepository):
         basename = re.sub('(^|\/)\.$','\\1dot', basename)
         return os.path.join(self.root, basename)
 
+    def getstatusdb(self):
+        """Return the status database of the account, for the sqlite
+        backend"""
+        with self.statusdblock:
+            if self.statusdb is None:
+                self.statusdb = LocalStatusSQLiteDB(os.path.join(
+                    self.account.getaccountmeta(), 'LocalStatus-sqlite.db'))
+            return self.statusdb
+
     def makefolder(self, foldername):
         """Create a LocalStatus Folder
 
@@ -78,6 +101,11 @@ class LocalStatusRepository(BaseRepository):
         file.write(magicline + '\n')
         file.close()
         os.rename(filename + ".tmp", filename)
+        # A stale journal would resurrect messages of a former folder
+        journalname = os.path.join(self.journalroot,
+                                   os.path.basename(filename))
+        if os.path.exists(journalname):
+            os.unlink(journalname)
         # Invalidate the cache.
         self._folders = {}
 
@@ -20,6 +20,8 @@ from offlineimap import folder
 from offlineimap.ui import getglobalui
 from offlineimap.error import OfflineImapError
 from offlineimap.repository.Base import BaseRepository
+from offlineimap import inotify
+from offlineimap.threadutil import getWorkerPool
 import os
 from stat import *
 
@@ -39,6 +41,33 @@ class MaildirRepository(BaseRepository):
         if not os.path.isdir(self.root):
             os.mkdir(self.root, 0o700)
 
+        self.scancachedir = None
+        if self.getconfboolean('scancache', True):
+            self.scancachedir = os.path.join(self.config.getmetadatadir(),
+                                             'Repository-' + self.name,
+                                             'ScanCache')
+            if not os.path.exists(self.scancachedir):
+                os.mkdir(self.scancachedir, 0o700)
+
+        # Listing and stat()ing directories is shared out to a pool of
+        # threads, as they mostly wait for the disk
+        try:
+            self.scanpool = getWorkerPool('SCAN')
+        except KeyError: # single threaded
+            self.scanpool = None
+        self.scanchunk = 64
+        """number of directory entries checked by one scan pool call"""
+
+        # Watching the folders only pays off if we sync them repeatedly
+        self.watcher = None
+        self.lastscans = {}
+        if account.refreshperiod and self.getconfboolean('watch', False):
+            if inotify.available():
+                self.watcher = inotify.DirectoryWatcher(self._localchange)
+            else:
+                self.ui.warn("Cannot watch Maildir repository %s for "
+                             "changes, inotify is not available." % self)
+
     def _append_folder_atimes(self, foldername):
         """Store the atimes of a folder's new|cur in self.folder_atimes"""
         p = os.path.join(self.root, foldername)
@@ -60,6 +89,34 @@ class MaildirRepository(BaseRepository):
             os.utime(new_dir, (new_atime, os.path.getmtime(new_dir)))
             os.utime(cur_dir, (cur_atime, os.path.getmtime(cur_dir)))
 
+    def _localchange(self, path, filename):
+        """Called by the watcher for changes we did not make ourselves"""
+        self.debug("Noticed a change of %s, requesting a sync" %
+                   (os.path.join(path, filename) if path else self))
+        self.account.notifylocalchange()
+
+    def getwatcher(self):
+        """The inotify.DirectoryWatcher of the folders, None if disabled"""
+        return self.watcher
+
+    def shutdown(self):
+        if self.watcher:
+            self.watcher.close()
+
+    def scanmap(self, target, argslist):
+        """Call `target` with each of the argument tuples of `argslist`,
+        in parallel on the shared scan pool unless we are single threaded
+
+        :returns: the list of the results, in the order of `argslist`"""
+        if self.scanpool is None or len(argslist) < 2:
+            return [target(*args) for args in argslist]
+        return self.scanpool.map(target, argslist,
+                                 "Scan Maildir repository %s" % self)
+
+    def getscancachedir(self):
+        """Directory of the folders' scan caches, None if disabled"""
+        return self.scancachedir
+
     def getlocalroot(self):
         return os.path.expanduser(self.getconf('localfolders'))
 
@@ -133,9 +190,27 @@ class MaildirRepository(BaseRepository):
                                "folder '%s'." % foldername,
                                OfflineImapError.ERROR.FOLDER)
 
+    def _checkfolderdirs(self, toppath, dirnames):
+        """Return whether each of `dirnames` in `toppath` is a directory
+        and whether it is a Maildir folder, as (isdir, ismaildir) pairs"""
+        retval = []
+        for dirname in dirnames:
+            fullname = os.path.join(toppath, dirname)
+            if not os.path.isdir(fullname):
+                retval.append((False, False))
+                continue
+            retval.append((True,
+                           os.path.isdir(os.path.join(fullname, 'cur')) and
+                           os.path.isdir(os.path.join(fullname, 'new')) and
+                           os.path.isdir(os.path.join(fullname, 'tmp'))))
+        return retval
+
     def _getfolders_scandir(self, root, extension = None):
         """Recursively scan folder 'root'; return a list of MailDirFolder
 
+        The entries of a directory are checked in chunks and nested
+        folders are scanned on the scan pool, see :meth:`scanmap`.
+
         :param root: (absolute) path to Maildir root
         :param extension: (relative) subfolder to examine within root"""
         self.debug("_GETFOLDERS_SCANDIR STARTING. root = %s, extension = %s" \
@@ -150,6 +225,7 @@ class MaildirRepository(BaseRepository):
         self.debug("  toppath = %s" % toppath)
 
         # Iterate over directories in top & top itself.
+        dirnames = []
         for dirname in os.listdir(toppath) + ['']:
             self.debug("  dirname = %s" % dirname)
             if dirname == '' and extension is not None:
@@ -159,8 +235,16 @@ class MaildirRepository(BaseRepository):
                 self.debug("  skip this entry (Maildir special)")
                 # Bypass special files.
                 continue
-            fullname = os.path.join(toppath, dirname)
-            if not os.path.isdir(fullname):
+            dirnames.append(dirname)
+        chunks = [(toppath, dirnames[i:i + self.scanchunk])
+                  for i in xrange(0, len(dirnames), self.scanchunk)]
+        checks = []
+        for chunk in self.scanmap(self._checkfolderdirs, chunks):
+            checks.extend(chunk)
+
+        subfolders = []
+        for dirname, (isdir, ismaildir) in zip(dirnames, checks):
+            if not isdir:
                 self.debug("  skip this entry (not a directory)")
                 # Not a directory -- not a folder.
                 continue
@@ -170,9 +254,7 @@ class MaildirRepository(BaseRepository):
             else:
                 foldername = dirname
 
-            if (os.path.isdir(os.path.join(fullname, 'cur')) and
-                os.path.isdir(os.path.join(fullname, 'new')) and
-                os.path.isdir(os.path.join(fullname, 'tmp'))):
+            if ismaildir:
                 # This directory has maildir stuff -- process
                 self.debug("  This is maildir folder '%s'." % foldername)
                 if self.getconfboolean('restoreatime', False):
@@ -183,8 +265,14 @@ class MaildirRepository(BaseRepository):
                                                            self))
 
             if self.getsep() == '/' and dirname != '':
-                # Recursively check sub-directories for folders too.
-                retval.extend(self._getfolders_scandir(root, foldername))
+                # Recursively check sub-directories for folders too,
+                # keeping their place after the parent folder.
+                subfolders.append((len(retval), foldername))
+        scanned = self.scanmap(self._getfolders_scandir,
+                               [(root, foldername)
+                                for pos, foldername in subfolders])
+        for (pos, foldername), folders in reversed(zip(subfolders, scanned)):
+            retval[pos:pos] = folders
         self.debug("_GETFOLDERS_SCANDIR RETURNING %s" % \
                    repr([x.getname() for x in retval]))
         return retval
@@ -15,11 +15,14 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-from threading import Lock, Thread, BoundedSemaphore, currentThread
+from threading import Lock, Thread, BoundedSemaphore, Condition, Event, \
+    currentThread
 try:
     from Queue import Queue, Empty
 except ImportError: # python3
     from queue import Queue, Empty
+import heapq
+import time
 import traceback
 import os.path
 import sys
@@ -228,3 +231,307 @@ class InstanceLimitedThread(ExitNotifyThread):
         finally:
             if instancelimitedsems and instancelimitedsems[self.instancename]:
                 instancelimitedsems[self.instancename].release()
+
+
+######################################################################
+# Worker pools
+######################################################################
+
+class Future(object):
+    """A function queued on a :class:`WorkerPool`
+
+    Use :meth:`result` to wait for it and get its return value. An
+    exception raised by the function is re-raised there instead of
+    ending the worker thread; its stack trace is kept in
+    :attr:`exit_stacktrace`."""
+    def __init__(self, target, name, args=(), kwargs={}):
+        self.target = target
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+        self.queuetime = time.time()
+        self.claimed = False
+        """set once a worker (or :meth:`WorkerPool.steal`) took it"""
+        self.exit_stacktrace = None
+        self._result = None
+        self._exception = None
+        self._done = Event()
+
+    def run(self):
+        try:
+            self._result = self.target(*self.args, **self.kwargs)
+        except BaseException as e:
+            self._exception = e
+            self.exit_stacktrace = traceback.format_exc()
+        finally:
+            self._done.set()
+
+    def done(self):
+        """Has the function run already?"""
+        return self._done.is_set()
+
+    def wait(self):
+        """Block until the function has run"""
+        # wait with a timeout, so that signals still get through
+        while not self._done.is_set():
+            self._done.wait(60)
+
+    def exception(self):
+        """Wait for the function, returning its exception or None"""
+        self.wait()
+        return self._exception
+
+    def result(self):
+        """Wait for the function, returning its result or raising its
+        exception"""
+        self.wait()
+        if self._exception:
+            raise self._exception
+        return self._result
+
+class WorkerPool(object):
+    """A named pool of up to `workers` threads running queued functions
+    by priority
+
+    Threads are started when work is queued and there is no idle one,
+    and are kept for later work instead of exiting. The pool records
+    the queue depth and how long functions waited for a worker, see
+    :meth:`getstats`."""
+    def __init__(self, name, workers):
+        self.name = name
+        self.maxworkers = max(workers, 1)
+        self.cond = Condition(Lock())
+        self.queue = []
+        self.threads = []
+        self.idle = 0
+        self.running = 0
+        """Number of functions run by workers or :meth:`tryrun` now"""
+        self.submitted = 0
+        self.stolen = 0
+        self.maxdepth = 0
+        self.waittime = 0.0
+        self.maxwait = 0.0
+
+    def submit(self, target, name=None, args=(), kwargs={}, priority=0):
+        """Queue `target` to be called with `args` and `kwargs`
+
+        :param name: thread name to use while running it
+        :param priority: calls with lower values run first, calls of the
+                         same priority in the order they were queued
+        :returns: the :class:`Future` of the call"""
+        return self._submit(Future(target, name or self.name, args, kwargs),
+                            priority)
+
+    def _submit(self, future, priority):
+        self.cond.acquire()
+        try:
+            heapq.heappush(self.queue, (priority, self.submitted, future))
+            self.submitted += 1
+            self.maxdepth = max(self.maxdepth, len(self.queue))
+            if self.idle < len(self.queue) and \
+                    len(self.threads) < self.maxworkers:
+                thread = ExitNotifyThread(target=self._worker,
+                                          args=(len(self.threads),))
+                thread.start()
+                self.threads.append(thread)
+            self.cond.notify()
+        finally:
+            self.cond.release()
+        return future
+
+    def _nextfuture(self):
+        """Dequeue the next function to run, waiting for one
+
+        Called with self.cond held."""
+        while True:
+            while not self.queue or self.running >= self.maxworkers:
+                self.cond.wait()
+            future = heapq.heappop(self.queue)[2]
+            if not future.claimed:
+                future.claimed = True
+                return future
+
+    def steal(self, future):
+        """Claim `future` for the caller if no worker started it yet
+
+        Lets a thread waiting for its queued calls run them itself
+        instead of idling while the workers are busy with other work.
+        :returns: True if the caller has to run the future now"""
+        self.cond.acquire()
+        try:
+            if future.claimed:
+                return False
+            future.claimed = True
+            self.stolen += 1
+            return True
+        finally:
+            self.cond.release()
+
+    def tryrun(self, future):
+        """Run `future` in the caller if no worker started it yet and
+        fewer than `workers` functions of the pool are running
+
+        Unlike :meth:`steal`, the caller takes the slot of a worker while
+        running the function, so waiters never add to the number of
+        functions the pool runs at a time.
+        :returns: True if the caller ran the future"""
+        self.cond.acquire()
+        try:
+            if future.claimed or self.running >= self.maxworkers:
+                return False
+            future.claimed = True
+            self.stolen += 1
+            self.running += 1
+        finally:
+            self.cond.release()
+        try:
+            future.run()
+        finally:
+            self._release()
+        return True
+
+    def _release(self):
+        """Give back the slot of a function that has run"""
+        self.cond.acquire()
+        try:
+            self.running -= 1
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def map(self, target, argslist, name=None):
+        """Call `target` with each of the argument tuples of `argslist`
+        on the pool and wait for all of them
+
+        The caller runs the calls no worker took yet itself, so this may
+        also be used from within a worker of the same pool.
+        :returns: the list of the results, in the order of `argslist`"""
+        futures = [self.submit(target, name, args) for args in argslist]
+        for future in futures:
+            if self.steal(future):
+                future.run()
+        return [future.result() for future in futures]
+
+    def _finished(self, future):
+        """Called by the worker after running `future`"""
+        pass
+
+    def _worker(self, num):
+        thread = currentThread()
+        idlename = "%s worker %d" % (self.name, num)
+        thread.name = idlename
+        while True:
+            self.cond.acquire()
+            try:
+                self.idle += 1
+                future = self._nextfuture()
+                self.idle -= 1
+                self.running += 1
+                waited = time.time() - future.queuetime
+                self.waittime += waited
+                self.maxwait = max(self.maxwait, waited)
+            finally:
+                self.cond.release()
+            thread.name = future.name
+            try:
+                future.run()
+            finally:
+                self._release()
+                thread.name = idlename
+                # the function may have registered us with an account
+                ui = getglobalui()
+                if ui and ui.getthreadaccount(thread):
+                    ui.delThreadDebugLog(thread)
+                    ui.unregisterthread(thread)
+                self._finished(future)
+
+    def getstats(self):
+        """Return a line describing the use of the pool so far"""
+        self.cond.acquire()
+        try:
+            queued = len([e for e in self.queue if not e[2].claimed])
+            started = self.submitted - queued - self.stolen
+            return ("Pool %s: %d threads, %d run, %d run by waiters, %d "
+                    "queued, max queue depth %d, waited %.3fs on average, "
+                    "%.3fs at most" % (self.name, len(self.threads), started,
+                    self.stolen, queued, self.maxdepth,
+                    self.waittime / max(started, 1), self.maxwait))
+        finally:
+            self.cond.release()
+
+workerpools = {}
+workerpoolslock = Lock()
+
+def initWorkerPool(name, workers):
+    """Initialize the :class:`WorkerPool` `name` with up to `workers`
+    threads"""
+    workerpoolslock.acquire()
+    if not name in workerpools:
+        workerpools[name] = WorkerPool(name, workers)
+    workerpoolslock.release()
+
+def getWorkerPool(name):
+    """Return the :class:`WorkerPool` `name`"""
+    return workerpools[name]
+
+
+######################################################################
+# Task engine
+######################################################################
+
+class TaskEngine(WorkerPool):
+    """Runs the folder syncs of all accounts on a fixed number of
+    worker threads
+
+    In the default engine every repository has a pool of its own for
+    folder syncs, so the number of threads grows with the number of
+    accounts synced at the same time. Here tasks are still limited by
+    the 'FOLDER_<repository>' instance limit, but a worker never blocks
+    on a busy instance: it takes the oldest queued task whose instance
+    limit has a free slot and leaves the others queued."""
+    def __init__(self, workers):
+        super(TaskEngine, self).__init__('Task', workers)
+
+    def submit(self, instancename, target, name=None, args=(), kwargs={},
+               priority=0):
+        """Queue `target` to be run as part of instance `instancename`
+
+        :returns: the :class:`Future` of the call"""
+        future = Future(target, name or self.name, args, kwargs)
+        future.instancename = instancename
+        return self._submit(future, priority)
+
+    def _nextfuture(self):
+        while True:
+            for entry in sorted(self.queue):
+                future = entry[2]
+                if future.claimed or \
+                        instancelimitedsems[future.instancename].acquire(False):
+                    self.queue.remove(entry)
+                    heapq.heapify(self.queue)
+                    if not future.claimed:
+                        future.claimed = True
+                        return future
+            # slots are released by other workers, who notify us.
+            # Time out anyway in case a slot is shared with an
+            # InstanceLimitedThread.
+            self.cond.wait(1)
+
+    def _finished(self, future):
+        instancelimitedsems[future.instancename].release()
+        self.cond.acquire()
+        try:
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+taskengine = None
+
+def initTaskEngine(workers):
+    """Run folder syncs on a :class:`TaskEngine` with `workers` threads"""
+    global taskengine
+    taskengine = TaskEngine(workers)
+
+def getTaskEngine():
+    """Return the :class:`TaskEngine`, or None for a pool per repository"""
+    return taskengine
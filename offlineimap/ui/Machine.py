@@ -24,22 +24,35 @@ from threading import currentThread
 from offlineimap.ui.UIBase import UIBase
 import offlineimap
 
-protocol = '7.0.0'
+protocol = '7.1.0'
 
 class MachineLogFormatter(logging.Formatter):
     """urlencodes any outputted line, to avoid multi-line output"""
+    def __init__(self, separator=''):
+        super(MachineLogFormatter, self).__init__()
+        self.separator = separator
+
     def format(self, record):
+        if not hasattr(record, 'mesg'):
+            # plain messages logged by UIBase methods
+            return "%s:%s:%s%s%s" % ('msg', '_display', record.threadName,
+                                     self.separator,
+                                     urlencode([('', record.getMessage())])[1:])
         # urlencode the "mesg" attribute and append to regular line...
         line = super(MachineLogFormatter, self).format(record)
-        return line + urlencode([('', record.mesg)])[1:]
+        return line + self.separator + urlencode([('', record.mesg)])[1:]
 
 class MachineUI(UIBase):
+    separator = ''
+    """Put between the thread name and the message"""
+
     def __init__(self, config, loglevel = logging.INFO):
         super(MachineUI, self).__init__(config, loglevel)
         self._log_con_handler.createLock()
         """lock needed to block on password input"""
         # Set up the formatter that urlencodes the strings...
-        self._log_con_handler.setFormatter(MachineLogFormatter())
+        self._log_con_handler.setFormatter(
+            MachineLogFormatter(self.separator))
 
     def _printData(self, command, msg):
         self.logger.info("%s:%s:%s" % (
@@ -48,10 +61,14 @@ class MachineUI(UIBase):
     def _msg(s, msg):
         s._printData('_display', msg)
 
+    def _printWarning(self, threadname, msg):
+        # warnings are not urlencoded, the empty mesg adds nothing
+        self.logger.warning("%s:%s:%s:%s" % ('warn', '', threadname, msg),
+                            extra={'mesg': ''})
+
     def warn(self, msg, minor = 0):
         # TODO, remove and cleanup the unused minor stuff
-        self.logger.warning("%s:%s:%s:%s" % (
-                'warn', '', currentThread().getName(), msg))
+        self._printWarning(currentThread().getName(), msg)
 
     def registerthread(self, account):
         super(MachineUI, self).registerthread(account)
@@ -78,6 +95,14 @@ class MachineUI(UIBase):
     def connecting(s, hostname, port):
         s._printData('connecting', "%s\n%s" % (hostname, str(port)))
 
+    def compressionstats(s, repository, wirein, plainin, wireout, plainout):
+        s._printData('compressionstats', "%s\n%d\n%d\n%d\n%d" % (
+                repository.getname(), wirein, plainin, wireout, plainout))
+
+    def connectionbudget(s, repository, old, new, reason):
+        s._printData('connectionbudget', "%s\n%d\n%d\n%s" % (
+                repository.getname(), old, new, reason))
+
     def syncfolders(s, srcrepos, destrepos):
         s._printData('syncfolders', "%s\n%s" % (s.getnicename(srcrepos), 
                                                 s.getnicename(destrepos)))
@@ -151,12 +176,11 @@ class MachineUI(UIBase):
 
     def getpass(self, accountname, config, errmsg = None):
         if errmsg:
-            self._printData('getpasserror', "%s\n%s" % (accountname, errmsg),
-                         False)
+            self._printData('getpasserror', "%s\n%s" % (accountname, errmsg))
 
         self._log_con_handler.acquire() # lock the console output
         try:
-            self._printData('getpass', accountname, False)
+            self._printData('getpass', accountname)
             return (sys.stdin.readline()[:-1])
         finally:
             self._log_con_handler.release()
@@ -167,3 +191,23 @@ class MachineUI(UIBase):
 
     def callhook(self, msg):
         self._printData('callhook', msg)
+
+    def childevent(self, accounts, kind, command, threadname, msg):
+        # pass the events of the sync processes on unchanged
+        if kind == 'warn':
+            self._printWarning(threadname, msg)
+        else:
+            self.logger.info("%s:%s:%s" % (kind, command, threadname),
+                             extra={'mesg': msg})
+
+
+class SyncProcessUI(MachineUI):
+    """MachineUI of the processes started for 'syncprocesses'
+
+    The main process parses their output, so the thread name is
+    followed by ':' and warnings are urlencoded like all messages."""
+    separator = ':'
+
+    def _printWarning(self, threadname, msg):
+        self.logger.warning("%s:%s:%s" % ('warn', '', threadname),
+                            extra={'mesg': msg})
@@ -200,6 +200,13 @@ class UIBase(object):
         else:
             self.invaliddebug(debugtype)
 
+    def is_debugging(self, debugtype):
+        """Returns True if debug messages of `debugtype` are logged
+
+        Use this to avoid building expensive debug strings (e.g. from
+        message bodies) that would only end up in the debug buffer."""
+        return debugtype in self.debuglist
+
     def debugging(self, debugtype):
         global debugtypes
         self.logger.debug("Now debugging for %s: %s" % (debugtype,
@@ -279,6 +286,19 @@ class UIBase(object):
             displaystr = ' to %s:%s' % (hostname, port)
         self.logger.info("Establishing connection%s" % displaystr)
 
+    def compressionstats(self, repository, wirein, plainin, wireout,
+                         plainout):
+        """Log the bytes transferred over COMPRESS=DEFLATE connections"""
+        if not self.logger.isEnabledFor(logging.INFO): return
+        self.logger.info("Compression on %s: received %d bytes for %d, "
+                         "sent %d bytes for %d" % (repository, wirein,
+                         plainin, wireout, plainout))
+
+    def connectionbudget(self, repository, old, new, reason):
+        """Log a change of the number of connections to use"""
+        self.logger.info("Using %d instead of %d connections for %s: %s" %
+                         (new, old, repository, reason))
+
     def acct(self, account):
         """Output that we start syncing an account (and start counting)"""
         self.acct_startimes[account] = time.time()
@@ -381,7 +401,10 @@ class UIBase(object):
                         #    'version', offlineimap.__version__))
                         #self._msg("Server ID: %s %s" % (res_type, response[0]))
                     self._msg("Server welcome string: %s" % str(conn.welcome))
-                    self._msg("Server capabilities: %s\n" % str(conn.capabilities))
+                    self._msg("Server capabilities: %s" % str(conn.capabilities))
+                    self._msg("Connection setup times: %s\n" % ', '.join(
+                        ['%s %.3fs' % (phase, secs) for phase, secs in
+                         sorted(conn.phasetimes.items())]))
                     repository.imapserver.releaseconnection(conn)
             if type != 'Status':
                 folderfilter = repository.getconf('folderfilter', None)
@@ -480,6 +503,38 @@ class UIBase(object):
 
     ################################################## Other
 
+    def childevent(self, accounts, kind, command, threadname, msg):
+        """Display an event output by a sync process
+
+        With 'syncprocesses' the accounts are synced by child processes
+        using the MachineUI, whose lines are decoded and passed in here.
+        :param accounts: the accounts synced by that process
+        :param kind: 'msg' or 'warn'"""
+        fields = msg.split('\n')
+        if kind == 'warn':
+            self.warn(msg)
+        elif command in ('_display', 'callhook'):
+            self.info(msg)
+        elif command == 'acct':
+            self.acct(msg)
+        elif command == 'acctdone':
+            if msg in self.acct_startimes:
+                self.acctdone(msg)
+        elif command == 'syncingfolder':
+            self.logger.info("Syncing %s: %s -> %s" % (fields[1], fields[0],
+                                                        fields[2]))
+        elif command == 'copyingmessage':
+            self.logger.info("Copy message %s %s:%s -> %s" % tuple(fields))
+        elif command in ('threadException', 'mainException'):
+            self.warn(msg)
+        elif command in ('deletingmessages', 'addingflags', 'deletingflags',
+                         'validityproblem'):
+            self.logger.info("%s: %s" % (command, ", ".join(
+                        [f.replace('\f', ' ') for f in fields])))
+        else:
+            self.debug('thread', "[%s] %s %s: %s" % (accounts, threadname,
+                                                     command, msg))
+
     def sleep(self, sleepsecs, account):
         """This function does not actually output anything, but handles
         the overall sleep, dealing with updates as necessary.  It will,
@@ -21,7 +21,8 @@ from offlineimap.ui import TTY, Noninteractive, Machine
 UI_LIST = {'ttyui': TTY.TTYUI,
            'basic': Noninteractive.Basic,
            'quiet': Noninteractive.Quiet, 
-           'machineui': Machine.MachineUI}
+           'machineui': Machine.MachineUI,
+           'syncprocessui': Machine.SyncProcessUI}
 
 #add Blinkenlights UI if it imports correctly (curses installed)
 try:
@@ -0,0 +1,68 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+"""Micro-benchmark of FETCH response parsing as done in
+IMAPFolder.cachemessagelist().
+
+Run from the top level dir as 'python -m test.benchmarks.bench_fetch [lines]'
+"""
+import sys
+import time
+
+from offlineimap import imaputil, imaplibutil
+from offlineimap.ui import UI_LIST, setglobalui
+from offlineimap.CustomConfig import CustomConfigParser
+
+FLAGS = ['()', '(\\Seen)', '(\\Seen \\Answered)', '(\\Flagged $Label1)',
+         '(\\Seen \\Deleted \\Draft)']
+
+def make_response(lines):
+    return ['%d (FLAGS %s UID %d)' % (i + 1, FLAGS[i % len(FLAGS)], i + 100)
+            for i in xrange(lines)]
+
+def parse_split(response):
+    """The imapsplit() based parser used up to now"""
+    for messagestr in response:
+        messagestr = messagestr.split(' ', 1)[1]
+        options = imaputil.flags2hash(messagestr)
+        uid = long(options['UID'])
+        flags = imaputil.flagsimap2maildir(options['FLAGS'])
+        rtime = imaplibutil.Internaldate2epoch(messagestr)
+
+def parse_fetch2hash(response):
+    """The single pass parser"""
+    for messagestr in response:
+        options = imaputil.fetch2hash(messagestr)
+        uid = long(options['UID'])
+        flags = imaputil.flagsimap2maildir(options['FLAGS'])
+        rtime = None
+        if 'INTERNALDATE' in options:
+            rtime = imaplibutil.Internaldate2epoch(
+                'INTERNALDATE ' + options['INTERNALDATE'])
+
+def main(lines=100000):
+    config = CustomConfigParser()
+    config.add_section('general')
+    setglobalui(UI_LIST['quiet'](config))
+    response = make_response(lines)
+    for func in (parse_split, parse_fetch2hash):
+        start = time.time()
+        func(response)
+        elapsed = time.time() - start
+        print("%-18s %8d lines in %6.3fs: %10.0f lines/sec" % (
+            func.__name__, lines, elapsed, lines / elapsed))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,98 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+"""Benchmark of imaplib2 fetching a synthetic mailbox from a minimal
+local IMAP server, using different read sizes.
+
+Run from the top level dir as
+'python -m test.benchmarks.bench_imapfetch [megabytes]'
+"""
+import socket
+import sys
+import threading
+import time
+
+from offlineimap import imaplib2
+
+MSGSIZE = 512 * 1024
+
+def make_message(size):
+    line = 'All work and no play makes Jack a dull boy.\r\n'
+    body = line * (size // len(line))
+    return 'From: bench@localhost\r\nSubject: bench\r\n\r\n' + body
+
+class FetchServer(threading.Thread):
+    """Serves one connection, answering FETCH with `count` messages"""
+    def __init__(self, count):
+        super(FetchServer, self).__init__()
+        self.setDaemon(True)
+        self.count = count
+        self.message = make_message(MSGSIZE)
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1)
+        self.port = self.sock.getsockname()[1]
+
+    def run(self):
+        conn, addr = self.sock.accept()
+        rfile = conn.makefile('rb')
+        conn.sendall('* PREAUTH [CAPABILITY IMAP4rev1] bench ready\r\n')
+        while True:
+            line = rfile.readline()
+            if not line:
+                break
+            tag, cmd = line.split(' ', 2)[:2]
+            cmd = cmd.strip().upper()
+            if cmd == 'CAPABILITY':
+                conn.sendall('* CAPABILITY IMAP4rev1\r\n%s OK done\r\n' % tag)
+            elif cmd in ('SELECT', 'EXAMINE'):
+                conn.sendall('* %d EXISTS\r\n%s OK [READ-ONLY] done\r\n' %
+                             (self.count, tag))
+            elif cmd == 'FETCH':
+                for i in range(1, self.count + 1):
+                    conn.sendall('* %d FETCH (BODY[] {%d}\r\n%s)\r\n' %
+                                 (i, len(self.message), self.message))
+                conn.sendall('%s OK done\r\n' % tag)
+            elif cmd == 'LOGOUT':
+                conn.sendall('* BYE\r\n%s OK bye\r\n' % tag)
+                break
+            else:
+                conn.sendall('%s BAD unknown\r\n' % tag)
+        conn.close()
+
+def fetch(megabytes, read_size):
+    count = megabytes * 1024 * 1024 // MSGSIZE
+    server = FetchServer(count)
+    server.start()
+    imapobj = imaplib2.IMAP4('127.0.0.1', server.port)
+    imapobj.read_size = read_size
+    imapobj.select('INBOX', readonly=True)
+    start = time.time()
+    typ, data = imapobj.fetch('1:*', '(BODY[])')
+    elapsed = time.time() - start
+    assert typ == 'OK'
+    received = sum([len(item[1]) for item in data if isinstance(item, tuple)])
+    assert received == count * len(server.message)
+    imapobj.logout()
+    return received, elapsed
+
+def main(megabytes=50):
+    for read_size in (4096, imaplib2.READ_SIZE, 256 * 1024):
+        received, elapsed = fetch(megabytes, read_size)
+        print("read_size %7d: %5.1f MB in %6.3fs: %6.1f MB/s" % (read_size,
+              received / 1048576.0, elapsed, received / 1048576.0 / elapsed))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
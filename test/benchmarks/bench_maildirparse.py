@@ -0,0 +1,130 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+"""Micro-benchmark of Maildir file name parsing as done in
+MaildirFolder._scanfolder(), including the maxage check.
+
+Run from the top level dir as
+'python -m test.benchmarks.bench_maildirparse [filenames]'
+"""
+import os
+import re
+import shutil
+import string
+import sys
+import tempfile
+import time
+
+from offlineimap import accounts
+from offlineimap.flagutil import Flags
+from offlineimap.folder.Maildir import MaildirFolder, re_uidmatch, \
+    re_timestampmatch
+from offlineimap.repository.Maildir import MaildirRepository
+from offlineimap.ui import UI_LIST, setglobalui
+from offlineimap.CustomConfig import CustomConfigParser
+
+INFOS = [':2,', ':2,S', ':2,RS', ':2,FS', ':2,Sa', '']
+
+def make_folder(tmpdir):
+    config = CustomConfigParser()
+    config.add_section('general')
+    config.set('general', 'metadata', os.path.join(tmpdir, 'meta'))
+    config.set('general', 'dry-run', 'False')
+    config.add_section('Account Bench')
+    config.add_section('Repository Local')
+    config.set('Repository Local', 'localfolders',
+               os.path.join(tmpdir, 'mail'))
+    config.set('Repository Local', 'scancache', 'no')
+    setglobalui(UI_LIST['quiet'](config))
+    account = accounts.Account(config, 'Bench')
+    repository = MaildirRepository('Local', account)
+    return MaildirFolder(repository.root, 'INBOX', '.', repository)
+
+def make_filenames(folder, count):
+    """Mostly names as we write them, 1% from another folder and 1% from
+    other programs"""
+    filenames = []
+    for i in xrange(count):
+        fmd5 = folder._foldermd5
+        if i % 100 == 1:
+            fmd5 = '0' * 32
+        name = '%d_%d.%d.host,U=%d,FMD5=%s%s' % (1300000000 + i, i % 7,
+            1000 + i % 13, i + 1, fmd5, INFOS[i % len(INFOS)])
+        if i % 100 == 2:
+            name = '%d.M%dP%d.host,S=1234:2,S' % (1300000000 + i, i, i)
+        filenames.append(name)
+    return filenames
+
+def parse_previous(folder, filenames, maxage):
+    """Up to four regexps per name, and the maxage cutoff per name"""
+    re_flagmatch = re.compile('%s2,(\w*)' % folder.infosep)
+    re_prefixmatch = re.compile('([^' + folder.infosep + ',]*)')
+    result = []
+    for filename in filenames:
+        oldest_time_utc = time.time() - (60*60*24*maxage)
+        oldest_time_struct = time.gmtime(oldest_time_utc)
+        oldest_time_utc -= oldest_time_struct[3] * 3600 + \
+            oldest_time_struct[4] * 60 + oldest_time_struct[5]
+        timestampmatch = re_timestampmatch.search(filename)
+        if long(timestampmatch.group()) < oldest_time_utc:
+            continue
+        prefix, uid, flags = None, None, Flags()
+        prefixmatch = re_prefixmatch.match(filename)
+        if prefixmatch:
+            prefix = prefixmatch.group(1)
+        if ',FMD5=%s' % folder._foldermd5 in filename:
+            uidmatch = re_uidmatch.search(filename)
+            if uidmatch:
+                uid = long(uidmatch.group(1))
+        flagmatch = re_flagmatch.search(filename)
+        if flagmatch:
+            flags = Flags(flagmatch.group(1).translate(
+                    None, string.ascii_lowercase))
+        if uid is not None:
+            uid = long(re_uidmatch.search(filename).group(1))
+        result.append((prefix, uid, flags))
+    return result
+
+def parse_singlepass(folder, filenames, maxage):
+    """One regexp per name, the maxage cutoff once"""
+    result = []
+    cutoff = folder._maxagecutoff(maxage)
+    for filename in filenames:
+        if not folder._iswithinmaxage(filename, cutoff):
+            continue
+        prefix, uid, fmd5, flags = folder._parse_filename(filename)
+        result.append((prefix, uid, flags))
+    return result
+
+def main(count=1000000):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        folder = make_folder(tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+    filenames = make_filenames(folder, count)
+    # keep about half of the messages
+    maxage = (time.time() - 1300000000 - count / 2) / 86400
+    results = []
+    for func in (parse_previous, parse_singlepass):
+        start = time.time()
+        results.append(func(folder, filenames, maxage))
+        elapsed = time.time() - start
+        print("%-17s %8d names in %6.3fs: %10.0f names/sec" % (
+            func.__name__, count, elapsed, count / elapsed))
+    assert results[0] == results[1]
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
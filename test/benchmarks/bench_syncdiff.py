@@ -0,0 +1,119 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+"""Benchmark of computing the work lists of the three sync passes for
+a folder and its status, with per-UID lookups as done up to now and
+with offlineimap.diffutil, with and without NumPy.
+
+Run from the top level dir as
+'python -m test.benchmarks.bench_syncdiff [uids]'
+"""
+import sys
+import time
+
+from offlineimap import diffutil
+from offlineimap.flagutil import Flags
+
+FLAGS = [Flags(), Flags('S'), Flags('RS'), Flags('FS'), Flags('DS')]
+
+class Folder(object):
+    """Just enough of a folder for the sync passes"""
+    def __init__(self, messagelist):
+        self.messagelist = messagelist
+
+    def getmessagelist(self):
+        return self.messagelist
+
+    def getmessageuidlist(self):
+        return self.messagelist.keys()
+
+    def uidexists(self, uid):
+        return uid in self.messagelist
+
+    def getmessageflags(self, uid):
+        return self.messagelist[uid]['flags']
+
+def make_folders(uids):
+    """A folder with 1% new messages, 1% deleted ones and 1% with changed
+    flags compared to its status folder"""
+    src = {}
+    status = {}
+    for uid in xrange(1, uids + 1):
+        flags = FLAGS[uid % len(FLAGS)]
+        if uid % 100 != 1:
+            status[uid] = {'uid': uid, 'flags': flags}
+        if uid % 100 == 2:
+            continue
+        if uid % 100 == 3:
+            flags = flags ^ Flags('F')
+        src[uid] = {'uid': uid, 'flags': flags}
+    return Folder(src), Folder(status)
+
+def passes_lookup(src, status):
+    """Per UID lookups, as syncmessagesto_* did up to now"""
+    copylist = filter(lambda uid: not status.uidexists(uid),
+                      src.getmessageuidlist())
+    deletelist = filter(lambda uid: uid >= 0 and not src.uidexists(uid),
+                        status.getmessageuidlist())
+    addflaglist = {}
+    delflaglist = {}
+    for uid in src.getmessageuidlist():
+        if uid < 0 or not status.uidexists(uid):
+            continue
+        selfflags = src.getmessageflags(uid)
+        statusflags = status.getmessageflags(uid)
+        for flag in selfflags - statusflags:
+            addflaglist.setdefault(flag, []).append(uid)
+        for flag in statusflags - selfflags:
+            delflaglist.setdefault(flag, []).append(uid)
+    return len(copylist), len(deletelist), addflaglist, delflaglist
+
+def passes_diffutil(src, status):
+    """Set operations, as syncmessagesto_* do now"""
+    copylist = diffutil.difference(src.getmessageuidlist(),
+                                   status.getmessageuidlist())
+    deletelist = [uid for uid in diffutil.difference(
+            status.getmessageuidlist(), src.getmessageuidlist()) if uid >= 0]
+    uids = diffutil.intersection(src.getmessageuidlist(),
+                                 status.getmessageuidlist())
+    changed = diffutil.changedflags(
+        ((uid, src.getmessageflags(uid)) for uid in uids),
+        status.getmessagelist())
+    addflaglist, delflaglist = diffutil.flagbatches(
+        (uid, src.getmessageflags(uid), flags) for uid, flags in changed)
+    return len(copylist), len(deletelist), addflaglist, delflaglist
+
+def main(uids=1000000):
+    src, status = make_folders(uids)
+    numpy = diffutil.numpy
+    runs = [('lookup', passes_lookup, None),
+            ('diffutil/sets', passes_diffutil, None)]
+    if numpy is not None:
+        runs.append(('diffutil/numpy', passes_diffutil, numpy))
+    results = []
+    for name, func, usenumpy in runs:
+        diffutil.numpy = usenumpy
+        start = time.time()
+        result = func(src, status)
+        elapsed = time.time() - start
+        results.append(result)
+        print("%-15s %8d uids: %6.3fs (%d to copy, %d to delete)" % (name,
+              uids, elapsed, result[0], result[1]))
+    diffutil.numpy = numpy
+    for result in results[1:]:
+        assert result == results[0]
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -83,7 +83,7 @@ class TestInternalFunctions(unittest.TestCase):
     def test_05_flagsimap2maildir(self):
         """Test imaputil.flagsimap2maildir()"""
         res = imaputil.flagsimap2maildir(b'(\\Draft \\Deleted)')
-        self.assertEqual(res, set(b'DT'))
+        self.assertEqual(set(res), set(b'DT'))
 
     def test_06_flagsmaildir2imap(self):
         """Test imaputil.flagsmaildir2imap()"""
@@ -97,3 +97,26 @@ class TestInternalFunctions(unittest.TestCase):
         """Test imaputil.uid_sequence()"""
         res = imaputil.uid_sequence([1,2,3,4,5,10,12,13])
         self.assertEqual(res, b'1:5,10,12:13')
+
+    def test_08_status2hash(self):
+        """Test imaputil.status2hash()"""
+        res = imaputil.status2hash(b'"INBOX.Sent" (MESSAGES 3 UIDNEXT 4807)')
+        self.assertEqual(res, (b'INBOX.Sent', {b'MESSAGES': 3, b'UIDNEXT': 4807}))
+
+        res = imaputil.status2hash(b'INBOX (messages 0 UIDVALIDITY 1)')
+        self.assertEqual(res, (b'INBOX', {b'MESSAGES': 0, b'UIDVALIDITY': 1}))
+
+    def test_09_fetch2hash(self):
+        """Test imaputil.fetch2hash()"""
+        res = imaputil.fetch2hash(b'1 (FLAGS (\\Seen Old) UID 4807)')
+        self.assertEqual(res, {b'FLAGS': b'(\\Seen Old)', b'UID': b'4807'})
+
+        res = imaputil.fetch2hash(b'7 (UID 12 INTERNALDATE "17-Jul-1996 '
+                                  b'02:44:25 -0700" FLAGS ())')
+        self.assertEqual(res, {b'UID': b'12', b'FLAGS': b'()',
+            b'INTERNALDATE': b'"17-Jul-1996 02:44:25 -0700"'})
+
+        # nested lists fall back to the generic parser
+        res = imaputil.fetch2hash(b'2 (UID 3 BODYSTRUCTURE ("TEXT" ("A" "B")))')
+        self.assertEqual(res, {b'UID': b'3',
+                               b'BODYSTRUCTURE': b'("TEXT" ("A" "B"))'})
@@ -0,0 +1,143 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import os
+import random
+import struct
+import unittest
+import logging
+from threading import Lock
+
+from offlineimap.folder import UIDMaps
+from offlineimap.folder.UIDMaps import MappedIMAPFolder
+
+from test.OLItest import OLITestLib
+
+# Things need to be setup first, usually setup.py initializes everything.
+# but if e.g. called from command line, we take care of default values here:
+if not OLITestLib.cred_file:
+    OLITestLib(cred_file='./test/credentials.conf', cmd='./offlineimap.py')
+
+def setUpModule():
+    logging.info("Set Up test module %s" % __name__)
+    tdir = OLITestLib.create_test_dir(suffix=__name__)
+
+def tearDownModule():
+    logging.info("Tear Down test module")
+    OLITestLib.delete_test_dir()
+
+class MapFile(MappedIMAPFolder):
+    """Just the UID map of a MappedIMAPFolder, kept in `mapfilename`"""
+    def __init__(self, mapfilename):
+        self.mapfilename = mapfilename
+        self.maplock = Lock()
+        (self.diskr2l, self.diskl2r) = self._loadmaps()
+
+    def _getmapfilename(self):
+        return self.mapfilename
+
+class TestUIDMaps(unittest.TestCase):
+    """Tests the UID map file of MappedIMAPFolder, which is appended to
+    and compacted as messages are copied and deleted"""
+
+    def setUp(self):
+        self.mapfilename = os.path.join(OLITestLib.testdir, 'uidmap')
+        if os.path.exists(self.mapfilename):
+            os.unlink(self.mapfilename)
+
+    def assertLoads(self, l2r):
+        """The map file loads as `l2r`"""
+        folder = MapFile(self.mapfilename)
+        self.assertEqual(folder.diskl2r, l2r)
+        self.assertEqual(folder.diskr2l,
+                         dict((rem, loc) for loc, rem in l2r.items()))
+        return folder
+
+    def test_01_random_changes(self):
+        """Random adds, deletes and remaps reload to the same map"""
+        rand = random.Random(4711)
+        with open(self.mapfilename, 'wt') as file:
+            for loc in range(1, 200):
+                file.write('%d:%d\n' % (loc, loc + 1000))
+        folder = MapFile(self.mapfilename)
+        l2r = dict(folder.diskl2r)
+        self.assertEqual(len(l2r), 199)
+        nextloc = 1000
+        for step in range(3000):
+            with folder.maplock:
+                op = rand.random()
+                if op < 0.5 or not l2r:
+                    nextloc += 1
+                    changes = [(nextloc, nextloc + 5000)]
+                elif op < 0.8:
+                    changes = [(loc, 0) for loc in
+                               rand.sample(sorted(l2r), min(2, len(l2r)))]
+                else:
+                    changes = [(rand.choice(sorted(l2r)),
+                                rand.randint(10**6, 10**9))]
+                for loc, rem in changes:
+                    if loc in folder.diskl2r:
+                        del folder.diskr2l[folder.diskl2r.pop(loc)]
+                        del l2r[loc]
+                    if rem:
+                        folder.diskl2r[loc] = rem
+                        folder.diskr2l[rem] = loc
+                        l2r[loc] = rem
+                folder._appendmaps(changes)
+            if step % 97 == 0:
+                self.assertLoads(l2r)
+                # compacted before it grows beyond twice the map
+                self.assertTrue(os.path.getsize(self.mapfilename) <= 16 +
+                                16 * (2 * len(l2r) + UIDMaps.mapslack + 2))
+        self.assertLoads(l2r)
+
+    def test_02_truncated(self):
+        """A pair cut short is ignored, and the file rewritten before it
+        is appended to again"""
+        folder = MapFile(self.mapfilename)
+        folder.diskl2r = dict((loc, loc + 7) for loc in range(1, 50))
+        folder._savemaps()
+        with folder.maplock:
+            folder.diskl2r[100] = 5
+            folder._appendmaps([(100, 5)])
+        l2r = dict(folder.diskl2r)
+        with open(self.mapfilename, 'ab') as file:
+            file.write('\x01\x02\x03')
+        folder = self.assertLoads(l2r)
+        with folder.maplock:
+            folder.diskl2r[101] = 6
+            folder._appendmaps([(101, 6)])
+        l2r[101] = 6
+        self.assertLoads(l2r)
+        self.assertEqual(os.path.getsize(self.mapfilename), 16 + 16 * len(l2r))
+
+    def test_03_header(self):
+        """The header counts the sorted pairs, which are checked"""
+        folder = MapFile(self.mapfilename)
+        folder.diskl2r = {3: 30, 1: 10, 2: 20}
+        folder._savemaps()
+        with open(self.mapfilename, 'rb') as file:
+            data = file.read()
+        self.assertEqual(struct.unpack_from('<8sq', data),
+                         (UIDMaps.mapmagic, 3))
+        for count in (4, -1):
+            with open(self.mapfilename, 'wb') as file:
+                file.write(struct.pack('<8sq', UIDMaps.mapmagic, count))
+                file.write(data[16:])
+            self.assertRaises(Exception, MapFile, self.mapfilename)
+        with open(self.mapfilename, 'wb') as file:
+            file.write(struct.pack('<8sq6q', UIDMaps.mapmagic, 3,
+                                   2, 20, 1, 10, 3, 30))
+        self.assertRaises(Exception, MapFile, self.mapfilename)
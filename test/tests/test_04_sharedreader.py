@@ -0,0 +1,175 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import os
+import socket
+import ssl
+import threading
+import unittest
+import logging
+
+from offlineimap import imaplibutil
+from offlineimap.ui import UI_LIST, setglobalui
+
+from test.OLItest import OLITestLib
+
+# Things need to be setup first, usually setup.py initializes everything.
+# but if e.g. called from command line, we take care of default values here:
+if not OLITestLib.cred_file:
+    OLITestLib(cred_file='./test/credentials.conf', cmd='./offlineimap.py')
+
+def setUpModule():
+    logging.info("Set Up test module %s" % __name__)
+    tdir = OLITestLib.create_test_dir(suffix=__name__)
+
+def tearDownModule():
+    logging.info("Tear Down test module")
+    OLITestLib.delete_test_dir()
+
+certfile = os.path.join(os.path.dirname(__file__), 'keycert.pem')
+"""Self-signed certificate and key of the test server"""
+
+def body(size):
+    """The test message of `size` bytes"""
+    return ('abcdefghijklmnopqrstuvwxyz' * (size // 26 + 1))[:size]
+
+class IMAPServer(object):
+    """A minimal IMAP server, which answers 'UID FETCH n' with a
+    message of n bytes"""
+    def __init__(self, implicitssl=False):
+        self.implicitssl = implicitssl
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+        thread = threading.Thread(target=self._accept)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _accept(self):
+        while True:
+            sock = self.listener.accept()[0]
+            thread = threading.Thread(target=self._serve, args=(sock,))
+            thread.setDaemon(True)
+            thread.start()
+
+    def _serve(self, sock):
+        tls = self.implicitssl
+        if tls:
+            sock = ssl.wrap_socket(sock, certfile=certfile, server_side=True)
+        file = sock.makefile('rb')
+        sock.sendall('* OK test server ready\r\n')
+        while True:
+            line = file.readline()
+            if not line:
+                break
+            tag, command = line.split(' ', 1)
+            command = command.strip().upper()
+            if command == 'CAPABILITY':
+                caps = 'IMAP4rev1' if tls else 'IMAP4rev1 STARTTLS'
+                sock.sendall('* CAPABILITY %s\r\n%s OK done\r\n' % (caps, tag))
+            elif command == 'STARTTLS':
+                sock.sendall('%s OK begin TLS\r\n' % tag)
+                sock = ssl.wrap_socket(sock, certfile=certfile,
+                                       server_side=True)
+                file = sock.makefile('rb')
+                tls = True
+            elif command.startswith('SELECT'):
+                sock.sendall('* 1 EXISTS\r\n* OK [UIDVALIDITY 1] ok\r\n'
+                             '%s OK [READ-WRITE] done\r\n' % tag)
+            elif command.startswith('UID FETCH'):
+                size = int(command.split()[2])
+                sock.sendall('* 1 FETCH (UID %d BODY[] {%d}\r\n%s)\r\n'
+                             '%s OK done\r\n' % (size, size, body(size), tag))
+            elif command == 'LOGOUT':
+                sock.sendall('* BYE bye\r\n%s OK done\r\n' % tag)
+                break
+            else:
+                sock.sendall('%s OK done\r\n' % tag)
+        sock.close()
+
+class IMAP4(imaplibutil.WrappedIMAP4):
+    """Records whether the SharedReader polled the socket while the TLS
+    handshake of STARTTLS ran"""
+    def ssl_wrap_socket(self):
+        self.polledhandshake = self in self.sharedreader.connections.values()
+        super(IMAP4, self).ssl_wrap_socket()
+
+class TestSharedReader(unittest.TestCase):
+    """Tests IMAP connections read by the :class:`SharedReader`"""
+
+    @classmethod
+    def setUpClass(cls):
+        config = OLITestLib.get_default_config()
+        setglobalui(UI_LIST['quiet'](config))
+
+    def setUp(self):
+        self.reader = imaplibutil.SharedReader()
+
+    def fetch(self, imapobj, sizes):
+        """Fetch messages of `sizes` bytes on `imapobj`"""
+        imapobj.select('INBOX')
+        for size in sizes:
+            typ, dat = imapobj.uid('FETCH', str(size), '(BODY[])')
+            self.assertEqual(typ, 'OK')
+            self.assertEqual(dat[0][1], body(size))
+
+    def connect(self, server, tls=None):
+        if server.implicitssl:
+            imapobj = imaplibutil.WrappedIMAP4_SSL('127.0.0.1', server.port,
+                ca_certs=certfile, sharedreader=self.reader)
+        else:
+            imapobj = IMAP4('127.0.0.1', server.port,
+                            sharedreader=self.reader)
+            if tls:
+                imapobj.starttls(ca_certs=certfile)
+                self.assertFalse(imapobj.polledhandshake)
+        imapobj.login('user', 'pass')
+        imapobj.rdth.join(5)
+        self.assertFalse(imapobj.rdth.isAlive())
+        self.assertTrue(imapobj in self.reader.connections.values())
+        return imapobj
+
+    def logout(self, imapobj):
+        imapobj.logout()
+        self.assertFalse(imapobj in self.reader.connections.values())
+
+    def test_01_plain(self):
+        """Plain connections are read by the shared reader"""
+        server = IMAPServer()
+        connections = [self.connect(server) for i in range(3)]
+        for imapobj in connections:
+            self.fetch(imapobj, [1, 100, 70000, 1000000])
+        for imapobj in connections:
+            self.logout(imapobj)
+
+    def test_02_ssl(self):
+        """SSL connections are read without blocking on partial
+        records and with the data decrypted by SSL drained"""
+        server = IMAPServer(implicitssl=True)
+        imapobj = self.connect(server)
+        self.assertEqual(imapobj.sock.gettimeout(), 0.0)
+        self.fetch(imapobj, [1, 20000, 70000, 1000000])
+        self.logout(imapobj)
+
+    def test_03_starttls(self):
+        """STARTTLS reads the handshake with a reader of its own and
+        hands the connection back to the shared reader afterwards"""
+        server = IMAPServer()
+        for i in range(10):
+            imapobj = self.connect(server, tls=True)
+            self.assertTrue(isinstance(imapobj.sock, ssl.SSLSocket))
+            self.fetch(imapobj, [10, 70000])
+            self.logout(imapobj)
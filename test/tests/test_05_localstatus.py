@@ -0,0 +1,156 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import os
+import unittest
+import logging
+from threading import Lock
+
+from offlineimap.folder import LocalStatus
+from offlineimap.folder.LocalStatus import LocalStatusFolder
+from offlineimap.ui import UI_LIST, setglobalui, getglobalui
+
+from test.OLItest import OLITestLib
+
+# Things need to be setup first, usually setup.py initializes everything.
+# but if e.g. called from command line, we take care of default values here:
+if not OLITestLib.cred_file:
+    OLITestLib(cred_file='./test/credentials.conf', cmd='./offlineimap.py')
+
+def setUpModule():
+    logging.info("Set Up test module %s" % __name__)
+    tdir = OLITestLib.create_test_dir(suffix=__name__)
+
+def tearDownModule():
+    logging.info("Tear Down test module")
+    OLITestLib.delete_test_dir()
+
+class StatusFile(LocalStatusFolder):
+    """Just the status and journal files of a LocalStatusFolder"""
+    def __init__(self, filename, compactratio=1.0):
+        self.filename = filename
+        self.journalname = filename + '-journal'
+        self.journal = None
+        self.journalsize = 0
+        self.snapshotsize = 0
+        self.oldformat = False
+        self.compactratio = compactratio
+        self.messagelist = {}
+        self.savelock = Lock()
+        self.doautosave = False
+        self.ui = getglobalui()
+        self.cachemessagelist()
+
+class TestLocalStatus(unittest.TestCase):
+    """Tests the snapshot and journal files of the plain status backend"""
+
+    @classmethod
+    def setUpClass(cls):
+        config = OLITestLib.get_default_config()
+        setglobalui(UI_LIST['quiet'](config))
+
+    def setUp(self):
+        self.filename = os.path.join(OLITestLib.testdir, 'status')
+        for name in (self.filename, self.filename + '-journal'):
+            if os.path.exists(name):
+                os.unlink(name)
+
+    def write(self, name, content):
+        with open(name, 'wt') as file:
+            file.write(content)
+
+    def read(self, name):
+        with open(name, 'rt') as file:
+            return file.read()
+
+    def assertStatus(self, status, flags):
+        """`status` and a fresh load of its files hold `flags`, a dict
+        of uid: flags string"""
+        for folder in (status, StatusFile(self.filename)):
+            self.assertEqual(dict((uid, str(msg['flags'])) for uid, msg
+                                  in folder.messagelist.items()), flags)
+
+    def test_01_replay(self):
+        """Journal records add, reflag and delete messages"""
+        self.write(self.filename, LocalStatus.magicline + '\n1:S\n2:\n3:F\n')
+        self.write(self.filename + '-journal', '2:RS\n-3\n4:\n-1\n1:T\n')
+        status = StatusFile(self.filename)
+        self.assertEqual(status.snapshotsize, 3)
+        self.assertEqual(status.journalsize, 5)
+        self.assertStatus(status, {1: 'T', 2: 'RS', 4: ''})
+
+    def test_02_changes(self):
+        """Changes are appended to the journal, not the snapshot"""
+        self.write(self.filename, LocalStatus.magicline + '\n9:\n')
+        status = StatusFile(self.filename, compactratio=100)
+        status.savemessage(1, None, 'S', 0)
+        status.savemessage(2, None, '', 0)
+        status.savemessageflags(2, 'F')
+        status.deletemessages([1])
+        status.save()
+        self.assertEqual(self.read(self.filename),
+                         LocalStatus.magicline + '\n9:\n')
+        self.assertEqual(self.read(self.filename + '-journal'),
+                         '1:S\n2:\n2:F\n-1\n')
+        self.assertStatus(status, {2: 'F', 9: ''})
+
+    def test_03_torn_tail(self):
+        """A torn last record is ignored and cut off before appending"""
+        self.write(self.filename, LocalStatus.magicline + '\n9:\n')
+        self.write(self.filename + '-journal', '4:S\n5:')
+        status = StatusFile(self.filename, compactratio=100)
+        self.assertEqual(self.read(self.filename + '-journal'), '4:S\n')
+        status.savemessage(6, None, 'S', 0)
+        self.assertEqual(self.read(self.filename + '-journal'), '4:S\n6:S\n')
+        self.assertStatus(status, {4: 'S', 6: 'S', 9: ''})
+
+    def test_04_compaction(self):
+        """The snapshot is rewritten once the journal outgrows it"""
+        status = StatusFile(self.filename, compactratio=1.0)
+        for uid in range(1, 11):
+            status.savemessage(uid, None, '', 0)
+        status.save()
+        self.assertFalse(os.path.exists(self.filename + '-journal'))
+        self.assertEqual(status.snapshotsize, 10)
+        for uid in range(1, 6):
+            status.savemessageflags(uid, 'S')
+        status.save()
+        self.assertEqual(status.journalsize, 5)
+        for uid in range(6, 12):
+            status.savemessage(uid, None, 'S', 0)
+        status.save()
+        self.assertFalse(os.path.exists(self.filename + '-journal'))
+        self.assertEqual(status.snapshotsize, 11)
+        self.assertStatus(status, dict((uid, 'S') for uid in range(1, 12)))
+
+    def test_05_upgrade(self):
+        """Format 1 status files are read and rewritten as format 2"""
+        self.write(self.filename, LocalStatus.magiclines[1] + '\n1:S\n2:\n')
+        status = StatusFile(self.filename, compactratio=100)
+        self.assertTrue(status.oldformat)
+        status.save()
+        self.assertEqual(self.read(self.filename).splitlines()[0],
+                         LocalStatus.magicline)
+        self.assertStatus(status, {1: 'S', 2: ''})
+
+    def test_06_close(self):
+        """save() closes the journal file"""
+        self.write(self.filename, LocalStatus.magicline + '\n9:\n')
+        status = StatusFile(self.filename, compactratio=100)
+        status.savemessage(1, None, 'S', 0)
+        self.assertFalse(status.journal is None)
+        status.save()
+        self.assertTrue(status.journal is None)
+        self.assertEqual(status.journalsize, 1)
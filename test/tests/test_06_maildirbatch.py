@@ -0,0 +1,122 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import os
+import shutil
+import unittest
+import logging
+
+from offlineimap import accounts, OfflineImapError
+from offlineimap.folder.Maildir import MaildirFolder
+from offlineimap.repository.Maildir import MaildirRepository
+from offlineimap.ui import UI_LIST, setglobalui
+
+from test.OLItest import OLITestLib
+
+# Things need to be setup first, usually setup.py initializes everything.
+# but if e.g. called from command line, we take care of default values here:
+if not OLITestLib.cred_file:
+    OLITestLib(cred_file='./test/credentials.conf', cmd='./offlineimap.py')
+
+def setUpModule():
+    logging.info("Set Up test module %s" % __name__)
+    tdir = OLITestLib.create_test_dir(suffix=__name__)
+
+def tearDownModule():
+    logging.info("Tear Down test module")
+    OLITestLib.delete_test_dir()
+
+class TestMaildirBatch(unittest.TestCase):
+    """Tests Maildir folders writing messages in batches ('writebatch')"""
+
+    def setUp(self):
+        maildir = os.path.join(OLITestLib.testdir, 'mail')
+        if os.path.exists(maildir):
+            shutil.rmtree(maildir)
+        config = OLITestLib.get_default_config()
+        config.set('general', 'dry-run', 'False')
+        config.set('Repository Maildir', 'localfolders', maildir)
+        config.set('Repository Maildir', 'writebatch', '3')
+        setglobalui(UI_LIST['quiet'](config))
+        repo = MaildirRepository('Maildir', accounts.Account(config, 'test'))
+        repo.makefolder('INBOX')
+        self.folder = MaildirFolder(repo.root, 'INBOX', '.', repo)
+        self.folder.cachemessagelist()
+        self.flushed = []
+
+    def save(self, uid, flags):
+        self.folder.savemessage(uid, 'Subject: %d\n\nbody\n' % uid, flags,
+                                None)
+        self.folder.afterflush(uid, self.flushed.append, uid)
+
+    def assertFlushed(self, uids):
+        """`uids` were flushed, in this order, and are in 'cur' or 'new'"""
+        self.assertEqual(self.flushed, uids)
+        for uid in uids:
+            filename = self.folder.messagelist[uid]['filename']
+            self.assertFalse(filename.startswith('tmp' + os.sep))
+            self.assertTrue(os.path.exists(os.path.join(
+                self.folder.getfullname(), filename)))
+
+    def test_01_batch(self):
+        """Messages stay in tmp/ until their batch is full"""
+        self.save(1, 'S')
+        self.save(2, '')
+        self.assertEqual(self.flushed, [])
+        self.assertEqual(len(os.listdir(os.path.join(
+            self.folder.getfullname(), 'tmp'))), 2)
+        self.save(3, '')
+        self.assertFlushed([1, 2, 3])
+        self.assertEqual(self.folder._batch, [])
+        self.assertEqual(self.folder._batchcallbacks, {})
+        self.save(4, 'S')
+        self.folder.flushmessages()
+        self.assertFlushed([1, 2, 3, 4])
+
+    def test_02_changed(self):
+        """Messages deleted or moved while batched are dropped from the
+        batch"""
+        self.save(1, 'S')
+        self.save(2, '')
+        self.folder.deletemessage(1)
+        self.folder.savemessageflags(2, 'F')
+        self.save(3, '')
+        self.assertFlushed([2, 3])
+        self.assertFalse(1 in self.folder.messagelist)
+        self.assertEqual(str(self.folder.messagelist[2]['flags']), 'F')
+        self.assertEqual(self.folder._batchcallbacks, {})
+        self.assertEqual(os.listdir(os.path.join(self.folder.getfullname(),
+                                                 'tmp')), [])
+
+    def test_03_failed_rename(self):
+        """A message that cannot be moved stays in the batch for the
+        next flush"""
+        savemessageflags = self.folder.savemessageflags
+        fails = [2]
+        def flaky(uid, flags):
+            if uid in fails:
+                fails.remove(uid)
+                raise OfflineImapError("Can't rename file",
+                                       OfflineImapError.ERROR.FOLDER)
+            return savemessageflags(uid, flags)
+        self.folder.savemessageflags = flaky
+        for uid in (1, 2, 3):
+            self.save(uid, 'S')
+        self.assertFlushed([1, 3])
+        self.assertEqual(self.folder._batch, [2])
+        self.folder.flushmessages()
+        self.assertFlushed([1, 3, 2])
+        self.assertEqual(self.folder._batch, [])
+        self.assertEqual(self.folder._batchcallbacks, {})